@@ -14,8 +14,11 @@ from cloudbot.client import Client
 from cloudbot.config import Config
 from cloudbot.reloader import PluginReloader
 from cloudbot.plugin import PluginManager
-from cloudbot.event import Event, CommandEvent, RegexEvent, EventType
+from cloudbot.event import Event, CommandEvent, RegexEvent
 from cloudbot.util import botvars, formatting
+from cloudbot.util.metrics import MetricsRegistry
+from cloudbot.util.stall import StallDetector
+from cloudbot.util.tracing import Tracer
 from cloudbot.clients.irc import IrcClient
 
 logger = logging.getLogger("cloudbot")
@@ -38,6 +41,9 @@ class CloudBot:
     :type config: core.config.Config
     :type plugin_manager: PluginManager
     :type reloader: PluginReloader
+    :type stall_detector: StallDetector
+    :type metrics: MetricsRegistry
+    :type tracer: Tracer
     :type db_engine: sqlalchemy.engine.Engine
     :type db_factory: sqlalchemy.orm.session.sessionmaker
     :type db_session: sqlalchemy.orm.scoping.scoped_session
@@ -91,6 +97,23 @@ class CloudBot:
         botvars.metadata = self.db_metadata
         logger.debug("Database system initialised.")
 
+        # set up metrics, which the connections and plugin manager add to
+        self.metrics = MetricsRegistry()
+        self.metrics.add_collector(self._collect_metrics)
+        self._metrics_server = None
+        self._metrics_writer = None
+
+        # tracing of incoming lines through the bot, if it's enabled
+        tracing = self.config.get("tracing", {})
+        if tracing.get("enabled", False):
+            self.tracer = Tracer(os.path.abspath(tracing.get("path", os.path.join("logs", "trace.json"))),
+                                 sample_rate=tracing.get("sample_rate", 1.0),
+                                 max_events=tracing.get("max_events", 100000))
+            logger.info("Tracing {:.0%} of incoming lines to {}".format(self.tracer.sample_rate, self.tracer.path))
+        else:
+            self.tracer = None
+        self._trace_writer = None
+
         # Bot initialisation complete
         logger.debug("Bot setup completed.")
 
@@ -102,6 +125,15 @@ class CloudBot:
 
         self.plugin_manager = PluginManager(self)
 
+        # watches for plugins blocking the event loop
+        stall_config = self.config.get("stall_detector", {})
+        if stall_config.get("enabled", True):
+            self.stall_detector = StallDetector(self.loop, threshold=stall_config.get("threshold", 0.5),
+                                                interval=stall_config.get("interval", 0.1),
+                                                attribute=self.plugin_manager.hook_at)
+        else:
+            self.stall_detector = None
+
     def run(self):
         """
         Starts CloudBot.
@@ -125,10 +157,14 @@ class CloudBot:
             nick = conf['nick']
             server = conf['connection']['server']
             port = conf['connection'].get('port', 6667)
+            use_ssl = conf['connection'].get('ssl', False)
+            # other servers to fall back to when this one can't be reached
+            servers = [(other['server'], other.get('port', 6667), other.get('ssl', use_ssl))
+                       for other in conf['connection'].get('servers', [])]
 
             self.connections.append(IrcClient(self, name, nick, config=conf, channels=conf['channels'],
                                               readable_name=readable_name, server=server, port=port,
-                                              use_ssl=conf['connection'].get('ssl', False)))
+                                              use_ssl=use_ssl, servers=servers))
             logger.debug("[{}] Created connection.".format(readable_name))
 
     @asyncio.coroutine
@@ -160,6 +196,26 @@ class CloudBot:
                 continue
             connection.close()
 
+        self.plugin_manager.shutdown_executors()
+
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            self._metrics_server = None
+        if self._metrics_writer is not None:
+            self._metrics_writer.cancel()
+            self._metrics_writer = None
+        if self.tracer is not None:
+            if self._trace_writer is not None:
+                self._trace_writer.cancel()
+                self._trace_writer = None
+            try:
+                self.tracer.write()
+            except OSError:
+                logger.exception("Error writing trace events to {}".format(self.tracer.path))
+
+        if self.stall_detector is not None:
+            self.stall_detector.stop()
+
         self.running = False
         # Give the stopped_future a result, so that run() will exit
         self.stopped_future.set_result(restart)
@@ -183,76 +239,129 @@ class CloudBot:
             # start plugin reloader
             self.reloader.start(os.path.abspath("plugins"))
 
+        # start watching for stalls once plugins are loaded, since loading them blocks the loop anyway
+        if self.stall_detector is not None:
+            self.stall_detector.start()
+
+        yield from self._start_metrics()
+        if self.tracer is not None:
+            self._trace_writer = asyncio.async(self.tracer.write_periodically(
+                self.config.get("tracing", {}).get("write_interval", 30), loop=self.loop), loop=self.loop)
+
         # Connect to servers
         yield from asyncio.gather(*[conn.connect() for conn in self.connections], loop=self.loop)
 
         # Run a manual garbage collection cycle, to clean up any unused objects created during initialization
         gc.collect()
 
+    @asyncio.coroutine
+    def _start_metrics(self):
+        """
+        Starts the metrics HTTP listener and file writer, if they're enabled
+        """
+        metrics_config = self.config.get("metrics", {})
+        listen = metrics_config.get("listen", {})
+        if listen.get("enabled", False):
+            host, port = listen.get("host", "127.0.0.1"), listen.get("port", 9477)
+            try:
+                self._metrics_server = yield from self.metrics.serve(host, port, loop=self.loop)
+            except OSError as e:
+                logger.error("Couldn't listen for metrics requests on {}:{}: {}".format(host, port, e))
+            else:
+                logger.info("Serving metrics on http://{}:{}/".format(host, port))
+        metrics_file = metrics_config.get("file", {})
+        if metrics_file.get("enabled", False):
+            path = os.path.abspath(metrics_file.get("path", os.path.join("logs", "metrics.prom")))
+            self._metrics_writer = asyncio.async(self.metrics.write_periodically(
+                path, metrics_file.get("interval", 60), loop=self.loop), loop=self.loop)
+
+    def _collect_metrics(self):
+        """
+        Gets metrics for MetricsRegistry from the statistics the connections and stall detector keep
+        """
+        for attribute, metric_type, documentation in (
+                ("connected", "gauge", "Whether the connection is connected"),
+                ("lines_received", "counter", "Lines received from the server"),
+                ("lines_sent", "counter", "Lines sent to the server"),
+                ("lines_dropped", "counter", "Outgoing lines dropped because the send queue was full"),
+                ("writes", "counter", "Writes to the socket"),
+                ("events_dispatched", "counter", "Incoming events processed"),
+                ("events_skipped", "counter", "Incoming lines no hook wanted"),
+                ("dispatch_queue_depth", "gauge", "Incoming events waiting to be processed"),
+                ("dispatch_queue_peak", "gauge", "Most incoming events which have been waiting to be processed"),
+                ("hooks_running", "gauge", "Hooks running for incoming events, apart from ones with timeout=0"),
+                ("read_pauses", "counter", "Times reading was paused because too many events were waiting"),
+                ("reading_paused_time", "counter", "Seconds reading has been paused for"),
+                ("disconnects", "counter", "Times the connection was lost"),
+                ("connect_attempts", "counter", "Attempts to connect"),
+                ("connect_failures", "counter", "Failed attempts to connect"),
+                ("disconnected_time", "counter", "Seconds spent disconnected"),
+                ("tls_resumptions", "counter", "Reconnects which resumed the previous TLS session")):
+            samples = [({"connection": conn.name}, getattr(conn, attribute)) for conn in self.connections
+                       if hasattr(conn, attribute)]
+            if attribute == "reading_paused_time":
+                name = "cloudbot_reading_paused_seconds_total"
+            elif attribute == "disconnected_time":
+                name = "cloudbot_disconnected_seconds_total"
+            elif metric_type == "counter":
+                name = "cloudbot_{}_total".format(attribute)
+            else:
+                name = "cloudbot_{}".format(attribute)
+            yield (name, metric_type, documentation, samples)
+
+        if self.stall_detector is not None:
+            yield ("cloudbot_loop_lag_seconds", "gauge", "How late the event loop's last heartbeat was",
+                   [({}, self.stall_detector.lag)])
+            yield ("cloudbot_loop_peak_lag_seconds", "gauge", "The latest the event loop's heartbeat has been",
+                   [({}, self.stall_detector.peak_lag)])
+            yield ("cloudbot_loop_stalls_total", "counter", "Times the event loop was blocked for too long",
+                   [({}, self.stall_detector.stalls)])
+
     @asyncio.coroutine
     def process(self, event):
         """
+        Passes an event through the sieves for each hook which wants it, and starts the hooks they let through. Apart
+        from catch-all coroutine hooks, which finish before anything else starts, this doesn't wait for hooks to finish.
         :type event: Event
+        :rtype: list[(cloudbot.plugin.Hook, asyncio.Task)]
+        :return: The hooks which were started, with the tasks running them
         """
         run_before_tasks = []
         tasks = []
-        command_prefix = event.conn.config.get('command_prefix', '.')
-
-        # Raw IRC hook
-        for raw_hook in self.plugin_manager.catch_all_triggers:
-            # run catch-all coroutine hooks before all others - TODO: Make this a plugin argument
-            if not raw_hook.threaded:
-                run_before_tasks.append(
-                    self.plugin_manager.launch(raw_hook, Event(hook=raw_hook, base_event=event)))
-            else:
-                tasks.append(self.plugin_manager.launch(raw_hook, Event(hook=raw_hook, base_event=event)))
-        if event.irc_command in self.plugin_manager.raw_triggers:
-            for raw_hook in self.plugin_manager.raw_triggers[event.irc_command]:
-                tasks.append(self.plugin_manager.launch(raw_hook, Event(hook=raw_hook, base_event=event)))
+        plan = self.plugin_manager.dispatch_plan(event.conn, event.irc_command, event.type)
 
-        # Event hooks
-        if event.type in self.plugin_manager.event_type_hooks:
-            for event_hook in self.plugin_manager.event_type_hooks[event.type]:
-                tasks.append(self.plugin_manager.launch(event_hook, Event(hook=event_hook, base_event=event)))
+        # Raw IRC hooks and event hooks
+        for raw_hook in plan.run_before:
+            run_before_tasks.append(self.plugin_manager.launch(raw_hook, Event.view(event, raw_hook)))
+        for hook in plan.hooks:
+            tasks.append(self.plugin_manager.start(hook, Event.view(event, hook)))
 
-        if event.type is EventType.message:
+        if plan.match_commands:
             # Commands
             if event.chan.lower() == event.nick.lower():  # private message, no command prefix
-                command_re = r'(?i)^(?:[{}]?|{}[,;:]+\s+)(\w+)(?:$|\s+)(.*)'.format(command_prefix, event.conn.nick)
+                match = plan.private_command_re.match(event.content)
             else:
-                command_re = r'(?i)^(?:[{}]|{}[,;:]+\s+)(\w+)(?:$|\s+)(.*)'.format(command_prefix, event.conn.nick)
-
-            match = re.match(command_re, event.content)
+                match = plan.channel_command_re.match(event.content)
 
             if match:
                 command = match.group(1).lower()
-                if command in self.plugin_manager.commands:
-                    command_hook = self.plugin_manager.commands[command]
-                    command_event = CommandEvent(hook=command_hook, text=match.group(2).strip(),
-                                                 triggered_command=command, base_event=event)
-                    tasks.append(self.plugin_manager.launch(command_hook, command_event))
-                else:
-                    potential_matches = []
-                    for potential_match, plugin in self.plugin_manager.commands.items():
-                        if potential_match.startswith(command):
-                            potential_matches.append((potential_match, plugin))
-                    if potential_matches:
-                        if len(potential_matches) == 1:
-                            command_hook = potential_matches[0][1]
-                            command_event = CommandEvent(hook=command_hook, text=match.group(2).strip(),
-                                                         triggered_command=command, base_event=event)
-                            tasks.append(self.plugin_manager.launch(command_hook, command_event))
-                        else:
-                            event.notice("Possible matches: {}".format(
-                                formatting.get_text_list([command for command, plugin in potential_matches])))
-
+                potential_matches = self.plugin_manager.find_commands(command)
+                if len(potential_matches) == 1:
+                    command_hook = potential_matches[0][1]
+                    command_event = CommandEvent.view(event, command_hook, text=match.group(2).strip(),
+                                                      triggered_command=command)
+                    tasks.append(self.plugin_manager.start(command_hook, command_event))
+                elif potential_matches:
+                    event.notice("Possible matches: {}".format(
+                        formatting.get_text_list([command for command, plugin in potential_matches])))
+
+        if plan.match_regexes:
             # Regex hooks
-            for regex, regex_hook in self.plugin_manager.regex_hooks:
-                match = regex.search(event.content)
-                if match:
-                    regex_event = RegexEvent(hook=regex_hook, match=match, base_event=event)
-                    tasks.append(self.plugin_manager.launch(regex_hook, regex_event))
+            for match, regex_hook in self.plugin_manager.regex_matcher.search(event.content):
+                regex_event = RegexEvent.view(event, regex_hook, match=match)
+                tasks.append(self.plugin_manager.start(regex_hook, regex_event))
 
         # Run the tasks
         yield from asyncio.gather(*run_before_tasks, loop=self.loop)
-        yield from asyncio.gather(*tasks, loop=self.loop)
+        started = yield from asyncio.gather(*tasks, loop=self.loop)
+        return [hook_task for hook_task in started if hook_task is not None]
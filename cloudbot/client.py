@@ -1,12 +1,30 @@
 import asyncio
-from collections import deque
+from collections import deque, OrderedDict
+import enum
 import logging
+import string
+import sys
+import time
 
 from cloudbot.permissions import PermissionManager
 
 logger = logging.getLogger("cloudbot")
 
 
+@enum.unique
+class Priority(enum.IntEnum):
+    """
+    Priority of an outgoing line. Lines with a lower value are always sent first.
+
+    critical: Protocol-critical lines (PONG, NICK, QUIT), which are never held back by flood control
+    interactive: Replies to users, the default
+    bulk: Long listings and relays, which should never delay a reply
+    """
+    critical = 0
+    interactive = 1
+    bulk = 2
+
+
 class Client:
     """
     A Client representing each connection the bot makes to a single server
@@ -14,7 +32,8 @@ class Client:
     :type loop: asyncio.events.AbstractEventLoop
     :type name: str
     :type readable_name: str
-    :type channels: list[str]
+    :type channels: ChannelList
+    :type tracker: StateTracker
     :type config: dict[str, unknown]
     :type nick: str
     :type vars: dict
@@ -37,15 +56,16 @@ class Client:
         self.nick = nick
         self.readable_name = readable_name
 
-        if channels is None:
-            self.channels = []
-        else:
-            self.channels = channels
-
         if config is None:
             self.config = {}
         else:
             self.config = config
+
+        # the channels and users we can see, and the channels we should be in
+        tracking = self.config.get("state_tracking", {})
+        self.tracker = StateTracker(max_users=tracking.get("max_users", 100000),
+                                    history_size=tracking.get("history_size", 100))
+        self.channels = ChannelList(channels or (), key=self.tracker.casefold)
         self.vars = {}
         self.history = {}
 
@@ -74,27 +94,30 @@ class Client:
         """
         raise NotImplementedError
 
-    def message(self, target, text):
+    def message(self, target, text, priority=Priority.interactive):
         """
         Sends a message to the given target
         :type target: str
         :type text: str
+        :type priority: Priority
         """
         raise NotImplementedError
 
-    def action(self, target, text):
+    def action(self, target, text, priority=Priority.interactive):
         """
         Sends an action (or /me) to the given target channel
         :type target: str
         :type text: str
+        :type priority: Priority
         """
         raise NotImplementedError
 
-    def notice(self, target, text):
+    def notice(self, target, text, priority=Priority.interactive):
         """
         Sends a notice to the given target
         :type target: str
         :type text: str
+        :type priority: Priority
         """
         raise NotImplementedError
 
@@ -124,47 +147,489 @@ class Client:
         raise NotImplementedError
 
 
-# TODO: Tracking of user 'mode' in channels
+class ChannelList:
+    """
+    An ordered collection of channel names, with constant time membership checks which follow the server's case
+    mapping. It supports the parts of the list interface which Client.channels has always been used with.
+    """
+    __slots__ = ("_channels", "_key")
+
+    def __init__(self, channels=(), *, key=str.lower):
+        """
+        :type channels: collections.Iterable[str]
+        :param key: The function used to fold channel names before comparing them
+        :type key: (str) -> str
+        """
+        self._key = key
+        self._channels = OrderedDict()
+        for channel in channels:
+            self.append(channel)
+
+    def append(self, channel):
+        """
+        Adds <channel>, if an equivalent channel isn't already in this list
+        :type channel: str
+        """
+        self._channels.setdefault(self._key(channel), channel)
+
+    def remove(self, channel):
+        """
+        Removes <channel>, raising ValueError if it isn't in this list
+        :type channel: str
+        """
+        try:
+            del self._channels[self._key(channel)]
+        except KeyError:
+            raise ValueError("{} is not in the channel list".format(channel)) from None
+
+    def discard(self, channel):
+        """
+        Removes <channel>, if it is in this list
+        :type channel: str
+        """
+        self._channels.pop(self._key(channel), None)
+
+    def rekey(self, key):
+        """
+        Changes the function used to fold channel names, for when the server's case mapping changes
+        :type key: (str) -> str
+        """
+        self._key = key
+        channels = list(self._channels.values())
+        self._channels.clear()
+        for channel in channels:
+            self.append(channel)
+
+    def __contains__(self, channel):
+        return self._key(channel) in self._channels
+
+    def __iter__(self):
+        # iterate over a copy, so the list can be changed while it's being iterated over (for example by a kick while
+        # joining channels)
+        return iter(list(self._channels.values()))
+
+    def __len__(self):
+        return len(self._channels)
+
+    def __repr__(self):
+        return "ChannelList({!r})".format(list(self._channels.values()))
+
+
 class User:
     """
-    :param name: The nickname of this User
-    :param ident: The IRC ident of this User, if applicable
-    :param host: The hostname of this User, if applicable
-    :param mask: The IRC mask (nick!ident@host), if applicable
+    name: The nickname of this User
+    ident: The IRC ident of this User, if known
+    host: The hostname of this User, if known
+    key: The nickname, folded using the server's case mapping
+    channels: The tracked channels this User is in
     :type name: str
     :type ident: str
     :type host: str
-    :type mask: str
+    :type account: str
+    :type realname: str
+    :type away: bool
+    :type key: str
+    :type channels: set[Channel]
     """
+    __slots__ = ("name", "ident", "host", "account", "realname", "away", "key", "channels")
 
-    def __init__(self, name, ident, host, mask):
+    def __init__(self, name, ident=None, host=None, *, key=None):
         self.name = name
         self.ident = ident
         self.host = host
-        self.mask = mask
+        self.account = None
+        self.realname = None
+        self.away = False
+        self.key = key if key is not None else name
+        self.channels = set()
+
+    @property
+    def mask(self):
+        """
+        The IRC mask (nick!ident@host) of this User, if the ident and host are known
+        :rtype: str
+        """
+        if self.ident is None or self.host is None:
+            return None
+        return "{}!{}@{}".format(self.name, self.ident, self.host)
+
+    def __repr__(self):
+        return "User({!r})".format(self.name)
 
 
 class Channel:
     """
     name: the name of this channel
-    users: A dict from nickname to User in this channel
-    user_modes: A dict from User to an str containing all of the user's modes in this channel
+    key: the name of this channel, folded using the server's case mapping
+    users: A dict from folded nickname to User in this channel
+    user_modes: A dict from User to an str containing all of the user's prefix modes in this channel (for example "ov")
     history: A list of (User, timestamp, message content)
+    tracked: Whether the users in this channel are being tracked, False if tracking them would go over the memory budget
     :type name: str
+    :type key: str
     :type users: dict[str, User]
     :type user_modes: dict[User, str]
-    :type history: deque[(User, datetime, str)]
-
+    :type history: deque[(User, float, str)]
+    :type tracked: bool
     """
+    __slots__ = ("name", "key", "users", "user_modes", "history", "tracked")
 
-    def __init__(self, name):
+    def __init__(self, name, *, key=None, history_size=100):
         self.name = name
+        self.key = key if key is not None else name
         self.users = {}
         self.user_modes = {}
-        self.history = deque(maxlen=100)
+        self.history = deque(maxlen=history_size)
+        self.tracked = True
+
+    def track_message(self, user, content):
+        """
+        Adds a message to this channel's history
+        :type user: User
+        :type content: str
+        """
+        self.history.append((user, time.time(), content))
+
+    def __repr__(self):
+        return "Channel({!r})".format(self.name)
+
+
+def _make_casemapping(upper, lower):
+    """
+    :type upper: str
+    :type lower: str
+    :rtype: dict[int, int]
+    """
+    return str.maketrans(string.ascii_uppercase + upper, string.ascii_lowercase + lower)
+
+
+casemappings = {
+    "ascii": _make_casemapping("", ""),
+    "rfc1459": _make_casemapping("[]\\~", "{}|^"),
+    "strict-rfc1459": _make_casemapping("[]\\", "{}|"),
+}
+
+
+class StateTracker:
+    """
+    Tracks the channels a client is in, and the users in them, indexed by folded nick and channel name.
+
+    Nicks are interned, and each User and Channel is stored once, however many channels it is referenced from. To keep
+    memory bounded, at most max_users users are tracked: when a channel would take the tracker over that, the channel
+    stops being tracked and its users are forgotten, until the bot rejoins it.
+
+    :type users: dict[str, User]
+    :type channels: dict[str, Channel]
+    :type prefix_modes: OrderedDict[str, str]
+    :type max_users: int
+    :type history_size: int
+    :type untracked_channels: int
+    """
+
+    def __init__(self, *, max_users=100000, history_size=100):
+        """
+        :type max_users: int
+        :type history_size: int
+        """
+        self.max_users = max_users
+        self.history_size = history_size
+        self.casemapping = "rfc1459"
+        self._casemap = casemappings["rfc1459"]
+        self.users = {}
+        self.channels = {}
+        # prefix mode -> prefix symbol, ordered from highest to lowest
+        self.prefix_modes = OrderedDict([("o", "@"), ("v", "+")])
+        self._prefix_symbols = {"@": "o", "+": "v"}
+        # the number of times a channel has stopped being tracked because of max_users
+        self.untracked_channels = 0
+
+    def casefold(self, name):
+        """
+        Folds a nick or channel name using the server's case mapping
+        :type name: str
+        :rtype: str
+        """
+        return name.translate(self._casemap)
+
+    def set_casemapping(self, casemapping):
+        """
+        Changes the case mapping, re-indexing everything already tracked
+        :type casemapping: str
+        """
+        if casemapping not in casemappings or casemapping == self.casemapping:
+            return
+        self.casemapping = casemapping
+        self._casemap = casemappings[casemapping]
+        users = list(self.users.values())
+        self.users = {}
+        for user in users:
+            user.key = sys.intern(self.casefold(user.name))
+            self.users[user.key] = user
+        channels = list(self.channels.values())
+        self.channels = {}
+        for channel in channels:
+            channel.key = sys.intern(self.casefold(channel.name))
+            channel.users = {user.key: user for user in channel.users.values()}
+            self.channels[channel.key] = channel
+
+    def set_prefixes(self, modes, symbols):
+        """
+        Sets the channel prefix modes the server supports, for example "ov" and "@+"
+        :type modes: str
+        :type symbols: str
+        """
+        self.prefix_modes = OrderedDict(zip(modes, symbols))
+        self._prefix_symbols = dict(zip(symbols, modes))
+
+    def clear(self):
+        """
+        Forgets everything, for when the client reconnects
+        """
+        self.users.clear()
+        self.channels.clear()
+
+    def get_user(self, nick):
+        """
+        :type nick: str
+        :rtype: User
+        """
+        return self.users.get(self.casefold(nick))
+
+    def get_channel(self, name):
+        """
+        :type name: str
+        :rtype: Channel
+        """
+        return self.channels.get(self.casefold(name))
+
+    def update_user(self, nick, ident=None, host=None):
+        """
+        Updates the ident and host of a tracked user, returning the User, or None if the user isn't tracked
+        :type nick: str
+        :type ident: str
+        :type host: str
+        :rtype: User
+        """
+        user = self.users.get(self.casefold(nick))
+        if user is not None:
+            if ident is not None:
+                user.ident = ident
+            if host is not None:
+                user.host = host
+        return user
+
+    def _add_member(self, channel, nick, ident=None, host=None, modes=""):
+        """
+        Adds a user to a tracked channel, creating the User if it isn't already tracked
+        :type channel: Channel
+        :type nick: str
+        :type ident: str
+        :type host: str
+        :type modes: str
+        :rtype: User
+        """
+        key = self.casefold(nick)
+        user = self.users.get(key)
+        if user is None:
+            if len(self.users) >= self.max_users:
+                self._untrack(channel)
+                return None
+            key = sys.intern(key)
+            user = User(sys.intern(nick), ident, host, key=key)
+            self.users[key] = user
+        else:
+            if ident is not None:
+                user.ident = ident
+            if host is not None:
+                user.host = host
+        channel.users[user.key] = user
+        user.channels.add(channel)
+        if modes:
+            channel.user_modes[user] = modes
+        else:
+            channel.user_modes.pop(user, None)
+        return user
+
+    def _remove_member(self, channel, user):
+        """
+        :type channel: Channel
+        :type user: User
+        """
+        channel.users.pop(user.key, None)
+        channel.user_modes.pop(user, None)
+        user.channels.discard(channel)
+        if not user.channels:
+            self.users.pop(user.key, None)
+
+    def _untrack(self, channel):
+        """
+        Stops tracking the users in <channel>, because tracking them would go over max_users
+        :type channel: Channel
+        """
+        logger.warning("Tracking {} would go over the limit of {} users, so it won't be tracked".format(
+            channel.name, self.max_users))
+        self.untracked_channels += 1
+        for user in list(channel.users.values()):
+            self._remove_member(channel, user)
+        channel.tracked = False
+        channel.history.clear()
 
-    def track_message(self):
+    def join(self, channel_name, nick, ident=None, host=None, *, is_self=False):
         """
-        Adds a message to this channel's history, adding user info from the message as well
+        Records <nick> joining <channel_name>. When we join, the channel starts being tracked.
+        :type channel_name: str
+        :type nick: str
+        :type ident: str
+        :type host: str
+        :type is_self: bool
+        :rtype: User
         """
-        pass
+        key = self.casefold(channel_name)
+        if is_self:
+            old_channel = self.channels.get(key)
+            if old_channel is not None:
+                self.remove_channel(channel_name)
+            key = sys.intern(key)
+            channel = Channel(channel_name, key=key, history_size=self.history_size)
+            self.channels[key] = channel
+        else:
+            channel = self.channels.get(key)
+            if channel is None or not channel.tracked:
+                return None
+        return self._add_member(channel, nick, ident, host)
+
+    def part(self, channel_name, nick, *, is_self=False):
+        """
+        Records <nick> leaving <channel_name>, by parting or being kicked
+        :type channel_name: str
+        :type nick: str
+        :type is_self: bool
+        """
+        if is_self:
+            self.remove_channel(channel_name)
+            return
+        channel = self.channels.get(self.casefold(channel_name))
+        user = self.users.get(self.casefold(nick))
+        if channel is not None and user is not None:
+            self._remove_member(channel, user)
+
+    def quit(self, nick):
+        """
+        Records <nick> quitting, removing them from every channel
+        :type nick: str
+        """
+        user = self.users.pop(self.casefold(nick), None)
+        if user is None:
+            return
+        for channel in user.channels:
+            channel.users.pop(user.key, None)
+            channel.user_modes.pop(user, None)
+        user.channels.clear()
+
+    def rename(self, old_nick, new_nick):
+        """
+        Records a user changing their nick from <old_nick> to <new_nick>
+        :type old_nick: str
+        :type new_nick: str
+        """
+        user = self.users.pop(self.casefold(old_nick), None)
+        if user is None:
+            return
+        for channel in user.channels:
+            channel.users.pop(user.key, None)
+        user.name = sys.intern(new_nick)
+        user.key = sys.intern(self.casefold(new_nick))
+        self.users[user.key] = user
+        for channel in user.channels:
+            channel.users[user.key] = user
+
+    def remove_channel(self, channel_name):
+        """
+        Stops tracking <channel_name>, for when we leave it
+        :type channel_name: str
+        """
+        channel = self.channels.pop(self.casefold(channel_name), None)
+        if channel is None:
+            return
+        for user in list(channel.users.values()):
+            self._remove_member(channel, user)
+
+    def set_mode(self, channel_name, nick, mode, adding):
+        """
+        Adds or removes a prefix mode (such as op or voice) for <nick> in <channel_name>
+        :type channel_name: str
+        :type nick: str
+        :type mode: str
+        :type adding: bool
+        """
+        channel = self.channels.get(self.casefold(channel_name))
+        if channel is None or not channel.tracked:
+            return
+        user = channel.users.get(self.casefold(nick))
+        if user is None:
+            return
+        modes = channel.user_modes.get(user, "")
+        if adding and mode not in modes:
+            modes = "".join(m for m in self.prefix_modes if m in modes or m == mode)
+        elif not adding:
+            modes = modes.replace(mode, "")
+        if modes:
+            channel.user_modes[user] = modes
+        else:
+            channel.user_modes.pop(user, None)
+
+    def split_prefixes(self, name):
+        """
+        Splits the prefix symbols from a name in a NAMES or WHO reply, returning the name and its prefix modes
+        :type name: str
+        :rtype: (str, str)
+        """
+        index = 0
+        while index < len(name) and name[index] in self._prefix_symbols:
+            index += 1
+        return name[index:], "".join(self._prefix_symbols[symbol] for symbol in name[:index])
+
+    def names(self, channel_name, names):
+        """
+        Replaces the users in a tracked channel with the contents of a complete NAMES reply
+        :param names: The names from the reply, each with prefix symbols and optionally the user's ident and host
+        :type channel_name: str
+        :type names: list[str]
+        """
+        channel = self.channels.get(self.casefold(channel_name))
+        if channel is None or not channel.tracked:
+            return
+        old_users = set(channel.users.values())
+        channel.user_modes.clear()
+        for name in names:
+            name, modes = self.split_prefixes(name)
+            nick, _, userhost = name.partition("!")
+            ident, _, host = userhost.partition("@")
+            user = self._add_member(channel, nick, ident or None, host or None, modes)
+            if user is None:
+                # we've gone over max_users, and the channel is no longer tracked
+                return
+            old_users.discard(user)
+        for user in old_users:
+            self._remove_member(channel, user)
+
+    def who(self, channel_name, nick, ident, host, flags, realname):
+        """
+        Records a WHO reply for <nick> in <channel_name>
+        :param flags: The flags from the reply, H or G for here or gone, then * for opers, then prefix symbols
+        :type channel_name: str
+        :type nick: str
+        :type ident: str
+        :type host: str
+        :type flags: str
+        :type realname: str
+        """
+        channel = self.channels.get(self.casefold(channel_name))
+        if channel is not None and channel.tracked:
+            _, modes = self.split_prefixes(flags.lstrip("HG*"))
+            user = self._add_member(channel, nick, ident, host, modes)
+        else:
+            user = self.update_user(nick, ident, host)
+        if user is not None:
+            user.away = flags.startswith("G")
+            user.realname = realname
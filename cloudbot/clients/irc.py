@@ -1,19 +1,35 @@
 from _ssl import PROTOCOL_SSLv23
 import asyncio
+import base64
+from collections import deque, OrderedDict
+import functools
 import re
 import ssl
 import logging
+import random
 from ssl import SSLContext
+import time
 
-from cloudbot.client import Client
+from cloudbot.client import Client, Priority
 from cloudbot.event import Event, EventType
+from cloudbot.util.bucket import TokenBucket
+from cloudbot.util.tracing import current_trace, now, span
 
 logger = logging.getLogger("cloudbot")
 
-irc_prefix_re = re.compile(r":([^ ]*) ([^ ]*) (.*)")
-irc_noprefix_re = re.compile(r"([^ ]*) (.*)")
 irc_netmask_re = re.compile(r"([^!@]*)!([^@]*)@(.*)")
 irc_param_re = re.compile(r"(?:^|(?<= ))(:.*|[^ ]+)")
+tag_escape_re = re.compile(r"\\(.?)")
+tag_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+# commands which are sent as Priority.critical unless specified otherwise
+critical_commands = {"PONG", "PING", "NICK", "QUIT", "PASS", "USER", "CAP", "AUTHENTICATE"}
+
+# IRCv3 capabilities which we request by default, if the server supports them
+default_caps = ["multi-prefix", "extended-join", "away-notify", "server-time", "batch", "message-tags"]
+
+# RPL_SASLSUCCESS, and ERR_SASLFAIL, ERR_SASLTOOLONG, ERR_SASLABORTED, ERR_SASLALREADY
+sasl_done_numerics = {"903", "904", "905", "906", "907"}
 
 irc_command_to_event_type = {
     "PRIVMSG": EventType.message,
@@ -24,18 +40,425 @@ irc_command_to_event_type = {
 }
 
 
+# commands which change what the state tracker knows, command -> IrcClient method which handles them
+state_handlers = {
+    "JOIN": "_track_join",
+    "PART": "_track_part",
+    "KICK": "_track_kick",
+    "QUIT": "_track_quit",
+    "NICK": "_track_nick",
+    "MODE": "_track_mode",
+    "AWAY": "_track_away",
+    "PRIVMSG": "_track_message",
+    "005": "_track_isupport",
+    "352": "_track_who",
+    "353": "_track_names",
+    "366": "_track_end_of_names",
+}
+
+# channel modes which take a parameter, used until the server tells us its CHANMODES
+default_chanmodes = ["beI", "k", "l", "imnpst"]
+
+# the maximum length of an IRC line in bytes, not including the trailing "\r\n"
+max_line_bytes = 510
+
+# the longest user and host we expect a server to give us, used until we know our real hostmask
+assumed_userhost = "{}@{}".format("u" * 10, "h" * 63)
+
+
+def _utf8_boundary(data, index):
+    """
+    Moves <index> back until it isn't in the middle of a multi-byte UTF-8 sequence in <data>
+    :type data: bytes
+    :type index: int
+    :rtype: int
+    """
+    while 0 < index < len(data) and (data[index] & 0xC0) == 0x80:  # 0b10xxxxxx is a continuation byte
+        index -= 1
+    return index
+
+
+def _unescape_tag(match):
+    """
+    :type match: re.__Match
+    :rtype: str
+    """
+    return tag_escapes.get(match.group(1), match.group(1))
+
+
+def encode_line(line):
+    """
+    Encodes a single outgoing IRC line, including the line ending.
+
+    Anything after the first line break is discarded, and the line is truncated to max_line_bytes, never in the middle
+    of a character. Use split_message() first to avoid losing text.
+    :type line: str
+    :rtype: bytes
+    """
+    lines = line.splitlines()
+    data = lines[0].encode("utf-8", "replace") if lines else b""
+    if len(data) > max_line_bytes:
+        data = data[:_utf8_boundary(data, max_line_bytes)]
+    return data + b"\r\n"
+
+
+def split_message(text, max_bytes):
+    """
+    Splits <text> into lines which are each at most <max_bytes> long when encoded as UTF-8.
+
+    Existing line breaks are kept, long lines are split on the last space which fits, and words too long to fit on
+    a line by themselves are split between characters, never inside a multi-byte character. Empty lines are dropped.
+    :type text: str
+    :type max_bytes: int
+    :rtype: list[str]
+    """
+    result = []
+    for line in text.splitlines():
+        data = line.encode("utf-8", "replace")
+        while len(data) > max_bytes:
+            cut = data.rfind(b" ", 0, max_bytes + 1)
+            if cut > 0:
+                # split on the space, and drop it
+                result.append(data[:cut])
+                data = data[cut + 1:]
+            else:
+                cut = _utf8_boundary(data, max_bytes)
+                result.append(data[:cut])
+                data = data[cut:]
+        if data:
+            result.append(data)
+    return [data.decode("utf-8") for data in result]
+
+
+class _ResumingSSLContext(SSLContext):
+    """
+    An SSLContext which offers the TLS session from the last connection to each server, so reconnects can skip the
+    full handshake. asyncio doesn't let us pass a session to create_connection(), but it does create every connection
+    through wrap_bio(), so that's where the session is added.
+
+    Session resumption needs Python 3.6, on earlier versions this is a plain SSLContext.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls, *args, **kwargs)
+        # server hostname -> ssl.SSLSession
+        self.sessions = {}
+        return self
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, **kwargs):
+        session = self.sessions.get(server_hostname)
+        if session is not None and not server_side and "session" not in kwargs:
+            kwargs["session"] = session
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, **kwargs)
+
+
+def _trailing(param):
+    """
+    Removes the ":" from the start of a trailing param
+    :type param: str
+    :rtype: str
+    """
+    return param[1:] if param.startswith(":") else param
+
+
+def decode_line(data):
+    """
+    Decodes a single raw IRC line. Lines which aren't valid UTF-8 are decoded as latin-1, which can't fail.
+    :type data: bytes | bytearray | memoryview
+    :rtype: str
+    """
+    try:
+        return str(data, "utf-8")
+    except UnicodeDecodeError:
+        return str(data, "latin-1")
+
+
+class IrcLineBuffer:
+    """
+    Incremental framer for the inbound IRC byte stream.
+
+    Data is appended to a single bytearray, and every complete line is extracted in one pass using a moving offset,
+    so a large burst (NAMES, MOTD, netsplit QUITs) costs O(n) rather than re-copying the buffer once per line.
+    Lines may end with either "\r\n" or a bare "\n". Empty lines are skipped.
+
+    :type _buffer: bytearray
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Adds received data to the buffer, and returns all lines which are now complete
+        :type data: bytes
+        :rtype: list[str]
+        """
+        buffer = self._buffer
+        buffer += data
+
+        lines = []
+        start = 0
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(b"\n", start)
+                if end == -1:
+                    break
+                line_end = end
+                if line_end > start and buffer[line_end - 1] == 13:  # 13 is "\r"
+                    line_end -= 1
+                if line_end > start:
+                    lines.append(decode_line(view[start:line_end]))
+                start = end + 1
+
+        # the memoryview has been released, so we can resize the buffer now
+        if start:
+            del buffer[:start]
+
+        return lines
+
+    def clear(self):
+        """
+        Discards any partially received line
+        """
+        del self._buffer[:]
+
+    def __len__(self):
+        return len(self._buffer)
+
+
+class _cached_property:
+    """
+    A read-only property which is computed on first access, then stored on the instance, replacing itself
+    """
+
+    def __init__(self, function):
+        self.function = function
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.function.__name__] = self.function(instance)
+        return value
+
+
+class IrcMessage:
+    """
+    A single IRC line, parsed on demand.
+
+    Only the prefix and command are split out when the message is created, which is enough to route the line.
+    Every other field is parsed the first time it is accessed, and cached, so lines which are only ever logged or
+    ignored never pay for param, CTCP or channel parsing.
+
+    If the line isn't a valid IRC line, `command` will be None.
+
+    :type raw: str
+    :type command: str
+    :type netmask_prefix: str
+    :type params: str
+    :type tag_string: str
+    :type batch: list[IrcMessage]
+    """
+
+    def __init__(self, conn, raw):
+        """
+        :type conn: IrcClient
+        :type raw: str
+        """
+        self.raw = raw
+        self._conn_nick = conn.nick
+        # for a BATCH end line, all of the messages in the batch
+        self.batch = None
+
+        if raw.startswith("@"):
+            # IRCv3 message tags
+            split = raw[1:].split(" ", 1)
+            if len(split) < 2:
+                self.tag_string = self.netmask_prefix = self.command = self.params = None
+                return
+            self.tag_string, line = split
+        else:
+            self.tag_string = None
+            line = raw
+
+        if line.startswith(":"):
+            split = line[1:].split(" ", 2)
+            if len(split) < 3:
+                self.netmask_prefix = self.command = self.params = None
+                return
+            self.netmask_prefix, self.command, self.params = split
+        else:
+            split = line.split(" ", 1)
+            if len(split) < 2:
+                self.netmask_prefix = self.command = self.params = None
+                return
+            self.netmask_prefix = None
+            self.command, self.params = split
+
+    @_cached_property
+    def tags(self):
+        """
+        The IRCv3 message tags sent with this line. Tags without a value are given the value None.
+        :rtype: dict[str, str]
+        """
+        tags = {}
+        if self.tag_string is None:
+            return tags
+        for tag in self.tag_string.split(";"):
+            if "=" in tag:
+                key, value = tag.split("=", 1)
+                if "\\" in value:
+                    value = tag_escape_re.sub(_unescape_tag, value)
+                tags[key] = value
+            elif tag:
+                tags[tag] = None
+        return tags
+
+    @property
+    def prefix(self):
+        # TODO: Do we need to know this?
+        if self.netmask_prefix is None:
+            return None
+        return ":" + self.netmask_prefix
+
+    @_cached_property
+    def _netmask(self):
+        """
+        :rtype: (str, str, str, str)
+        """
+        if self.netmask_prefix is None:
+            return None, None, None, None
+        netmask_match = irc_netmask_re.match(self.netmask_prefix)
+        if netmask_match is None:
+            # This isn't in the format of a netmask
+            return self.netmask_prefix, None, None, self.netmask_prefix
+        return netmask_match.group(1), netmask_match.group(2), netmask_match.group(3), self.netmask_prefix
+
+    @property
+    def nick(self):
+        return self._netmask[0]
+
+    @property
+    def user(self):
+        return self._netmask[1]
+
+    @property
+    def host(self):
+        return self._netmask[2]
+
+    @property
+    def mask(self):
+        return self._netmask[3]
+
+    @_cached_property
+    def paramlist(self):
+        """
+        :rtype: list[str]
+        """
+        return irc_param_re.findall(self.params)
+
+    @_cached_property
+    def _content(self):
+        """
+        :rtype: (EventType, str, str)
+        """
+        paramlist = self.paramlist
+        if paramlist and paramlist[-1].startswith(":"):
+            # If the last param is in the format of `:content` remove the `:` from it, and set content from it
+            content = paramlist[-1][1:]
+        else:
+            content = None
+
+        event_type = irc_command_to_event_type.get(self.command, EventType.other)
+
+        # Parse for CTCP
+        if event_type is EventType.message and content.count("\x01") >= 2 and content.startswith("\x01"):
+            # Remove the first \x01, then rsplit to remove the last one, and ignore text after the last \x01
+            ctcp_text = content[1:].rsplit("\x01", 1)[0]
+            ctcp_text_split = ctcp_text.split(None, 1)
+            if ctcp_text_split[0] == "ACTION":
+                # this is a CTCP ACTION, set event_type and content accordingly
+                event_type = EventType.action
+                content = ctcp_text_split[1]
+            else:
+                # this shouldn't be considered a regular message
+                event_type = EventType.other
+        else:
+            ctcp_text = None
+
+        return event_type, content, ctcp_text
+
+    @property
+    def event_type(self):
+        """
+        :rtype: EventType
+        """
+        if self.command == "PRIVMSG":
+            # PRIVMSG could be a CTCP, which changes the type, so we need the content
+            return self._content[0]
+        return irc_command_to_event_type.get(self.command, EventType.other)
+
+    @property
+    def content(self):
+        return self._content[1]
+
+    @property
+    def ctcp_text(self):
+        return self._content[2]
+
+    @_cached_property
+    def target(self):
+        """
+        The target of the action, for KICK and INVITE
+        """
+        if self.command == "KICK":
+            return self.paramlist[1]
+        elif self.command == "INVITE":
+            return self.paramlist[0]
+        else:
+            # TODO: Find more commands which give a target
+            return None
+
+    @_cached_property
+    def channel(self):
+        # TODO: Migrate plugins using chan for storage to use chan.lower() instead so we can pass the original case
+        paramlist = self.paramlist
+        if paramlist and (len(paramlist) > 2 or not paramlist[0].startswith(":")):
+            if paramlist[0].lower() == self._conn_nick.lower():
+                # this is a private message - set the channel to the sender's nick
+                return self.nick.lower()
+            else:
+                return paramlist[0].lower()
+        else:
+            return None
+
+
 class IrcClient(Client):
     """
     An implementation of Client for IRC.
+
+    When the connection is lost, or can't be made, the client reconnects with exponential backoff and jitter, moving on
+    to the next server in its server list after each failed attempt.
+
     :type use_ssl: bool
     :type server: str
     :type port: int
+    :type servers: list[(str, int, bool)]
+    :type disconnects: int
+    :type connect_attempts: int
+    :type connect_failures: int
+    :type tls_resumptions: int
     :type _connected: bool
     :type _ignore_cert_errors: bool
+    :type _send_queues: list[deque[bytes]]
+    :type _send_bucket: TokenBucket
+    :type lines_sent: int
+    :type lines_dropped: int
+    :type writes: int
     """
 
     def __init__(self, bot, name, nick, *, readable_name, channels=None, config=None,
-                 server, port=6667, use_ssl=False, ignore_cert_errors=True, timeout=300):
+                 server, port=6667, use_ssl=False, ignore_cert_errors=True, timeout=300, servers=None):
         """
         :type bot: cloudbot.bot.CloudBot
         :type name: str
@@ -48,18 +471,22 @@ class IrcClient(Client):
         :type use_ssl: bool
         :type ignore_cert_errors: bool
         :type timeout: int
+        :param servers: Other servers to fall back to, as (server, port, use_ssl)
+        :type servers: list[(str, int, bool)]
         """
         super().__init__(bot, name, nick, readable_name=readable_name, channels=channels, config=config)
 
-        self.use_ssl = use_ssl
         self._ignore_cert_errors = ignore_cert_errors
         self._timeout = timeout
-        self.server = server
-        self.port = port
 
-        # create SSL context
-        if self.use_ssl:
-            self.ssl_context = SSLContext(PROTOCOL_SSLv23)
+        # the servers we can connect to, and the one we're using now
+        self.servers = [(server, port, use_ssl)] + list(servers or [])
+        self._server_index = 0
+        self.server, self.port, self.use_ssl = self.servers[0]
+
+        # create SSL context, which is kept across reconnects so TLS sessions can be resumed
+        if any(server_ssl for _, _, server_ssl in self.servers):
+            self.ssl_context = _ResumingSSLContext(PROTOCOL_SSLv23)
             if self._ignore_cert_errors:
                 self.ssl_context.verify_mode = ssl.CERT_NONE
             else:
@@ -76,6 +503,98 @@ class IrcClient(Client):
         self._transport = None
         self._protocol = None
 
+        # reconnect policy
+        reconnect = self.config.get("reconnect", {})
+        self._reconnect_min_delay = reconnect.get("min_delay", 5)
+        self._reconnect_max_delay = reconnect.get("max_delay", 300)
+        self._reconnect_jitter = reconnect.get("jitter", 0.5)
+        # failed attempts since we were last registered, which decides how long to wait before the next one
+        self._failures = 0
+        self._reconnect_task = None
+        self._registered = False
+
+        # connection statistics
+        self.disconnects = 0
+        self.connect_attempts = 0
+        self.connect_failures = 0
+        self.tls_resumptions = 0
+        # when we were last disconnected, or None if we're connected, and the total time spent disconnected before that
+        self._disconnected_since = None
+        self._disconnected_time = 0
+
+        # outgoing lines, written by _writer() as fast as flood control allows
+        flood_control = self.config.get("flood_control", {})
+        self._flood_control = flood_control.get("enabled", True)
+        self._send_bucket = TokenBucket(flood_control.get("burst", 10), flood_control.get("rate", 2))
+        self._max_send_queue = flood_control.get("max_queue", 1000)
+        self._send_queues = [deque() for _ in Priority]
+        self._send_ready = asyncio.Event(loop=self.loop)
+        self._writer_task = None
+        # id(queued line) -> (trace, time sent, priority), for lines sent while tracing an event
+        self._traced_lines = {}
+
+        # outgoing statistics
+        self.lines_sent = 0
+        self.lines_dropped = 0
+        self.writes = 0
+
+        # incoming events, processed by a fixed number of workers. When more than high_water events are waiting, or
+        # running hooks, we stop reading from the socket, and start again once that's come down to low_water.
+        dispatch = self.config.get("dispatch", {})
+        self._dispatch_workers = dispatch.get("workers", 16)
+        self._dispatch_high_water = dispatch.get("high_water", 500)
+        self._dispatch_low_water = dispatch.get("low_water", 100)
+        self._dispatch_queue = asyncio.Queue(loop=self.loop)
+        self._dispatch_tasks = []
+        # tasks running hooks for events from this connection, apart from hooks with timeout=0 (which might never end)
+        self._hook_tasks = set()
+        self._reading_paused = False
+
+        # incoming statistics
+        self.lines_received = 0
+        self.events_dispatched = 0
+        # lines no hook wanted, which were never made into events
+        self.events_skipped = 0
+        self.dispatch_queue_peak = 0
+        self.read_pauses = 0
+        self._paused_since = None
+        self._paused_time = 0
+        self._dispatch_seconds = bot.metrics.histogram("cloudbot_dispatch_seconds",
+                                                       "How long incoming events took to process",
+                                                       ("connection",))
+
+        # IRCv3 capabilities, cap -> value (or None) for caps the server supports, and the set of caps we've enabled
+        self.server_caps = {}
+        self.enabled_caps = set()
+        self.sasl_authenticated = False
+        self._cap_negotiating = False
+
+        # our user@host, as seen by the server, which is needed to work out how much text fits on a line
+        self.userhost = None
+        # long messages are split into at most this many lines, with the rest available through .more
+        self.max_message_lines = self.config.get("max_message_lines", 3)
+        # the remaining lines of long messages, target.lower() -> (command, template, lines), least recently used first.
+        # Only the last max_more_buffers targets are kept, and they're forgotten when we disconnect.
+        self._more_buffers = OrderedDict()
+        self._max_more_buffers = self.config.get("max_more_buffers", 100)
+
+        # what the server has told us it supports in RPL_ISUPPORT (005), token -> value (or None)
+        self.isupport = {}
+        # channel modes which take parameters, split into the four CHANMODES types
+        self._chanmodes = default_chanmodes
+        # names from RPL_NAMREPLY (353) which we're collecting until RPL_ENDOFNAMES (366), folded channel -> names
+        self._pending_names = {}
+
+    @property
+    def disconnected_time(self):
+        """
+        The total number of seconds this client has spent disconnected since it first connected, including now
+        :rtype: float
+        """
+        if self._disconnected_since is None:
+            return self._disconnected_time
+        return self._disconnected_time + time.time() - self._disconnected_since
+
     def describe_server(self):
         if self.use_ssl:
             return "+{}:{}".format(self.server, self.port)
@@ -100,8 +619,59 @@ class IrcClient(Client):
             self._connected = True
             logger.info("[{}] Connecting".format(self.readable_name))
 
-        self._transport, self._protocol = yield from self.loop.create_connection(
-            lambda: _IrcProtocol(self), host=self.server, port=self.port, ssl=self.ssl_context)
+        if self._reconnect_task is not None:
+            # we're reconnecting now, so we don't need to later
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+
+        if self.queue_depth:
+            # these were meant for the last connection, and we haven't registered on the new one yet
+            logger.info("[{}] Discarding {} lines queued before reconnecting".format(self.readable_name,
+                                                                                     self.queue_depth))
+            self.lines_dropped += self.queue_depth
+            for queue in self._send_queues:
+                queue.clear()
+            self._traced_lines.clear()
+
+        self._start_tasks()
+
+        while True:
+            self.connect_attempts += 1
+            try:
+                self._transport, self._protocol = yield from self.loop.create_connection(
+                    lambda: _IrcProtocol(self), host=self.server, port=self.port,
+                    ssl=self.ssl_context if self.use_ssl else None)
+            except OSError as e:
+                # including ssl.SSLError and socket.gaierror
+                self.connect_failures += 1
+                self._failures += 1
+                logger.warning("[{}] Couldn't connect to {}: {}".format(self.readable_name, self.describe_server(), e))
+                self._next_server()
+                delay = self._reconnect_delay()
+                logger.info("[{}] Trying {} in {:.1f} seconds".format(self.readable_name, self.describe_server(), delay))
+                yield from asyncio.sleep(delay, loop=self.loop)
+                if self._quit:
+                    return
+            else:
+                break
+
+        if self._disconnected_since is not None:
+            self._disconnected_time += time.time() - self._disconnected_since
+            self._disconnected_since = None
+        self._registered = False
+        # the new connection starts off reading, even if the last one was paused
+        self._set_reading_paused(False)
+
+        # we don't know anything about the new connection yet
+        self.tracker.clear()
+        self._pending_names = {}
+
+        # start capability negotiation, which will hold off registration until we send CAP END
+        self.server_caps = {}
+        self.enabled_caps = set()
+        self.sasl_authenticated = False
+        self._cap_negotiating = True
+        self.send("CAP LS 302")
 
         # send the password, nick, and user
         self.set_pass(self.config["connection"].get("password"))
@@ -109,6 +679,72 @@ class IrcClient(Client):
         self.cmd("USER", self.config.get('user', 'cloudbot'), "3", "*",
                  self.config.get('realname', 'CloudBotRefresh - http://cloudbot.pw'))
 
+    def _start_tasks(self):
+        """
+        Starts the writer and the dispatch workers, if they aren't already running
+        """
+        if self._writer_task is None:
+            self._writer_task = asyncio.async(self._writer(), loop=self.loop)
+        if not self._dispatch_tasks:
+            self._dispatch_tasks = [asyncio.async(self._dispatch_worker(), loop=self.loop)
+                                    for _ in range(self._dispatch_workers)]
+
+    def _next_server(self):
+        """
+        Moves on to the next server in the server list
+        """
+        self._server_index = (self._server_index + 1) % len(self.servers)
+        self.server, self.port, self.use_ssl = self.servers[self._server_index]
+
+    def _reconnect_delay(self):
+        """
+        Works out how long to wait before the next connection attempt, doubling with each failure up to max_delay.
+        Each delay is randomly shortened by up to jitter (a fraction), so clients don't all reconnect at once.
+        :rtype: float
+        """
+        delay = min(self._reconnect_max_delay, self._reconnect_min_delay * 2 ** min(self._failures, 16))
+        return delay * (1 - random.random() * self._reconnect_jitter)
+
+    def _connection_lost(self):
+        """
+        Called by the protocol when the connection is lost without us closing it, schedules a reconnect
+        """
+        if self._quit or (self._reconnect_task is not None and not self._reconnect_task.done()):
+            return
+        self.disconnects += 1
+        self._more_buffers.clear()
+        if self._disconnected_since is None:
+            self._disconnected_since = time.time()
+        if not self._registered:
+            # we were dropped before registering, so treat this server like one we couldn't connect to
+            self.connect_failures += 1
+            self._failures += 1
+            self._next_server()
+        self._reconnect_task = asyncio.async(self._reconnect(), loop=self.loop)
+
+    @asyncio.coroutine
+    def _reconnect(self):
+        delay = self._reconnect_delay()
+        logger.info("[{}] Reconnecting to {} in {:.1f} seconds".format(self.readable_name, self.describe_server(),
+                                                                       delay))
+        yield from asyncio.sleep(delay, loop=self.loop)
+        self._reconnect_task = None
+        yield from self.connect()
+
+    def _on_registered(self):
+        """
+        Called when the server has accepted our registration, which means this server is working
+        """
+        self._registered = True
+        self._failures = 0
+        if self.use_ssl and isinstance(self.ssl_context, _ResumingSSLContext):
+            ssl_object = self._transport.get_extra_info("ssl_object")
+            if ssl_object is not None and getattr(ssl_object, "session", None) is not None:
+                # by now the server will have sent any TLS 1.3 session tickets
+                self.ssl_context.sessions[self.server] = ssl_object.session
+                if ssl_object.session_reused:
+                    self.tls_resumptions += 1
+
     def quit(self, reason=None):
         if self._quit:
             return
@@ -121,80 +757,703 @@ class IrcClient(Client):
     def close(self):
         if not self._quit:
             self.quit()
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        self._more_buffers.clear()
         if not self._connected:
             return
 
+        if self.queue_depth and self._protocol is not None and self._protocol.connected:
+            # flush anything left (including the QUIT) past flood control, since we're leaving anyways
+            for queue in self._send_queues:
+                self._protocol.write(b"".join(queue))
+                self.lines_sent += len(queue)
+                queue.clear()
+            self._traced_lines.clear()
+
         self._transport.close()
         self._connected = False
 
-    def message(self, target, text):
-        self.cmd("PRIVMSG", target, text)
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        for task in self._dispatch_tasks:
+            task.cancel()
+        self._dispatch_tasks = []
 
-    def action(self, target, text):
-        self.ctcp(target, "ACTION", text)
+    def message(self, target, text, priority=Priority.interactive):
+        self._send_text("PRIVMSG", target, text, priority)
 
-    def notice(self, target, text):
-        self.cmd("NOTICE", target, text)
+    def action(self, target, text, priority=Priority.interactive):
+        self._send_text("PRIVMSG", target, text, priority, ctcp_type="ACTION")
+
+    def notice(self, target, text, priority=Priority.interactive):
+        self._send_text("NOTICE", target, text, priority)
+
+    def max_text_bytes(self, command, target):
+        """
+        Gets the number of bytes of text which will fit in a <command> to <target>, once the server has added our
+        hostmask to the front of it when relaying.
+        :type command: str
+        :type target: str
+        :rtype: int
+        """
+        # :nick!user@host COMMAND target :text
+        overhead = ":{}!{} {} {} :".format(self.nick, self.userhost or assumed_userhost, command, target)
+        return max_line_bytes - len(overhead.encode("utf-8"))
+
+    def _send_text(self, command, target, text, priority, ctcp_type=None):
+        """
+        Sends <text> to <target> as one or more <command>s, splitting it to fit, and keeping anything past
+        max_message_lines for the .more command.
+        :type command: str
+        :type target: str
+        :type text: str
+        :type priority: Priority
+        :type ctcp_type: str
+        """
+        if ctcp_type is None:
+            template = "{}"
+        else:
+            template = "\x01" + ctcp_type + " {}\x01"
+        max_bytes = self.max_text_bytes(command, target) - len(template.format("").encode("utf-8"))
+
+        lines = split_message(text, max_bytes)
+        if len(lines) > self.max_message_lines:
+            # leave room for the " (+N more, .more)" marker on the last line of each page
+            marker = self._more_marker(len(lines))
+            lines = split_message(text, max_bytes - len(marker.encode("utf-8")))
+        elif not lines:
+            # keep the old behaviour of sending empty messages as-is
+            lines = [""]
+
+        self._send_page(command, target, template, lines, priority)
+
+    def send_more(self, target, priority=Priority.interactive):
+        """
+        Sends the next page of the last long message that was cut short when sent to <target>.
+
+        Returns False if there was nothing more to send.
+        :type target: str
+        :type priority: Priority
+        :rtype: bool
+        """
+        more = self._more_buffers.pop(target.lower(), None)
+        if more is None:
+            return False
+        command, template, lines = more
+        self._send_page(command, target, template, lines, priority)
+        return True
+
+    def _more_marker(self, count):
+        """
+        :type count: int
+        :rtype: str
+        """
+        return " (+{} more, {}more)".format(count, self.config.get("command_prefix", "."))
+
+    def _send_page(self, command, target, template, lines, priority):
+        """
+        Sends the first max_message_lines of <lines>, and stores the rest for send_more()
+        :type command: str
+        :type target: str
+        :type template: str
+        :type lines: list[str]
+        :type priority: Priority
+        """
+        if len(lines) > self.max_message_lines:
+            remaining = lines[self.max_message_lines:]
+            lines = lines[:self.max_message_lines]
+            lines[-1] += self._more_marker(len(remaining))
+            key = target.lower()
+            self._more_buffers[key] = (command, template, remaining)
+            self._more_buffers.move_to_end(key)
+            while len(self._more_buffers) > self._max_more_buffers:
+                self._more_buffers.popitem(last=False)
+
+        for line in lines:
+            self.cmd(command, target, template.format(line), priority=priority)
 
     def set_nick(self, nick):
         self.cmd("NICK", nick)
 
     def join(self, channel):
         self.send("JOIN {}".format(channel))
-        if channel not in self.channels:
-            self.channels.append(channel)
+        self.channels.append(channel)
 
     def part(self, channel):
         self.cmd("PART", channel)
-        if channel in self.channels:
-            self.channels.remove(channel)
+        self.channels.discard(channel)
 
     def set_pass(self, password):
         if not password:
             return
         self.cmd("PASS", password)
 
-    def ctcp(self, target, ctcp_type, text):
+    def ctcp(self, target, ctcp_type, text, priority=Priority.interactive):
         """
         Makes the bot send a PRIVMSG CTCP of type <ctcp_type> to the target
         :type ctcp_type: str
         :type text: str
         :type target: str
+        :type priority: Priority
         """
-        out = "\x01{} {}\x01".format(ctcp_type, text)
-        self.cmd("PRIVMSG", target, out)
+        self._send_text("PRIVMSG", target, text, priority, ctcp_type=ctcp_type)
 
-    def cmd(self, command, *params):
+    def cmd(self, command, *params, priority=None):
         """
         Sends a raw IRC command of type <command> with params <params>
         :param command: The IRC command to send
         :param params: The params to the IRC command
+        :param priority: The priority to send this command with, see send()
         :type command: str
         :type params: (str)
+        :type priority: Priority
         """
         params = list(params)  # turn the tuple of parameters into a list
         if params:
             params[-1] = ':' + params[-1]
-            self.send("{} {}".format(command, ' '.join(params)))
+            self.send("{} {}".format(command, ' '.join(params)), priority=priority)
         else:
-            self.send(command)
+            self.send(command, priority=priority)
 
-    def send(self, line):
+    def send(self, line, priority=None):
         """
-        Sends a raw IRC line
+        Sends a raw IRC line.
+
+        Lines are sent in order of priority, then in the order they were sent. If no priority is given, connection
+        registration and keep-alive commands are sent as Priority.critical, and everything else as
+        Priority.interactive.
         :type line: str
+        :type priority: Priority
         """
         if not self._connected:
             raise ValueError("Client must be connected to irc server to use send")
-        self.loop.call_soon_threadsafe(self._send, line)
+        if priority is None:
+            if line.split(" ", 1)[0].upper() in critical_commands:
+                priority = Priority.critical
+            else:
+                priority = Priority.interactive
+        trace = current_trace()
+        if trace is None:
+            self.loop.call_soon_threadsafe(self._send, line, priority)
+        else:
+            self.loop.call_soon_threadsafe(self._send, line, priority, None, trace, now())
 
-    def _send(self, line):
+    def _send(self, line, priority, log_line=None, trace=None, sent=None):
         """
-        Sends a raw IRC line unchecked. Doesn't do connected check, and is *not* threadsafe
+        Queues a raw IRC line unchecked. Doesn't do connected check, and is *not* threadsafe
+        :param log_line: What to log instead of the line, if the line contains something secret
+        :param trace: The trace of the event this line is a reply to, if it's being traced
+        :param sent: When send() was called, from tracing.now(), if the line is being traced
         :type line: str
+        :type priority: Priority
+        :type log_line: str
+        :type trace: cloudbot.util.tracing.Trace
+        :type sent: float
+        """
+        if log_line is None:
+            log_line = line
+        if priority is not Priority.critical and self.queue_depth >= self._max_send_queue:
+            self.lines_dropped += 1
+            logger.warning("[{}] Output queue full, dropping >> {}".format(self.readable_name, log_line))
+            return
+        logger.info("[{}] >> {}".format(self.readable_name, log_line))
+        data = encode_line(line)
+        if trace is not None:
+            # the queues hold bytes, so traced lines are looked up by the identity of theirs when they're written
+            self._traced_lines[id(data)] = (trace, sent, priority)
+        self._send_queues[priority].append(data)
+        self._send_ready.set()
+
+    def _line_cost(self, data):
+        """
+        Gets the flood control cost of sending the given line. Like most ircds, longer lines are penalised more.
+        :type data: bytes
+        :rtype: float
+        """
+        return min(1 + len(data) / 512, self._send_bucket.capacity)
+
+    def _next_queue(self):
+        """
+        Gets the highest priority queue with lines waiting in it, or None if all queues are empty
+        :rtype: deque[bytes]
+        """
+        for queue in self._send_queues:
+            if queue:
+                return queue
+        return None
+
+    @asyncio.coroutine
+    def _writer(self):
+        """
+        Drains the output queues, writing as many lines as flood control allows in a single write.
+
+        Critical lines (PONG, NICK, QUIT, ...) skip flood control entirely. Other lines are taken strictly in order of
+        priority, so while bulk output is being paced, an interactive reply only ever waits for the bucket to refill,
+        never behind the bulk lines queued before it.
+        """
+        critical_queue = self._send_queues[Priority.critical]
+        while True:
+            queue = self._next_queue()
+            if queue is None or self._protocol is None or not self._protocol.connected:
+                # wait until there's something to send, and somewhere to send it
+                self._send_ready.clear()
+                yield from self._send_ready.wait()
+                continue
+
+            if queue is critical_queue or not self._flood_control:
+                batch = list(queue)
+                queue.clear()
+            else:
+                delay = self._send_bucket.time_until(self._line_cost(queue[0]))
+                if delay > 0:
+                    # wait for the bucket to refill, but wake up early if a higher priority line is queued
+                    self._send_ready.clear()
+                    try:
+                        yield from asyncio.wait_for(self._send_ready.wait(), delay, loop=self.loop)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                batch = []
+                while queue is not None and queue is not critical_queue \
+                        and self._send_bucket.consume(self._line_cost(queue[0])):
+                    batch.append(queue.popleft())
+                    queue = self._next_queue()
+
+            self._protocol.write(b"".join(batch))
+            self.lines_sent += len(batch)
+            self.writes += 1
+            if self._traced_lines:
+                self._finish_traces(batch)
+
+    def _finish_traces(self, batch):
+        """
+        Records the time the traced lines in <batch> spent between IrcClient.send and being written
+        :type batch: list[bytes]
+        """
+        written = now()
+        for data in batch:
+            traced = self._traced_lines.pop(id(data), None)
+            if traced is not None:
+                trace, sent, priority = traced
+                trace.add("IrcClient.send", sent, written, priority=priority.name)
+
+    def _finish_line_trace(self, trace, event, future=None):
+        """
+        Records the time a traced line took, from being received to its hooks finishing
+        :type trace: cloudbot.util.tracing.Trace
+        :type event: cloudbot.event.Event
+        """
+        trace.add("line", trace.start, now(), connection=self.name, line=event.irc_raw)
+
+    def _queue_event(self, event):
+        """
+        Queues an incoming event to be processed by the bot, pausing reading if too many are waiting
+        :type event: cloudbot.event.Event
+        """
+        self._dispatch_queue.put_nowait(event)
+        depth = self._dispatch_queue.qsize()
+        if depth > self.dispatch_queue_peak:
+            self.dispatch_queue_peak = depth
+        self._check_backlog()
+
+    def _check_backlog(self):
+        """
+        Pauses reading if too many events are waiting to be processed or have hooks running, or resumes it once there
+        are few enough
+        """
+        backlog = self.backlog
+        if not self._reading_paused and backlog >= self._dispatch_high_water:
+            logger.warning("[{}] {} events waiting to be processed and hooks running, pausing reading".format(
+                self.readable_name, backlog))
+            self._set_reading_paused(True)
+        elif self._reading_paused and backlog <= self._dispatch_low_water:
+            logger.info("[{}] Resuming reading".format(self.readable_name))
+            self._set_reading_paused(False)
+
+    def _hook_finished(self, task):
+        """
+        :type task: asyncio.Task
+        """
+        self._hook_tasks.discard(task)
+        self._check_backlog()
+
+    def _set_reading_paused(self, paused):
+        """
+        :type paused: bool
+        """
+        if paused == self._reading_paused:
+            return
+        self._reading_paused = paused
+        if paused:
+            self.read_pauses += 1
+            self._paused_since = time.time()
+            if self._protocol is not None:
+                self._protocol.pause_reading()
+        else:
+            if self._paused_since is not None:
+                self._paused_time += time.time() - self._paused_since
+                self._paused_since = None
+            if self._protocol is not None:
+                self._protocol.resume_reading()
+
+    @asyncio.coroutine
+    def _dispatch_worker(self):
+        """
+        Processes queued events one at a time. Hooks are started in tasks of their own, so a worker only waits for an
+        event's sieves before taking the next one, and a slow (or never-ending) hook can't hold it up.
+        """
+        while True:
+            event = yield from self._dispatch_queue.get()
+            trace = event.trace
+            if trace is not None:
+                trace.add("dispatch queue", trace.start, now())
+            start = time.perf_counter()
+            started = []
+            try:
+                with span(trace, "CloudBot.process"):
+                    started = yield from self.bot.process(event)
+            except Exception:
+                logger.exception("[{}] Error processing {}".format(self.readable_name, event.irc_raw))
+            self._dispatch_seconds.observe(time.perf_counter() - start, self.name)
+            tasks = []
+            for hook, task in started:
+                tasks.append(task)
+                if hook.timeout != 0:
+                    # counted towards the backlog until it finishes, so slow hooks pause reading too
+                    self._hook_tasks.add(task)
+                    task.add_done_callback(self._hook_finished)
+            if trace is not None:
+                if tasks:
+                    asyncio.gather(*tasks, loop=self.loop).add_done_callback(
+                        functools.partial(self._finish_line_trace, trace, event))
+                else:
+                    self._finish_line_trace(trace, event)
+            self.events_dispatched += 1
+            self._dispatch_queue.task_done()
+            self._check_backlog()
+
+    @asyncio.coroutine
+    def wait_for_dispatch(self):
+        """
+        Waits until every event received so far has been processed, and the hooks it started have finished (apart from
+        ones with timeout=0, which might never finish)
+        """
+        yield from self._dispatch_queue.join()
+        while self._hook_tasks:
+            yield from asyncio.wait(list(self._hook_tasks), loop=self.loop)
+
+    @property
+    def hooks_running(self):
+        """
+        The number of hooks running for events from this connection, not counting ones with timeout=0
+        :rtype: int
+        """
+        return len(self._hook_tasks)
+
+    @property
+    def backlog(self):
+        """
+        The number of incoming events waiting to be processed, plus the number of hooks running for them
+        :rtype: int
+        """
+        return self._dispatch_queue.qsize() + len(self._hook_tasks)
+
+    @property
+    def dispatch_queue_depth(self):
+        """
+        The number of incoming events waiting to be processed
+        :rtype: int
+        """
+        return self._dispatch_queue.qsize()
+
+    @property
+    def reading_paused_time(self):
+        """
+        The total number of seconds reading from the server has been paused for, because of a full dispatch queue
+        :rtype: float
+        """
+        if self._paused_since is None:
+            return self._paused_time
+        return self._paused_time + time.time() - self._paused_since
+
+    def _wanted_caps(self):
+        """
+        Gets the capabilities we want to enable, in the order we want them
+        :rtype: list[str]
+        """
+        caps = list(self.config.get("caps", default_caps))
+        if self._sasl_config() is not None:
+            caps.append("sasl")
+        return caps
+
+    def _sasl_config(self):
+        """
+        Gets the SASL configuration for this connection, or None if SASL shouldn't be used
+        :rtype: dict
+        """
+        sasl = self.config.get("sasl")
+        if not sasl or not sasl.get("enabled", True) or not sasl.get("password"):
+            return None
+        return sasl
+
+    def _on_cap(self, message):
+        """
+        Handles a CAP reply from the server, continuing capability negotiation
+        :type message: IrcMessage
+        """
+        paramlist = message.paramlist
+        if len(paramlist) < 3:
+            return
+        subcommand = paramlist[1].upper()
+        caps = paramlist[-1][1:] if paramlist[-1].startswith(":") else paramlist[-1]
+
+        if subcommand in ("LS", "NEW"):
+            for cap in caps.split():
+                name, _, value = cap.partition("=")
+                self.server_caps[name] = value or None
+            if subcommand == "LS" and len(paramlist) > 3 and paramlist[2] == "*":
+                # this is a multi-line reply, wait until we have all of it
+                return
+            wanted = [cap for cap in self._wanted_caps() if cap in self.server_caps and cap not in self.enabled_caps]
+            if wanted:
+                self._send("CAP REQ :{}".format(" ".join(wanted)), Priority.critical)
+            else:
+                self._end_cap()
+        elif subcommand == "ACK":
+            for cap in caps.split():
+                if cap.startswith("-"):
+                    self.enabled_caps.discard(cap[1:])
+                else:
+                    self.enabled_caps.add(cap)
+            logger.info("[{}] Enabled capabilities: {}".format(self.readable_name, " ".join(sorted(self.enabled_caps))))
+            if "sasl" in caps.split() and not self.sasl_authenticated:
+                self._send("AUTHENTICATE PLAIN", Priority.critical)
+            else:
+                self._end_cap()
+        elif subcommand == "NAK":
+            logger.warning("[{}] Server refused capabilities: {}".format(self.readable_name, caps))
+            self._end_cap()
+        elif subcommand == "DEL":
+            for cap in caps.split():
+                self.enabled_caps.discard(cap)
+                self.server_caps.pop(cap, None)
+
+    def _on_authenticate(self, message):
+        """
+        Handles an AUTHENTICATE challenge from the server, sending our SASL PLAIN credentials
+        :type message: IrcMessage
+        """
+        if message.paramlist[0] != "+":
+            return
+        sasl = self._sasl_config()
+        if sasl is None:
+            self._send("AUTHENTICATE *", Priority.critical)
+            return
+        user = sasl.get("user") or self.nick
+        payload = "{0}\0{0}\0{1}".format(user, sasl["password"]).encode("utf-8")
+        encoded = base64.b64encode(payload).decode("ascii")
+        # the response is sent in chunks of 400 bytes, with a "+" to finish if the last chunk was exactly 400 bytes
+        for i in range(0, len(encoded), 400):
+            self._send("AUTHENTICATE " + encoded[i:i + 400], Priority.critical, log_line="AUTHENTICATE <hidden>")
+        if len(encoded) % 400 == 0:
+            self._send("AUTHENTICATE +", Priority.critical)
+
+    def _on_sasl_done(self, message):
+        """
+        Handles the result of SASL authentication, ending capability negotiation either way
+        :type message: IrcMessage
+        """
+        if message.command == "903":
+            logger.info("[{}] Authenticated using SASL".format(self.readable_name))
+            self.sasl_authenticated = True
+        else:
+            logger.warning("[{}] SASL authentication failed: {}".format(self.readable_name, message.content))
+        self._end_cap()
+
+    def _end_cap(self):
+        """
+        Ends capability negotiation, letting the server finish registering us, if we haven't already
+        """
+        if self._cap_negotiating:
+            self._cap_negotiating = False
+            self._send("CAP END", Priority.critical)
+
+    def _track(self, message):
+        """
+        Updates the state tracker from a message, if it's one which changes channel or user state
+        :type message: IrcMessage
+        """
+        handler = state_handlers.get(message.command)
+        if handler is not None and message.netmask_prefix is not None and message.paramlist:
+            getattr(self, handler)(message)
+
+    def _is_self(self, nick):
+        """
+        :type nick: str
+        :rtype: bool
+        """
+        return self.tracker.casefold(nick) == self.tracker.casefold(self.nick)
+
+    def _track_join(self, message):
+        """
+        :type message: IrcMessage
+        """
+        paramlist = message.paramlist
+        user = self.tracker.join(_trailing(paramlist[0]), message.nick, message.user, message.host,
+                                 is_self=self._is_self(message.nick))
+        if user is not None and len(paramlist) >= 3:
+            # extended-join, which tells us the user's account and real name
+            user.account = None if paramlist[1] == "*" else paramlist[1]
+            user.realname = _trailing(paramlist[2])
+
+    def _track_part(self, message):
+        """
+        :type message: IrcMessage
+        """
+        self.tracker.part(_trailing(message.paramlist[0]), message.nick, is_self=self._is_self(message.nick))
+
+    def _track_kick(self, message):
+        """
+        :type message: IrcMessage
+        """
+        paramlist = message.paramlist
+        if len(paramlist) >= 2:
+            nick = _trailing(paramlist[1])
+            self.tracker.part(paramlist[0], nick, is_self=self._is_self(nick))
+
+    def _track_quit(self, message):
+        """
+        :type message: IrcMessage
+        """
+        self.tracker.quit(message.nick)
+
+    def _track_nick(self, message):
+        """
+        :type message: IrcMessage
+        """
+        new_nick = _trailing(message.paramlist[0])
+        if self._is_self(message.nick):
+            # follow our own nick changes straight away, so the lines after this are attributed correctly
+            self.nick = new_nick
+        self.tracker.rename(message.nick, new_nick)
+
+    def _track_mode(self, message):
+        """
+        :type message: IrcMessage
+        """
+        paramlist = message.paramlist
+        if len(paramlist) < 2 or self.tracker.get_channel(paramlist[0]) is None:
+            # a user mode, or a channel we aren't tracking
+            return
+        channel = paramlist[0]
+        args = [_trailing(arg) for arg in paramlist[2:]]
+        list_modes, always_modes, set_modes, _ = self._chanmodes
+        prefix_modes = self.tracker.prefix_modes
+        adding = True
+        for mode in _trailing(paramlist[1]):
+            if mode == "+":
+                adding = True
+            elif mode == "-":
+                adding = False
+            elif mode in prefix_modes:
+                if args:
+                    self.tracker.set_mode(channel, args.pop(0), mode, adding)
+            elif mode in list_modes or mode in always_modes or (adding and mode in set_modes):
+                # this mode takes a parameter we don't need
+                if args:
+                    args.pop(0)
+
+    def _track_away(self, message):
+        """
+        :type message: IrcMessage
+        """
+        user = self.tracker.get_user(message.nick)
+        if user is not None:
+            user.away = bool(message.paramlist)
+
+    def _track_message(self, message):
+        """
+        :type message: IrcMessage
+        """
+        if not self.tracker.history_size:
+            return
+        channel = self.tracker.get_channel(message.paramlist[0])
+        if channel is None or not channel.tracked:
+            return
+        user = self.tracker.update_user(message.nick, message.user, message.host)
+        if user is not None:
+            channel.track_message(user, message.content)
+
+    def _track_isupport(self, message):
+        """
+        :type message: IrcMessage
+        """
+        for token in message.paramlist[1:-1]:
+            if token.startswith("-"):
+                self.isupport.pop(token[1:], None)
+                continue
+            key, _, value = token.partition("=")
+            self.isupport[key] = value or None
+            if key == "CASEMAPPING" and value:
+                self.tracker.set_casemapping(value)
+                self.channels.rekey(self.tracker.casefold)
+            elif key == "PREFIX" and value and value.startswith("(") and ")" in value:
+                modes, symbols = value[1:].split(")", 1)
+                self.tracker.set_prefixes(modes, symbols)
+            elif key == "CHANMODES" and value:
+                self._chanmodes = (value.split(",") + ["", "", "", ""])[:4]
+
+    def _track_who(self, message):
+        """
+        :type message: IrcMessage
+        """
+        paramlist = message.paramlist
+        if len(paramlist) < 8:
+            return
+        # the last param is "<hopcount> <real name>"
+        realname = _trailing(paramlist[7]).partition(" ")[2]
+        self.tracker.who(paramlist[1], paramlist[5], paramlist[2], paramlist[3], paramlist[6], realname)
+
+    def _track_names(self, message):
+        """
+        :type message: IrcMessage
+        """
+        paramlist = message.paramlist
+        if len(paramlist) < 4:
+            return
+        key = self.tracker.casefold(paramlist[2])
+        self._pending_names.setdefault(key, []).extend(_trailing(paramlist[3]).split())
+
+    def _track_end_of_names(self, message):
+        """
+        :type message: IrcMessage
+        """
+        paramlist = message.paramlist
+        if len(paramlist) < 2:
+            return
+        names = self._pending_names.pop(self.tracker.casefold(paramlist[1]), None)
+        if names is not None:
+            self.tracker.names(paramlist[1], names)
+
+    @property
+    def queue_depth(self):
         """
-        logger.info("[{}] >> {}".format(self.readable_name, line))
-        asyncio.async(self._protocol.send(line), loop=self.loop)
+        The number of lines waiting to be sent
+        :rtype: int
+        """
+        return sum(len(queue) for queue in self._send_queues)
+
+    @property
+    def queue_depths(self):
+        """
+        The number of lines waiting to be sent in each priority
+        :rtype: dict[Priority, int]
+        """
+        return {priority: len(self._send_queues[priority]) for priority in Priority}
 
     @property
     def connected(self):
@@ -206,10 +1465,9 @@ class _IrcProtocol(asyncio.Protocol):
     :type loop: asyncio.events.AbstractEventLoop
     :type conn: IrcClient
     :type bot: cloudbot.bot.CloudBot
-    :type _input_buffer: bytes
+    :type _input_buffer: IrcLineBuffer
     :type _connected: bool
     :type _transport: asyncio.transports.Transport
-    :type _connected_future: asyncio.Future
     """
 
     def __init__(self, conn):
@@ -221,7 +1479,10 @@ class _IrcProtocol(asyncio.Protocol):
         self.conn = conn
 
         # input buffer
-        self._input_buffer = b""
+        self._input_buffer = IrcLineBuffer()
+
+        # open IRCv3 batches, reference tag -> messages in the batch
+        self._batches = {}
 
         # connected
         self._connected = False
@@ -229,149 +1490,124 @@ class _IrcProtocol(asyncio.Protocol):
         # transport
         self._transport = None
 
-        # Future that waits until we are connected
-        self._connected_future = asyncio.Future(loop=self.loop)
-
     def connection_made(self, transport):
         self._transport = transport
         self._connected = True
-        self._connected_future.set_result(None)
-        # we don't need the _connected_future, everything uses it will check _connected first.
-        del self._connected_future
+        # wake up the writer, in case lines were queued while we were connecting
+        self.conn._send_ready.set()
+
+    @property
+    def connected(self):
+        return self._connected
 
     def connection_lost(self, exc):
         self._connected = False
-        # create a new connected_future for when we are connected.
-        self._connected_future = asyncio.Future(loop=self.loop)
         if exc is None:
             # we've been closed intentionally, so don't reconnect
             return
-        logger.exception("[{}] Connection lost.".format(self.conn.readable_name))
-        asyncio.async(self.conn.connect(), loop=self.loop)
+        logger.error("[{}] Connection lost: {}".format(self.conn.readable_name, exc))
+        self.conn._connection_lost()
 
     def eof_received(self):
         self._connected = False
-        # create a new connected_future for when we are connected.
-        self._connected_future = asyncio.Future(loop=self.loop)
         logger.info("[{}] EOF received.".format(self.conn.readable_name))
-        asyncio.async(self.conn.connect(), loop=self.loop)
+        self.conn._connection_lost()
         return True
 
-    @asyncio.coroutine
-    def send(self, line):
-        # make sure we are connected before sending
-        if not self._connected:
-            yield from self._connected_future
-        line = line.splitlines()[0][:500] + "\r\n"
-        data = line.encode("utf-8", "replace")
-        self._transport.write(data)
-
-    def data_received(self, data):
-        self._input_buffer += data
-
-        while b"\r\n" in self._input_buffer:
-            line_data, self._input_buffer = self._input_buffer.split(b"\r\n", 1)
-            line = line_data.decode()
-
-            # parse the line into a message
-            if line.startswith(":"):
-                prefix_line_match = irc_prefix_re.match(line)
-                if prefix_line_match is None:
-                    logger.critical("[{}] Received invalid IRC line '{}' from {}".format(
-                        self.conn.readable_name, line, self.conn.describe_server()))
-                    continue
+    def pause_reading(self):
+        if self._connected:
+            self._transport.pause_reading()
 
-                netmask_prefix, command, params = prefix_line_match.groups()
-                prefix = ":" + netmask_prefix  # TODO: Do we need to know this?
-                netmask_match = irc_netmask_re.match(netmask_prefix)
-                if netmask_match is None:
-                    # This isn't in the format of a netmask
-                    nick = netmask_prefix
-                    user = None
-                    host = None
-                    mask = netmask_prefix
-                else:
-                    nick = netmask_match.group(1)
-                    user = netmask_match.group(2)
-                    host = netmask_match.group(3)
-                    mask = netmask_prefix
-            else:
-                prefix = None
-                noprefix_line_match = irc_noprefix_re.match(line)
-                if noprefix_line_match is None:
-                    logger.critical("[{}] Received invalid IRC line '{}' from {}".format(
-                        self.conn.readable_name, line, self.conn.describe_server()))
-                    continue
-                command = noprefix_line_match.group(1)
-                params = noprefix_line_match.group(2)
-                nick = None
-                user = None
-                host = None
-                mask = None
+    def resume_reading(self):
+        if self._connected:
+            self._transport.resume_reading()
 
-            command_params = irc_param_re.findall(params)
+    def write(self, data):
+        """
+        Writes already encoded data straight to the transport
+        :type data: bytes
+        """
+        self._transport.write(data)
 
-            # Reply to pings immediately
+    def data_received(self, data):
+        for line in self._input_buffer.feed(data):
+            self._parse_line(line)
 
-            if command == "PING":
-                asyncio.async(self.send("PONG " + command_params[-1]), loop=self.loop)
+    def _parse_line(self, line):
+        """
+        Parses a single decoded IRC line, and dispatches it to the bot
+        :type line: str
+        """
+        self.conn.lines_received += 1
+        message = IrcMessage(self.conn, line)
+        if message.command is None:
+            logger.critical("[{}] Received invalid IRC line '{}' from {}".format(
+                self.conn.readable_name, line, self.conn.describe_server()))
+            return
 
-            # Parse the command and params
+        if message.tag_string is not None and self._batches:
+            batch = self._batches.get(message.tags.get("batch"))
+            if batch is not None:
+                # hold on to this until the end of the batch
+                batch.append(message)
+                return
 
-            # Content
-            if command_params and command_params[-1].startswith(":"):
-                # If the last param is in the format of `:content` remove the `:` from it, and set content from it
-                content = command_params[-1][1:]
-            else:
-                content = None
+        # Reply to pings immediately
+        if message.command == "PING":
+            self.conn._send("PONG " + message.paramlist[-1], Priority.critical)
+        elif message.command == "JOIN" and message.nick == self.conn.nick:
+            # the server tells us our real hostmask when we join, which we need to know how long messages can be
+            self.conn.userhost = "{}@{}".format(message.user, message.host)
+        elif message.command == "396":
+            # RPL_HOSTHIDDEN, our host has been changed (cloaked)
+            if self.conn.userhost is not None:
+                self.conn.userhost = "{}@{}".format(self.conn.userhost.split("@", 1)[0], message.paramlist[1])
 
-            # Event type
-            if command in irc_command_to_event_type:
-                event_type = irc_command_to_event_type[command]
-            else:
-                event_type = EventType.other
+        elif message.command == "001":
+            # we're registered, so capability negotiation is over, even if the server doesn't support it
+            self.conn._cap_negotiating = False
+            self.conn._on_registered()
+        elif message.command == "CAP":
+            self.conn._on_cap(message)
+        elif message.command == "AUTHENTICATE":
+            self.conn._on_authenticate(message)
+        elif message.command in sasl_done_numerics:
+            self.conn._on_sasl_done(message)
+        elif message.command == "BATCH":
+            reference = message.paramlist[0]
+            if reference.startswith("+"):
+                self._batches[reference[1:]] = []
+            elif reference.startswith("-"):
+                message.batch = self._batches.pop(reference[1:], [])
+                # hooks on BATCH see the whole batch at once, then each message is processed in order as usual
+                self._dispatch(message)
+                for batched_message in message.batch:
+                    self._dispatch(batched_message)
+                return
 
-            # Target (for KICK, INVITE)
-            if event_type is EventType.kick:
-                target = command_params[1]
-            elif command == "INVITE":
-                target = command_params[0]
-            else:
-                # TODO: Find more commands which give a target
-                target = None
-
-            # Parse for CTCP
-            if event_type is EventType.message and content.count("\x01") >= 2 and content.startswith("\x01"):
-                # Remove the first \x01, then rsplit to remove the last one, and ignore text after the last \x01
-                ctcp_text = content[1:].rsplit("\x01", 1)[0]
-                ctcp_text_split = ctcp_text.split(None, 1)
-                if ctcp_text_split[0] == "ACTION":
-                    # this is a CTCP ACTION, set event_type and content accordingly
-                    event_type = EventType.action
-                    content = ctcp_text_split[1]
-                else:
-                    # this shouldn't be considered a regular message
-                    event_type = EventType.other
-            else:
-                ctcp_text = None
+        self._dispatch(message)
 
-            # Channel
-            # TODO: Migrate plugins using chan for storage to use chan.lower() instead so we can pass the original case
-            if command_params and (len(command_params) > 2 or not command_params[0].startswith(":")):
+    def _dispatch(self, message):
+        """
+        Sends a message to the bot to be processed
+        :type message: IrcMessage
+        """
+        tracer = self.bot.tracer
+        start = now() if tracer is not None else None
+        self.conn._track(message)
 
-                if command_params[0].lower() == self.conn.nick.lower():
-                    # this is a private message - set the channel to the sender's nick
-                    channel = nick.lower()
-                else:
-                    channel = command_params[0].lower()
-            else:
-                channel = None
+        plan = self.bot.plugin_manager.dispatch_plan(self.conn, message.command, message.event_type)
+        if plan.empty:
+            # no hooks want this line, so don't bother with an event
+            self.conn.events_skipped += 1
+            return
 
-            # Set up parsed message
-            # TODO: Do we really want to send the raw `prefix` and `command_params` here?
-            event = Event(bot=self.bot, conn=self.conn, event_type=event_type, content=content, target=target,
-                          channel=channel, nick=nick, user=user, host=host, mask=mask, irc_raw=line, irc_prefix=prefix,
-                          irc_command=command, irc_paramlist=command_params, irc_ctcp_text=ctcp_text)
+        # Set up the event. Everything except the command is parsed lazily, when a hook first asks for it.
+        event = Event(bot=self.bot, conn=self.conn, irc_message=message)
+        if tracer is not None:
+            event.trace = tracer.start_trace(start)
+            if event.trace is not None:
+                event.trace.add("dispatch", start, now(), command=message.command)
 
-            # handle the message, async
-            asyncio.async(self.bot.process(event), loop=self.loop)
+        # queue the event for the client's dispatch workers
+        self.conn._queue_event(event)
@@ -71,6 +71,14 @@ class Config(dict):
             for connection in self.bot.connections:
                 connection.permissions.reload()
 
+        # dispatch plans, sieve verdicts and executors depend on the config, so work them out again (the plugin manager
+        # doesn't exist on first load)
+        if hasattr(self.bot, "plugin_manager"):
+            self.bot.plugin_manager.invalidate_dispatch_plans()
+            self.bot.plugin_manager.clear_sieve_cache()
+            # the config can be reloaded from the file watcher's thread, and executors belong to the event loop
+            self.bot.loop.call_soon_threadsafe(self.bot.plugin_manager.configure_executors)
+
     def save_config(self):
         """saves the contents of the config dict to the config file"""
         json.dump(self, open(self.path, 'w'), sort_keys=True, indent=4)
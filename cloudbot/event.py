@@ -3,6 +3,9 @@ import enum
 import logging
 import concurrent.futures
 
+from cloudbot.client import Priority
+from cloudbot.util.tracing import span
+
 logger = logging.getLogger("cloudbot")
 
 
@@ -18,6 +21,39 @@ class EventType(enum.Enum):
     other = 6
 
 
+class _MessageField:
+    """
+    An Event attribute which, unless explicitly assigned, is read from the event's lazily parsed irc_message.
+
+    Assigned values are stored in the event's _fields dict. Derived events share the dict with the event they're based
+    on, until either of them assigns a field, at which point that event gets its own copy.
+    """
+
+    def __init__(self, name, message_attribute):
+        """
+        :type name: str
+        :type message_attribute: str
+        """
+        self.name = name
+        self.message_attribute = message_attribute
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        fields = instance._fields
+        if self.name in fields:
+            return fields[self.name]
+        if instance.irc_message is None:
+            return None
+        return getattr(instance.irc_message, self.message_attribute)
+
+    def __set__(self, instance, value):
+        if instance._fields_shared:
+            instance._fields = instance._fields.copy()
+            instance._fields_shared = False
+        instance._fields[self.name] = value
+
+
 class Event:
     """
     :type bot: cloudbot.bot.CloudBot
@@ -38,11 +74,32 @@ class Event:
     :type irc_command: str
     :type irc_paramlist: str
     :type irc_ctcp_text: str
+    :type irc_tags: dict[str, str]
+    :type irc_batch: list[cloudbot.clients.irc.IrcMessage]
+    :type irc_message: cloudbot.clients.irc.IrcMessage
+    :type trace: cloudbot.util.tracing.Trace
     """
+    __slots__ = ("bot", "conn", "hook", "irc_message", "db", "db_executor", "trace", "_fields", "_fields_shared")
+
+    type = _MessageField("type", "event_type")
+    content = _MessageField("content", "content")
+    target = _MessageField("target", "target")
+    chan = _MessageField("chan", "channel")
+    nick = _MessageField("nick", "nick")
+    user = _MessageField("user", "user")
+    host = _MessageField("host", "host")
+    mask = _MessageField("mask", "mask")
+    irc_raw = _MessageField("irc_raw", "raw")
+    irc_prefix = _MessageField("irc_prefix", "prefix")
+    irc_command = _MessageField("irc_command", "command")
+    irc_paramlist = _MessageField("irc_paramlist", "paramlist")
+    irc_ctcp_text = _MessageField("irc_ctcp_text", "ctcp_text")
+    irc_tags = _MessageField("irc_tags", "tags")
+    irc_batch = _MessageField("irc_batch", "batch")
 
     def __init__(self, *, bot=None, hook=None, conn=None, base_event=None, event_type=EventType.other, content=None,
                  target=None, channel=None, nick=None, user=None, host=None, mask=None, irc_raw=None, irc_prefix=None,
-                 irc_command=None, irc_paramlist=None, irc_ctcp_text=None):
+                 irc_command=None, irc_paramlist=None, irc_ctcp_text=None, irc_message=None):
         """
         All of these parameters except for `bot` and `hook` are optional.
         The irc_* parameters should only be specified for IRC events.
@@ -68,6 +125,10 @@ class Event:
         :param irc_paramlist: The list of params for the IRC command. If the last param is a content param, the ':'
                                 should be removed from the front.
         :param irc_ctcp_text: CTCP text if this message is a CTCP command
+        :param irc_message: A lazily parsed IRC message. If this is specified, all of the event_type, content, target,
+                            channel, nick, user, host, mask and irc_* arguments are ignored, and read from the message
+                            when first accessed instead. This is also the only way to set irc_tags (the IRCv3 message
+                            tags) and irc_batch (for the end of an IRCv3 BATCH, all of the messages in the batch).
         :type bot: cloudbot.bot.CloudBot
         :type conn: cloudbot.client.Client
         :type hook: cloudbot.plugin.Hook
@@ -84,12 +145,17 @@ class Event:
         :type irc_command: str
         :type irc_paramlist: list[str]
         :type irc_ctcp_text: str
+        :type irc_message: cloudbot.clients.irc.IrcMessage
         """
+        self._fields = {}
+        self._fields_shared = False
         self.db = None
         self.db_executor = None
         self.bot = bot
         self.conn = conn
         self.hook = hook
+        # the trace this event is being traced in, if it's being traced
+        self.trace = None
         if base_event is not None:
             # We're copying an event, so inherit values
             if self.bot is None and base_event.bot is not None:
@@ -99,23 +165,18 @@ class Event:
             if self.hook is None and base_event.hook is not None:
                 self.hook = base_event.hook
 
-            # If base_event is provided, don't check these parameters, just inherit
-            self.type = base_event.type
-            self.content = base_event.content
-            self.target = base_event.target
-            self.chan = base_event.chan
-            self.nick = base_event.nick
-            self.user = base_event.user
-            self.host = base_event.host
-            self.mask = base_event.mask
-            # irc-specific parameters
-            self.irc_raw = base_event.irc_raw
-            self.irc_prefix = base_event.irc_prefix
-            self.irc_command = base_event.irc_command
-            self.irc_paramlist = base_event.irc_paramlist
-            self.irc_ctcp_text = base_event.irc_ctcp_text
+            # If base_event is provided, don't check these parameters, just inherit. Anything not parsed yet stays
+            # unparsed, and is shared with base_event through irc_message.
+            self.irc_message = base_event.irc_message
+            self.trace = base_event.trace
+            self._fields = base_event._fields
+            self._fields_shared = base_event._fields_shared = True
+        elif irc_message is not None:
+            # Everything else is parsed from the message when it is first accessed
+            self.irc_message = irc_message
         else:
             # Since base_event wasn't provided, we can take these parameters
+            self.irc_message = None
             self.type = event_type
             self.content = content
             self.target = target
@@ -131,6 +192,28 @@ class Event:
             self.irc_paramlist = irc_paramlist
             self.irc_ctcp_text = irc_ctcp_text
 
+    @classmethod
+    def view(cls, base_event, hook):
+        """
+        Creates an event for <hook> which shares everything else with <base_event>. This is what the Event constructor
+        does with a base_event, without the cost of going through all of its arguments, for creating an event for each
+        hook a line is passed to.
+        :type base_event: Event
+        :type hook: cloudbot.plugin.Hook
+        :rtype: Event
+        """
+        event = cls.__new__(cls)
+        event.bot = base_event.bot
+        event.conn = base_event.conn
+        event.hook = hook
+        event.irc_message = base_event.irc_message
+        event.db = None
+        event.db_executor = None
+        event.trace = base_event.trace
+        event._fields = base_event._fields
+        event._fields_shared = base_event._fields_shared = True
+        return event
+
     @asyncio.coroutine
     def prepare(self):
         """
@@ -224,49 +307,56 @@ class Event:
     def logger(self):
         return logger
 
-    def message(self, message, target=None):
+    def message(self, message, target=None, priority=Priority.interactive):
         """sends a message to a specific or current channel/user
         :type message: str
         :type target: str
+        :type priority: cloudbot.client.Priority
         """
         if target is None:
             if self.chan is None:
                 raise ValueError("Target must be specified when chan is not assigned")
             target = self.chan
-        self.conn.message(target, message)
+        with span(self.trace, "message", activate=True):
+            self.conn.message(target, message, priority=priority)
 
-    def reply(self, message, target=None):
+    def reply(self, message, target=None, priority=Priority.interactive):
         """sends a message to the current channel/user with a prefix
         :type message: str
         :type target: str
+        :type priority: cloudbot.client.Priority
         """
         if target is None:
             if self.chan is None:
                 raise ValueError("Target must be specified when chan is not assigned")
             target = self.chan
 
-        if target == self.nick:
-            self.conn.message(target, message)
-        else:
-            self.conn.message(target, "{}, {}".format(self.nick, message))
+        with span(self.trace, "reply", activate=True):
+            if target == self.nick:
+                self.conn.message(target, message, priority=priority)
+            else:
+                self.conn.message(target, "{}, {}".format(self.nick, message), priority=priority)
 
-    def action(self, message, target=None):
+    def action(self, message, target=None, priority=Priority.interactive):
         """sends an action to the current channel/user or a specific channel/user
         :type message: str
         :type target: str
+        :type priority: cloudbot.client.Priority
         """
         if target is None:
             if self.chan is None:
                 raise ValueError("Target must be specified when chan is not assigned")
             target = self.chan
 
-        self.conn.action(target, message)
+        with span(self.trace, "action", activate=True):
+            self.conn.action(target, message, priority=priority)
 
-    def ctcp(self, message, ctcp_type, target=None):
+    def ctcp(self, message, ctcp_type, target=None, priority=Priority.interactive):
         """sends an ctcp to the current channel/user or a specific channel/user
         :type message: str
         :type ctcp_type: str
         :type target: str
+        :type priority: cloudbot.client.Priority
         """
         if target is None:
             if self.chan is None:
@@ -274,20 +364,23 @@ class Event:
             target = self.chan
         if not hasattr(self.conn, "ctcp"):
             raise ValueError("CTCP can only be used on IRC connections")
-        # noinspection PyUnresolvedReferences
-        self.conn.ctcp(target, ctcp_type, message)
+        with span(self.trace, "ctcp", activate=True):
+            # noinspection PyUnresolvedReferences
+            self.conn.ctcp(target, ctcp_type, message, priority=priority)
 
-    def notice(self, message, target=None):
+    def notice(self, message, target=None, priority=Priority.interactive):
         """sends a notice to the current channel/user or a specific channel/user
         :type message: str
         :type target: str
+        :type priority: cloudbot.client.Priority
         """
         if target is None:
             if self.nick is None:
                 raise ValueError("Target must be specified when nick is not assigned")
             target = self.nick
 
-        self.conn.notice(target, message)
+        with span(self.trace, "notice", activate=True):
+            self.conn.notice(target, message, priority=priority)
 
     def has_permission(self, permission, notice=True):
         """ returns whether or not the current user has a given permission
@@ -317,6 +410,7 @@ class CommandEvent(Event):
     :type text: str
     :type triggered_command: str
     """
+    __slots__ = ("text", "triggered_command")
 
     def __init__(self, *, bot=None, hook, text, triggered_command, conn=None, base_event=None, event_type=None,
                  content=None, target=None, channel=None, nick=None, user=None, host=None, mask=None, irc_raw=None,
@@ -334,6 +428,20 @@ class CommandEvent(Event):
         self.text = text
         self.triggered_command = triggered_command
 
+    @classmethod
+    def view(cls, base_event, hook, text=None, triggered_command=None):
+        """
+        :type base_event: Event
+        :type hook: cloudbot.plugin.CommandHook
+        :type text: str
+        :type triggered_command: str
+        :rtype: CommandEvent
+        """
+        event = super().view(base_event, hook)
+        event.text = text
+        event.triggered_command = triggered_command
+        return event
+
     def notice_doc(self, target=None):
         """sends a notice containing this command's docstring to the current channel/user or a specific channel/user
         :type target: str
@@ -359,6 +467,7 @@ class RegexEvent(Event):
     :type hook: cloudbot.plugin.RegexHook
     :type match: re.__Match
     """
+    __slots__ = ("match",)
 
     def __init__(self, *, bot=None, hook, match, conn=None, base_event=None, event_type=None, content=None, target=None,
                  channel=None, nick=None, user=None, host=None, mask=None, irc_raw=None, irc_prefix=None,
@@ -371,3 +480,15 @@ class RegexEvent(Event):
                          target=target, channel=channel, nick=nick, user=user, host=host, mask=mask, irc_raw=irc_raw,
                          irc_prefix=irc_prefix, irc_command=irc_command, irc_paramlist=irc_paramlist)
         self.match = match
+
+    @classmethod
+    def view(cls, base_event, hook, match=None):
+        """
+        :type base_event: Event
+        :type hook: cloudbot.plugin.RegexHook
+        :type match: re.__Match
+        :rtype: RegexEvent
+        """
+        event = super().view(base_event, hook)
+        event.match = match
+        return event
@@ -1,21 +1,46 @@
 import asyncio
 import enum
+import functools
 import glob
 import importlib
 import inspect
 import logging
+import operator
 import os
 import re
+import time
 
 import sqlalchemy
 
-from cloudbot.event import Event
+from cloudbot.event import Event, CommandEvent, RegexEvent, EventType
 from cloudbot.util import botvars
+from cloudbot.util.cache import ResultCache, UncachedReply
+from cloudbot.util.executor import BoundedExecutor, CallAbandoned, ExecutorFull
+from cloudbot.util.limiter import KeyedLimiter
+from cloudbot.util.prefilter import RegexPrefilter
+from cloudbot.util.tracing import span, now
+from cloudbot.util.trie import PrefixTrie
 from cloudbot.hook import _hook_name_to_hook
 
 logger = logging.getLogger("cloudbot")
 
 
+def _argument_injector(required_args):
+    """
+    Creates a function which gets the values of <required_args> from an event, as a tuple, raising AttributeError if
+    the event doesn't have one of them
+    :type required_args: list[str]
+    :rtype: (cloudbot.event.Event) -> tuple
+    """
+    if not required_args:
+        return lambda event: ()
+    if len(required_args) == 1:
+        # attrgetter with one attribute returns the value on its own, rather than in a tuple
+        getter = operator.attrgetter(required_args[0])
+        return lambda event: (getter(event),)
+    return operator.attrgetter(*required_args)
+
+
 def find_hooks(parent, module):
     """
     :type parent: Plugin
@@ -77,11 +102,19 @@ class PluginManager:
     :type bot: cloudbot.bot.CloudBot
     :type plugins: dict[str, Plugin]
     :type commands: dict[str, CommandHook]
+    :type command_index: PrefixTrie
     :type raw_triggers: dict[str, list[RawHook]]
     :type catch_all_triggers: list[RawHook]
     :type event_type_hooks: dict[cloudbot.event.EventType, list[EventHook]]
     :type regex_hooks: list[(re.__Regex, RegexHook)]
+    :type regex_matcher: RegexPrefilter
     :type sieves: list[SieveHook]
+    :type plans_built: int
+    :type sieve_cache_hits: int
+    :type sieve_cache_misses: int
+    :type executors: dict[str, BoundedExecutor]
+    :type default_timeout: float
+    :type hook_timeouts: int
     """
 
     def __init__(self, bot):
@@ -93,12 +126,286 @@ class PluginManager:
 
         self.plugins = {}
         self.commands = {}
+        # the same commands, indexed so abbreviations can be found without scanning every alias
+        self.command_index = PrefixTrie()
         self.raw_triggers = {}
         self.catch_all_triggers = []
         self.event_type_hooks = {}
         self.regex_hooks = []
+        # the same regexes, searched together so regexes which can't match aren't run
+        regex_budget = bot.config.get("regex_budget", {})
+        self.regex_matcher = RegexPrefilter(max_time=regex_budget.get("max_time", 0.1),
+                                            max_strikes=regex_budget.get("strikes", 3))
         self.sieves = []
-        self._hook_waiting_queues = {}
+        # (connection name, irc command, event type) -> DispatchPlan
+        self._dispatch_plans = {}
+        self.plans_built = 0
+        # (sieve, hook, connection name, irc command, channel, mask) -> whether a pure sieve let the event through
+        self._sieve_verdicts = {}
+        self._sieve_cache_size = bot.config.get("sieve_cache", {}).get("max_size", 10000)
+        self.sieve_cache_hits = 0
+        self.sieve_cache_misses = 0
+
+        # thread pools for threaded hooks and sieves, so slow plugins can only use up their own pool's threads
+        self.executors = {}
+        # executor name -> the options it was created with
+        self._executor_options = {}
+        # plugin title -> executor name, for plugins which don't choose one themselves
+        self.plugin_executors = {}
+        self.configure_executors()
+
+        # seconds a hook may run for, if it doesn't set its own timeout. 0 for no limit.
+        self.default_timeout = bot.config.get("hook_timeout", 60)
+        self.hook_timeouts = 0
+        # seconds a hook with a concurrency limit may wait to run before the event is dropped, if it doesn't set its
+        # own max_wait. 0 to wait as long as it takes.
+        self.default_max_wait = bot.config.get("hook_max_wait", 0)
+
+        # threaded hooks which keep finishing within max_time seconds are run on the event loop instead, since that's
+        # quicker than handing them to a thread, until a call takes longer than that
+        inline_hooks = bot.config.get("inline_hooks", {})
+        # hooks can't be checked for I/O, so moving threaded hooks onto the loop by how quick they are is opt-in
+        self.adaptive_inline = inline_hooks.get("enabled", False)
+        self.inline_exclude = set(inline_hooks.get("exclude", ()))
+        self.inline_promote_after = inline_hooks.get("promote_after", 50)
+        self.inline_max_time = inline_hooks.get("max_time", 0.0005)
+        self.hooks_promoted = 0
+        self.hooks_demoted = 0
+
+        metrics = bot.metrics
+        self.hook_calls = metrics.counter("cloudbot_hook_calls_total", "Hooks run", ("hook",))
+        self.hook_errors = metrics.counter("cloudbot_hook_errors_total",
+                                           "Hooks which raised an error, timed out or couldn't be run", ("hook",))
+        self.hook_seconds = metrics.histogram("cloudbot_hook_seconds", "How long hooks took to run", ("hook",))
+        self.sieve_rejections = metrics.counter("cloudbot_sieve_rejections_total", "Events sieves stopped",
+                                                ("sieve",))
+        self.db_session_seconds = metrics.histogram("cloudbot_db_session_seconds",
+                                                    "How long hooks held a database session for", ("hook",))
+        metrics.add_collector(self.collect_metrics)
+
+    def find_commands(self, command):
+        """
+        Finds the command hooks a typed command could mean: the command itself if it's registered, otherwise every
+        command it's an abbreviation of, in sorted order.
+        :type command: str
+        :rtype: list[(str, CommandHook)]
+        """
+        command_hook = self.commands.get(command)
+        if command_hook is not None:
+            return [(command, command_hook)]
+        return self.command_index.prefixed(command)
+
+    def dispatch_plan(self, conn, irc_command, event_type):
+        """
+        Gets the hooks a line with the given command and event type should be passed to on <conn>, working them out
+        the first time and reusing them until a plugin is loaded or unloaded, or the config changes.
+        :type conn: cloudbot.client.Client
+        :type irc_command: str
+        :type event_type: EventType
+        :rtype: DispatchPlan
+        """
+        key = (conn.name, irc_command, event_type)
+        plan = self._dispatch_plans.get(key)
+        if plan is None or plan.nick != conn.nick:
+            # the command regexes contain the nick, so they need rebuilding when it changes
+            plan = self._dispatch_plans[key] = DispatchPlan(self, conn, irc_command, event_type)
+            self.plans_built += 1
+        return plan
+
+    def invalidate_dispatch_plans(self):
+        """
+        Forgets every dispatch plan, so they're worked out again from the currently loaded hooks and config
+        """
+        self._dispatch_plans.clear()
+
+    def executor_for(self, hook):
+        """
+        Gets the pool a threaded hook or sieve runs in: the one it asked for with executor=, or the one its plugin is
+        assigned to in the config, or the default one.
+        :type hook: Hook
+        :rtype: BoundedExecutor
+        """
+        name = hook.executor or self.plugin_executors.get(hook.plugin.title, "default")
+        executor = self.executors.get(name)
+        if executor is None:
+            logger.warning("{} asked for unknown executor {}, using the default one".format(hook.description, name))
+            # don't warn again
+            hook.executor = "default"
+            executor = self.executors["default"]
+        return executor
+
+    def _may_inline(self, hook):
+        """
+        Checks whether a threaded hook can be moved to the event loop if it's quick enough: it must not have chosen
+        for itself, use the database, be from a plugin in inline_hooks.exclude (for plugins known to do I/O), or have
+        been put in an executor other than the default one (which is how plugins doing slow I/O are marked).
+        :type hook: Hook
+        :rtype: bool
+        """
+        if hook.inline is not None or hook.demoted or "db" in hook.required_args:
+            return False
+        if hook.plugin.title in self.inline_exclude:
+            return False
+        return (hook.executor or self.plugin_executors.get(hook.plugin.title, "default")) == "default"
+
+    def _record_hook_time(self, hook, elapsed):
+        """
+        Records how long a call to a threaded hook took, moving it onto or off the event loop if it needs to be
+        :type hook: Hook
+        :type elapsed: float
+        """
+        if elapsed > self.inline_max_time:
+            hook.fast_calls = 0
+            if hook.runs_inline and hook.inline is None:
+                # it's not quick after all, and won't be tried on the loop again
+                hook.runs_inline = False
+                hook.demoted = True
+                self.hooks_demoted += 1
+                logger.info("{} took {:.2f}ms, running it in a thread from now on".format(
+                    hook.description, elapsed * 1000))
+        elif not hook.runs_inline:
+            hook.fast_calls += 1
+            if hook.fast_calls >= self.inline_promote_after and self._may_inline(hook):
+                hook.runs_inline = True
+                self.hooks_promoted += 1
+                logger.debug("{} finished quickly {} times in a row, running it on the event loop from now on".format(
+                    hook.description, hook.fast_calls))
+
+    def all_hooks(self):
+        """
+        Gets every loaded hook, apart from onload hooks
+        :rtype: set[Hook]
+        """
+        hooks = set(self.commands.values())
+        hooks.update(self.catch_all_triggers)
+        for raw_hooks in self.raw_triggers.values():
+            hooks.update(raw_hooks)
+        for event_hooks in self.event_type_hooks.values():
+            hooks.update(event_hooks)
+        hooks.update(regex_hook for regex, regex_hook in self.regex_hooks)
+        hooks.update(self.sieves)
+        return hooks
+
+    def collect_metrics(self):
+        """
+        Gets metrics for MetricsRegistry from the statistics the plugin manager and its executors keep
+        """
+        yield ("cloudbot_dispatch_plans_built_total", "counter", "Dispatch plans built", [({}, self.plans_built)])
+        yield ("cloudbot_sieve_cache_hits_total", "counter", "Sieve verdicts reused",
+               [({}, self.sieve_cache_hits)])
+        yield ("cloudbot_sieve_cache_misses_total", "counter", "Sieve verdicts worked out",
+               [({}, self.sieve_cache_misses)])
+        yield ("cloudbot_inline_hooks", "gauge", "Threaded hooks running on the event loop",
+               [({}, len(self.inline_hooks()))])
+        # commands has an entry for each alias, so the same hook can be in it more than once
+        cached_hooks = sorted({hook for hook in self.commands.values() if hook.results is not None},
+                              key=lambda hook: hook.description)
+        cache_stats = [(hook.description, hook.results.stats()) for hook in cached_hooks]
+        for stat, metric_type, documentation in (("size", "gauge", "Results kept in the hook's result cache"),
+                                                 ("hits", "counter", "Calls answered from the hook's result cache"),
+                                                 ("misses", "counter", "Calls which ran the hook"),
+                                                 ("coalesced", "counter",
+                                                  "Calls which waited for the same call already running")):
+            name = "cloudbot_hook_cache_" + stat + ("_total" if metric_type == "counter" else "")
+            yield (name, metric_type, documentation,
+                   [({"hook": description}, stats[stat]) for description, stats in cache_stats])
+        limited_hooks = sorted((hook for hook in self.all_hooks() if hook.limiter is not None),
+                               key=lambda hook: hook.description)
+        limiter_stats = [(hook.description, hook.limiter.stats()) for hook in limited_hooks]
+        for stat, metric_type, documentation in (("keys_in_use", "gauge", "Concurrency keys the hook is running for"),
+                                                 ("waiting", "gauge", "Calls waiting for the hook's max_concurrency"),
+                                                 ("peak_waiting", "gauge", "Most calls which have been waiting"),
+                                                 ("waited", "counter", "Calls which had to wait to run"),
+                                                 ("dropped", "counter", "Calls dropped after waiting max_wait")):
+            name = "cloudbot_hook_concurrency_" + stat + ("_total" if metric_type == "counter" else "")
+            yield (name, metric_type, documentation,
+                   [({"hook": description}, stats[stat]) for description, stats in limiter_stats])
+        executor_stats = [(name, executor.stats()) for name, executor in sorted(self.executors.items())]
+        for stat, metric_type, documentation in (("active", "gauge", "Functions running in the executor"),
+                                                 ("queued", "gauge", "Functions waiting for a thread"),
+                                                 ("peak_queued", "gauge", "Most functions which have been waiting"),
+                                                 ("submitted", "counter", "Functions submitted"),
+                                                 ("rejected", "counter", "Functions rejected by a full executor"),
+                                                 ("abandoned", "counter", "Functions abandoned after timing out"),
+                                                 ("utilisation", "gauge", "Fraction of thread time spent busy")):
+            name = "cloudbot_executor_" + stat + ("_total" if metric_type == "counter" else "")
+            yield (name, metric_type, documentation,
+                   [({"executor": executor}, stats[stat]) for executor, stats in executor_stats])
+
+    def hook_at(self, frame):
+        """
+        Finds which hook is running <frame>, or the frames it was called from, going by the innermost one which is
+        running a hook's function, or failing that, code from a plugin's file. Returns None if there isn't one.
+        :type frame: types.FrameType
+        :rtype: str
+        """
+        hook_codes = {inspect.unwrap(hook.function).__code__: hook for hook in self.all_hooks()}
+        plugin_files = {plugin.file_path: plugin for plugin in list(self.plugins.values())}
+        plugin_frame = None
+        while frame is not None:
+            code = frame.f_code
+            hook = hook_codes.get(code)
+            if hook is not None:
+                return hook.description
+            if plugin_frame is None and code.co_filename in plugin_files:
+                plugin_frame = frame
+            frame = frame.f_back
+        if plugin_frame is not None:
+            return "{}:{}".format(plugin_files[plugin_frame.f_code.co_filename].title, plugin_frame.f_code.co_name)
+        return None
+
+    def inline_hooks(self):
+        """
+        Gets every loaded threaded hook which runs on the event loop
+        :rtype: list[Hook]
+        """
+        return sorted((hook for hook in self.all_hooks() if hook.runs_inline), key=lambda hook: hook.description)
+
+    def timed_out_hooks(self):
+        """
+        Gets every loaded hook which has timed out, with the ones which have timed out most first
+        :rtype: list[Hook]
+        """
+        hooks = self.all_hooks()
+        return sorted((hook for hook in hooks if hook.timeouts), key=lambda hook: hook.timeouts, reverse=True)
+
+    def configure_executors(self):
+        """
+        Creates the executors in the config, replacing any whose options have changed since they were created, and
+        stopping any which have been removed. Functions already running in a replaced executor finish there.
+        """
+        configured = dict(self.bot.config.get("executors", {}))
+        configured.setdefault("default", {})
+        for name, options in configured.items():
+            if name in self.executors and self._executor_options[name] == options:
+                continue
+            old_executor = self.executors.get(name)
+            self.executors[name] = BoundedExecutor(name, threads=options.get("threads", 10),
+                                                   max_queue=options.get("max_queue", 100),
+                                                   policy=options.get("on_full", "reject"), loop=self.bot.loop)
+            self._executor_options[name] = options
+            if old_executor is not None:
+                logger.info("Executor {} changed, replacing it".format(name))
+                old_executor.shutdown()
+        for name in set(self.executors) - set(configured):
+            logger.info("Executor {} removed, stopping it".format(name))
+            self.executors.pop(name).shutdown()
+            del self._executor_options[name]
+        self.plugin_executors = self.bot.config.get("plugin_executors", {})
+
+    def shutdown_executors(self):
+        """
+        Stops every executor's threads once they've finished what they're running
+        """
+        for executor in self.executors.values():
+            executor.shutdown()
+
+    def clear_sieve_cache(self):
+        """
+        Forgets every cached verdict from pure sieves. Anything which changes what a pure sieve would decide (ACLs,
+        ignores, permissions, regex status, ...) should call this.
+        """
+        self._sieve_verdicts.clear()
 
     @asyncio.coroutine
     def load_all(self, plugin_dir):
@@ -181,6 +488,7 @@ class PluginManager:
                         "Ignoring new assignment.".format(plugin.title, alias, self.commands[alias].plugin.title))
                 else:
                     self.commands[alias] = command_hook
+                    self.command_index[alias] = command_hook
             self._log_hook(command_hook)
 
         # register raw hooks
@@ -208,6 +516,7 @@ class PluginManager:
         for regex_hook in plugin.regexes:
             for regex_match in regex_hook.regexes:
                 self.regex_hooks.append((regex_match, regex_hook))
+                self.regex_matcher.add(regex_match, regex_hook)
             self._log_hook(regex_hook)
 
         # register sieves
@@ -218,6 +527,9 @@ class PluginManager:
         # we don't need this anymore
         del plugin.run_on_load
 
+        self.invalidate_dispatch_plans()
+        self.clear_sieve_cache()
+
     @asyncio.coroutine
     def _unload(self, path):
         """
@@ -247,6 +559,7 @@ class PluginManager:
                 if alias in self.commands and self.commands[alias] == command_hook:
                     # we need to make sure that there wasn't a conflict, so we don't delete another plugin's command
                     del self.commands[alias]
+                    del self.command_index[alias]
 
         # unregister raw hooks
         for raw_hook in plugin.raw_hooks:
@@ -271,6 +584,7 @@ class PluginManager:
         for regex_hook in plugin.regexes:
             for regex_match in regex_hook.regexes:
                 self.regex_hooks.remove((regex_match, regex_hook))
+                self.regex_matcher.remove(regex_match, regex_hook)
 
         # unregister sieves
         for sieve_hook in plugin.sieves:
@@ -282,6 +596,9 @@ class PluginManager:
         # remove last reference to plugin
         del self.plugins[plugin.file_name]
 
+        self.invalidate_dispatch_plans()
+        self.clear_sieve_cache()
+
         if self.bot.config.get("logging", {}).get("show_plugin_loading", True):
             logger.info("Unloaded all plugins from {}".format(plugin.title))
 
@@ -338,8 +655,13 @@ class PluginManager:
 
         :type hook: cloudbot.plugin.Hook
         :type event: cloudbot.event.Event
-        :rtype: list
+        :rtype: tuple | list
         """
+        try:
+            return hook.inject(event)
+        except AttributeError:
+            # find out which one is missing, for the error message
+            pass
         parameters = []
         for required_arg in hook.required_args:
             if hasattr(event, required_arg):
@@ -352,21 +674,43 @@ class PluginManager:
                 return None
         return parameters
 
-    def _execute_hook_threaded(self, hook, event):
+    def _execute_hook_threaded(self, hook, event, submitted=None):
         """
         :type hook: Hook
         :type event: cloudbot.event.Event
+        :param submitted: When the hook was handed to its executor, from tracing.now(), if the event is being traced
+        :type submitted: float
         """
-        event.prepare_threaded()
+        if submitted is not None:
+            event.trace.add("executor queue", submitted, now(), executor=self.executor_for(hook).name)
+        opened = time.perf_counter()
+        with span(event.trace, "Event.prepare"):
+            event.prepare_threaded()
 
         parameters = self._prepare_parameters(hook, event)
         if parameters is None:
             return None
 
+        start = time.perf_counter()
         try:
-            return hook.function(*parameters)
+            # replies the hook sends without going through the event are traced too, since it has this thread to itself
+            with span(event.trace, hook.description, activate=True):
+                return hook.function(*parameters)
         finally:
+            if self.adaptive_inline and hook.inline is None:
+                self._record_hook_time(hook, time.perf_counter() - start)
             event.close_threaded()
+            if "db" in hook.required_args:
+                self.db_session_seconds.observe(time.perf_counter() - opened, hook.description)
+
+    @asyncio.coroutine
+    def _execute_hook_inline(self, hook, event):
+        """
+        Runs a threaded hook on the event loop, for hooks which are quicker to run than to hand to a thread
+        :type hook: Hook
+        :type event: cloudbot.event.Event
+        """
+        return self._execute_hook_threaded(hook, event)
 
     @asyncio.coroutine
     def _execute_hook_sync(self, hook, event):
@@ -374,19 +718,24 @@ class PluginManager:
         :type hook: Hook
         :type event: cloudbot.event.Event
         """
-        yield from event.prepare()
+        opened = time.perf_counter()
+        with span(event.trace, "Event.prepare"):
+            yield from event.prepare()
 
         parameters = self._prepare_parameters(hook, event)
         if parameters is None:
             return None
 
         try:
-            return (yield from hook.function(*parameters))
+            with span(event.trace, hook.description):
+                return (yield from hook.function(*parameters))
         finally:
             yield from event.close()
+            if "db" in hook.required_args:
+                self.db_session_seconds.observe(time.perf_counter() - opened, hook.description)
 
     @asyncio.coroutine
-    def _execute_hook(self, hook, event):
+    def _execute_hook(self, hook, event, finished=None):
         """
         Runs the specific hook with the given bot and event.
 
@@ -394,18 +743,53 @@ class PluginManager:
 
         :type hook: cloudbot.plugin.Hook
         :type event: cloudbot.event.Event
+        :param finished: Called once the hook has stopped running: when this returns, unless the hook is threaded and
+                         timed out, in which case it's when the hook's thread gets round to returning
+        :type finished: () -> None
         :rtype: bool
         """
+        if hook.timeout is not None:
+            timeout = hook.timeout
+        elif hook.type is HookType.onload:
+            # loading a plugin can legitimately take a while, and there's nothing waiting on it
+            timeout = 0
+        else:
+            timeout = self.default_timeout
+        start = time.perf_counter()
+        failed = True
+        still_running = None
         try:
             # _internal_run_threaded and _internal_run_coroutine prepare the database, and run the hook.
             # _internal_run_* will prepare parameters and the database session, but won't do any error catching.
-            if hook.threaded:
-                out = yield from self.bot.loop.run_in_executor(None, self._execute_hook_threaded, hook, event)
+            if hook.type is HookType.command and (hook.cache_ttl or hook.coalesce):
+                out = yield from self._execute_hook_cached(hook, event, timeout)
             else:
-                out = yield from self._execute_hook_sync(hook, event)
+                out = yield from self._run_hook(hook, event, timeout)
+            failed = False
+        except asyncio.TimeoutError as e:
+            if isinstance(e, CallAbandoned):
+                still_running = e.finished
+            hook.timeouts += 1
+            self.hook_timeouts += 1
+            logger.warning("{} timed out after {} seconds ({} times so far)".format(
+                hook.description, timeout, hook.timeouts))
+            return False
+        except ExecutorFull as e:
+            logger.warning("Not running {}: {}".format(hook.description, e))
+            return False
         except Exception:
             logger.exception("Error in hook {}".format(hook.description))
             return False
+        finally:
+            self.hook_calls.inc(hook.description)
+            self.hook_seconds.observe(time.perf_counter() - start, hook.description)
+            if failed:
+                self.hook_errors.inc(hook.description)
+            if finished is not None:
+                if still_running is None:
+                    finished()
+                else:
+                    still_running.add_done_callback(lambda future: finished())
 
         if out is not None:
             # if there are multiple items in the response, return them on multiple lines
@@ -417,6 +801,51 @@ class PluginManager:
                 event.reply(str(out))
         return True
 
+    def _run_hook(self, hook, event, timeout):
+        """
+        :type hook: cloudbot.plugin.Hook
+        :type event: cloudbot.event.Event
+        :param timeout: Seconds the hook can run for, or 0 for no limit. A coroutine hook is cancelled when it times
+                        out. A threaded hook can't be stopped, but its executor stops waiting for it once it has been
+                        running for that long, and its result is thrown away.
+        :type timeout: float
+        :return: A coroutine which runs the hook, and returns what it returns
+        """
+        if hook.runs_inline:
+            return self._execute_hook_inline(hook, event)
+        elif hook.threaded:
+            if event.trace is not None:
+                return self.executor_for(hook).run(self._execute_hook_threaded, hook, event, now(),
+                                                   timeout=timeout or None)
+            return self.executor_for(hook).run(self._execute_hook_threaded, hook, event, timeout=timeout or None)
+        elif timeout:
+            return asyncio.wait_for(self._execute_hook_sync(hook, event), timeout, loop=self.bot.loop)
+        else:
+            return self._execute_hook_sync(hook, event)
+
+    @asyncio.coroutine
+    def _execute_hook_cached(self, hook, event, timeout):
+        """
+        Runs a command hook with cache_ttl or coalesce set, unless it has already returned, or is working out, what it
+        would return for the same text
+        :type hook: cloudbot.plugin.CommandHook
+        :type event: cloudbot.event.CommandEvent
+        :type timeout: float
+        """
+        if hook.results is None:
+            hook.results = ResultCache(ttl=hook.cache_ttl, max_size=hook.cache_size, coalesce=hook.coalesce,
+                                       loop=self.bot.loop)
+        text = " ".join(event.text.lower().split()) if event.text else ""
+        key = (text, hook.cache_key(event)) if hook.cache_key is not None else text
+        try:
+            return (yield from hook.results.run(key, lambda: self._run_hook(hook, event, timeout)))
+        except UncachedReply as e:
+            # raised to everyone waiting for the result, so each gets it as a reply to their own message
+            if e.notice:
+                event.notice(e.message)
+                return None
+            return e.message
+
     @asyncio.coroutine
     def _sieve(self, sieve, event, hook):
         """
@@ -426,16 +855,35 @@ class PluginManager:
         :rtype: cloudbot.event.Event
         """
         try:
-            if sieve.threaded:
-                result = yield from self.bot.loop.run_in_executor(None, sieve.function, self.bot, event, hook)
-            else:
-                result = yield from sieve.function(self.bot, event, hook)
+            with span(event.trace, "PluginManager._sieve", sieve=sieve.description):
+                if sieve.threaded:
+                    result = yield from self.executor_for(sieve).run(sieve.function, self.bot, event, hook)
+                else:
+                    result = yield from sieve.function(self.bot, event, hook)
+        except ExecutorFull as e:
+            logger.warning("Not running {} on {}: {}".format(sieve.description, hook.description, e))
+            return None
         except Exception:
             logger.exception("Error running sieve {} on {}:".format(sieve.description, hook.description))
             return None
         else:
             return result
 
+    def _sieve_inline(self, sieve, event, hook):
+        """
+        Runs a synchronous sieve directly in the event loop. Returns the sieve's result, or False if it errored.
+        :type sieve: SieveHook
+        :type event: cloudbot.event.Event
+        :type hook: cloudbot.plugin.Hook
+        :rtype: cloudbot.event.Event | bool
+        """
+        try:
+            with span(event.trace, "PluginManager._sieve", sieve=sieve.description):
+                return sieve.function(self.bot, event, hook)
+        except Exception:
+            logger.exception("Error running sieve {} on {}:".format(sieve.description, hook.description))
+            return False
+
     @asyncio.coroutine
     def launch(self, hook, event):
         """
@@ -447,57 +895,169 @@ class PluginManager:
         :type hook: cloudbot.plugin.Hook | cloudbot.plugin.CommandHook
         :rtype: bool
         """
+        with span(event.trace, "PluginManager.sieve", hook=hook.description):
+            event = yield from self.sieve(hook, event)
+        if event is None:
+            return False
+        return (yield from self.run(hook, event))
+
+    @asyncio.coroutine
+    def start(self, hook, event):
+        """
+        Passes a given event for a given hook through the sieves, and if they let it through, starts running the hook
+        in a task of its own, without waiting for it to finish.
+
+        :type event: cloudbot.event.Event | cloudbot.event.CommandEvent
+        :type hook: cloudbot.plugin.Hook | cloudbot.plugin.CommandHook
+        :rtype: (cloudbot.plugin.Hook, asyncio.Task)
+        :return: The hook, with the task running it, or None if it isn't going to run
+        """
+        with span(event.trace, "PluginManager.sieve", hook=hook.description):
+            event = yield from self.sieve(hook, event)
+        if event is None:
+            return None
+        return hook, asyncio.async(self.run(hook, event), loop=self.bot.loop)
+
+    @asyncio.coroutine
+    def sieve(self, hook, event):
+        """
+        Passes a given event for a given hook through every sieve, and checks the hook has something to do with it.
+
+        :type event: cloudbot.event.Event | cloudbot.event.CommandEvent
+        :type hook: cloudbot.plugin.Hook | cloudbot.plugin.CommandHook
+        :rtype: cloudbot.event.Event | cloudbot.event.CommandEvent
+        :return: The event to run the hook with, or None if it shouldn't run
+        """
         if hook.type is not HookType.onload:  # we don't need sieves on onload hooks.
-            for sieve in self.bot.plugin_manager.sieves:
-                event = yield from self._sieve(sieve, event, hook)
-                if event is None:
-                    return False
+            for sieve in self.sieves:
+                if sieve.pure:
+                    key = (sieve, hook, event.conn.name, event.irc_command, event.chan, event.mask)
+                    passed = self._sieve_verdicts.get(key)
+                    if passed is not None:
+                        self.sieve_cache_hits += 1
+                        if not passed:
+                            self.sieve_rejections.inc(sieve.description)
+                            return None
+                        continue
+                    self.sieve_cache_misses += 1
+                    result = self._sieve_inline(sieve, event, hook)
+                    if result is False:
+                        # the sieve errored, so there's no verdict to remember
+                        return None
+                    if len(self._sieve_verdicts) >= self._sieve_cache_size:
+                        self._sieve_verdicts.clear()
+                    self._sieve_verdicts[key] = result is not None
+                    if result is None:
+                        self.sieve_rejections.inc(sieve.description)
+                        return None
+                elif sieve.sync:
+                    event = self._sieve_inline(sieve, event, hook)
+                    if event is None:
+                        self.sieve_rejections.inc(sieve.description)
+                    if not event:
+                        return None
+                else:
+                    event = yield from self._sieve(sieve, event, hook)
+                    if event is None:
+                        self.sieve_rejections.inc(sieve.description)
+                        return None
 
         if hook.type is HookType.command and hook.auto_help and not event.text and hook.doc is not None:
             event.notice_doc()
-            return False
+            return None
 
-        if hook.single_thread:
-            # There should only be one running instance of this hook, so let's wait for the last event to be processed
-            # before starting this one.
-
-            key = (hook.plugin.title, hook.function_name)
-            if key in self._hook_waiting_queues:
-                queue = self._hook_waiting_queues[key]
-                if queue is None:
-                    # there's a hook running, but the queue hasn't been created yet, since there's only one hook
-                    queue = asyncio.Queue()
-                    self._hook_waiting_queues[key] = queue
-                assert isinstance(queue, asyncio.Queue)
-                # create a future to represent this task
-                future = asyncio.Future()
-                queue.put_nowait(future)
-                # wait until the last task is completed
-                yield from future
-            else:
-                # set to None to signify that this hook is running, but there's no need to create a full queue
-                # in case there are no more hooks that will wait
-                self._hook_waiting_queues[key] = None
+        return event
 
-            # Run the plugin with the message, and wait for it to finish
-            result = yield from self._execute_hook(hook, event)
+    @asyncio.coroutine
+    def run(self, hook, event):
+        """
+        Runs a given hook with a given event which has already been through the sieves, once the hook's
+        max_concurrency allows it.
 
-            queue = self._hook_waiting_queues[key]
-            if queue is None or queue.empty():
-                # We're the last task in the queue, we can delete it now.
-                del self._hook_waiting_queues[key]
-            else:
-                # set the result for the next task's future, so they can execute
-                next_future = yield from queue.get()
-                next_future.set_result(None)
+        Returns False if the hook didn't run successfully, and True if it ran successfully.
+
+        :type event: cloudbot.event.Event | cloudbot.event.CommandEvent
+        :type hook: cloudbot.plugin.Hook | cloudbot.plugin.CommandHook
+        :rtype: bool
+        """
+        if hook.max_concurrency:
+            # Only max_concurrency instances of this hook can run at once (for each concurrency key), so wait for
+            # one of the others to finish first if needed
+            if hook.limiter is None:
+                hook.limiter = KeyedLimiter(hook.max_concurrency, loop=self.bot.loop)
+            key = hook.concurrency_key(event) if hook.concurrency_key is not None else None
+            max_wait = self.default_max_wait if hook.max_wait is None else hook.max_wait
+            with span(event.trace, "concurrency wait"):
+                acquired = yield from hook.limiter.acquire(key, max_wait)
+            if not acquired:
+                logger.warning("Dropping event for {}: waited more than {} seconds to run".format(
+                    hook.description, max_wait))
+                return False
+            # a threaded hook which times out carries on running, so the limiter is only released once it's finished
+            with span(event.trace, "PluginManager._execute_hook", hook=hook.description):
+                result = yield from self._execute_hook(hook, event, functools.partial(hook.limiter.release, key))
         else:
             # Run the plugin with the message, and wait for it to finish
-            result = yield from self._execute_hook(hook, event)
+            with span(event.trace, "PluginManager._execute_hook", hook=hook.description):
+                result = yield from self._execute_hook(hook, event)
 
         # Return the result
         return result
 
 
+class DispatchPlan:
+    """
+    Everything about how to dispatch a line which depends only on its connection, IRC command and event type.
+
+    :type nick: str
+    :type run_before: list[RawHook]
+    :type hooks: list[RawHook | EventHook]
+    :type match_commands: bool
+    :type match_regexes: bool
+    :type channel_command_re: re.__Regex
+    :type private_command_re: re.__Regex
+    """
+    __slots__ = ("nick", "run_before", "hooks", "match_commands", "match_regexes", "channel_command_re",
+                 "private_command_re")
+
+    def __init__(self, plugin_manager, conn, irc_command, event_type):
+        """
+        :type plugin_manager: PluginManager
+        :type conn: cloudbot.client.Client
+        :type irc_command: str
+        :type event_type: EventType
+        """
+        self.nick = conn.nick
+        # catch-all coroutine hooks run before all others
+        self.run_before = [hook for hook in plugin_manager.catch_all_triggers if not hook.threaded]
+        self.hooks = [hook for hook in plugin_manager.catch_all_triggers if hook.threaded]
+        self.hooks.extend(plugin_manager.raw_triggers.get(irc_command, ()))
+        self.hooks.extend(plugin_manager.event_type_hooks.get(event_type, ()))
+
+        # only messages are matched against commands and regexes, so only they need their content parsed
+        is_message = event_type is EventType.message
+        self.match_commands = is_message and bool(plugin_manager.commands)
+        self.match_regexes = is_message and bool(plugin_manager.regex_hooks)
+        if self.match_commands:
+            command_prefix = re.escape(conn.config.get('command_prefix', '.'))
+            nick = re.escape(conn.nick)
+            self.channel_command_re = re.compile(r'(?i)^(?:[{}]|{}[,;:]+\s+)(\w+)(?:$|\s+)(.*)'.format(
+                command_prefix, nick))
+            # private message, no command prefix needed
+            self.private_command_re = re.compile(r'(?i)^(?:[{}]?|{}[,;:]+\s+)(\w+)(?:$|\s+)(.*)'.format(
+                command_prefix, nick))
+        else:
+            self.channel_command_re = self.private_command_re = None
+
+    @property
+    def empty(self):
+        """
+        Whether there's nothing to do for the line at all, so no event needs to be created for it
+        :rtype: bool
+        """
+        return not (self.run_before or self.hooks or self.match_commands or self.match_regexes)
+
+
 class Plugin:
     """
     Each Plugin represents a plugin file, and contains loaded hooks.
@@ -569,12 +1129,25 @@ class Hook:
     :type function: callable
     :type function_name: str
     :type required_args: list[str]
+    :type inject: (cloudbot.event.Event) -> tuple
     :type threaded: bool
     :type ignore_bots: bool
     :type permissions: list[str]
     :type single_thread: bool
+    :type executor: str
+    :type timeout: float
+    :type timeouts: int
+    :type max_concurrency: int
+    :type concurrency_key: (cloudbot.event.Event) -> object
+    :type max_wait: float
+    :type limiter: KeyedLimiter
+    :type inline: bool
+    :type runs_inline: bool
+    :type fast_calls: int
+    :type demoted: bool
     """
     type = None  # to be assigned in subclasses
+    event_class = Event  # the type of event the hook is passed
 
     def __init__(self, plugin, func_hook):
         """
@@ -588,6 +1161,11 @@ class Hook:
         self.required_args = inspect.getargspec(self.function)[0]
         if self.required_args is None:
             self.required_args = []
+        self.inject = _argument_injector(self.required_args)
+        for required_arg in self.required_args:
+            if self.event_class is not None and not hasattr(self.event_class, required_arg):
+                logger.warning("{} asks for argument '{}', which {} doesn't have".format(
+                    self.description, required_arg, self.event_class.__name__))
 
         if asyncio.iscoroutine(self.function) or asyncio.iscoroutinefunction(self.function):
             self.threaded = False
@@ -597,6 +1175,40 @@ class Hook:
         self.ignore_bots = func_hook.kwargs.pop("ignorebots", False)
         self.permissions = func_hook.kwargs.pop("permissions", [])
         self.single_thread = func_hook.kwargs.pop("singlethread", False)
+        # how many instances of this hook can run at once, or None for no limit. singlethread=True means 1.
+        self.max_concurrency = func_hook.kwargs.pop("max_concurrency", 1 if self.single_thread else None)
+        # event attributes to apply max_concurrency separately for, for example "chan" for one at a time per channel
+        concurrency_key = func_hook.kwargs.pop("concurrency_key", None)
+        if isinstance(concurrency_key, str):
+            concurrency_key = (concurrency_key,)
+        if concurrency_key:
+            for attribute in concurrency_key:
+                if self.event_class is not None and not hasattr(self.event_class, attribute):
+                    logger.warning("{} has concurrency key '{}', which {} doesn't have".format(
+                        self.description, attribute, self.event_class.__name__))
+            self.concurrency_key = operator.attrgetter(*concurrency_key)
+        else:
+            self.concurrency_key = None
+        # seconds to wait to run before dropping the event, 0 to wait forever, or None to use the default from the
+        # config
+        self.max_wait = func_hook.kwargs.pop("max_wait", None)
+        self.limiter = None
+        # the name of the executor this hook runs in if it's threaded, if it doesn't use its plugin's
+        self.executor = func_hook.kwargs.pop("executor", None)
+        # seconds this hook may run for, 0 for no limit, or None to use the default from the config
+        self.timeout = func_hook.kwargs.pop("timeout", None)
+        # how many times this hook has timed out
+        self.timeouts = 0
+        # True to run this threaded hook on the event loop instead of in a thread, False to always use a thread, or None
+        # to let the plugin manager decide by timing it
+        self.inline = func_hook.kwargs.pop("inline", None)
+        if self.inline and not self.threaded:
+            logger.warning("{} is a coroutine, so inline=True does nothing".format(self.description))
+            self.inline = None
+        self.runs_inline = bool(self.inline) and self.threaded
+        # how many times in a row this hook has finished quickly, and whether it was run inline and turned out slow
+        self.fast_calls = 0
+        self.demoted = False
 
         if func_hook.kwargs:
             # we should have popped all the args, so warn if there are any left
@@ -607,8 +1219,8 @@ class Hook:
         return "{}:{}".format(self.plugin.title, self.function_name)
 
     def __repr__(self):
-        return "type: {}, plugin: {}, ignore_bots: {}, permissions: {}, single_thread: {}, threaded: {}".format(
-            self.type.name, self.plugin.title, self.ignore_bots, self.permissions, self.single_thread, self.threaded
+        return "type: {}, plugin: {}, ignore_bots: {}, permissions: {}, max_concurrency: {}, threaded: {}".format(
+            self.type.name, self.plugin.title, self.ignore_bots, self.permissions, self.max_concurrency, self.threaded
         )
 
 
@@ -618,8 +1230,14 @@ class CommandHook(Hook):
     :type aliases: list[str]
     :type doc: str
     :type auto_help: bool
+    :type cache_ttl: float
+    :type coalesce: bool
+    :type cache_key: (cloudbot.event.CommandEvent) -> object
+    :type cache_size: int
+    :type results: ResultCache
     """
     type = HookType.command
+    event_class = CommandEvent
 
     def __init__(self, plugin, cmd_hook):
         """
@@ -627,6 +1245,16 @@ class CommandHook(Hook):
         :type cmd_hook: cloudbot.util.hook._CommandHook
         """
         self.auto_help = cmd_hook.kwargs.pop("autohelp", True)
+        # seconds to keep what this hook returns for, so the same command with the same text gets the same reply
+        # without running the hook again. Text is compared ignoring case and extra spaces. Only what the hook returns
+        # is kept, not anything it sends itself.
+        self.cache_ttl = cmd_hook.kwargs.pop("cache_ttl", 0)
+        # whether the same command with the same text, while this hook is still working on it, waits for that
+        self.coalesce = cmd_hook.kwargs.pop("coalesce", False)
+        # event attributes to keep results separately for, for example "chan" for commands which reply differently in
+        # each channel
+        cache_key = cmd_hook.kwargs.pop("cache_key", None)
+        self.cache_size = cmd_hook.kwargs.pop("cache_size", 100)
 
         self.name = cmd_hook.main_alias
         self.aliases = list(cmd_hook.aliases)  # turn the set into a list
@@ -636,6 +1264,18 @@ class CommandHook(Hook):
 
         super().__init__(plugin, cmd_hook)
 
+        if isinstance(cache_key, str):
+            cache_key = (cache_key,)
+        if cache_key:
+            for attribute in cache_key:
+                if not hasattr(self.event_class, attribute):
+                    logger.warning("{} has cache key '{}', which {} doesn't have".format(
+                        self.description, attribute, self.event_class.__name__))
+            self.cache_key = operator.attrgetter(*cache_key)
+        else:
+            self.cache_key = None
+        self.results = None
+
     def __repr__(self):
         return "Command[name: {}, aliases: {}, {}]".format(self.name, self.aliases[1:], Hook.__repr__(self))
 
@@ -648,6 +1288,7 @@ class RegexHook(Hook):
     :type regexes: set[re.__Regex]
     """
     type = HookType.regex
+    event_class = RegexEvent
 
     def __init__(self, plugin, regex_hook):
         """
@@ -692,17 +1333,34 @@ class RawHook(Hook):
 
 
 class SieveHook(Hook):
+    """
+    :type sync: bool
+    :type pure: bool
+    """
     type = HookType.sieve
+    event_class = None  # sieves are always called with (bot, event, hook)
 
     def __init__(self, plugin, sieve_hook):
         """
         :type plugin: Plugin
         :type sieve_hook: cloudbot.util.hook._SieveHook
         """
+        # a sync sieve is a plain function which doesn't block, so it's run in the event loop rather than in a thread
+        self.sync = sieve_hook.kwargs.pop("sync", False)
+        # a pure sieve is also sync, returns the event it's given or None, and decides only from the hook, connection,
+        # IRC command, channel and mask, so its verdicts can be cached
+        self.pure = sieve_hook.kwargs.pop("pure", False)
+
         super().__init__(plugin, sieve_hook)
 
+        if self.pure:
+            self.sync = True
+        if self.sync and not self.threaded:
+            logger.warning("{} is a coroutine, so it can't be a sync or pure sieve".format(self.description))
+            self.sync = self.pure = False
+
     def __repr__(self):
-        return "Sieve[{}]".format(Hook.__repr__(self))
+        return "Sieve[sync: {}, pure: {}, {}]".format(self.sync, self.pure, Hook.__repr__(self))
 
     def __str__(self):
         return "sieve {} from {}".format(self.function_name, self.plugin.file_name)
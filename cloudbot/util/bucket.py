@@ -28,6 +28,14 @@ class TokenBucket(object):
             return False
         return True
 
+    def time_until(self, tokens):
+        """Returns the number of seconds until there will be at least
+        <tokens> tokens in the bucket, or 0 if there already are."""
+        available = self.tokens
+        if tokens <= available:
+            return 0
+        return (tokens - available) / self.fill_rate
+
     def refill(self):
         self._tokens = self.capacity
 
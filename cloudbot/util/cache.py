@@ -0,0 +1,149 @@
+import asyncio
+from collections import OrderedDict
+import time
+
+
+class UncachedReply(Exception):
+    """
+    Raised by a command hook with cache_ttl or coalesce set to reply with something which shouldn't be remembered, like
+    an error message. Everyone waiting for the hook's result gets the reply, but the next call runs the hook again.
+    """
+
+    def __init__(self, message, *, notice=False):
+        """
+        :type message: str
+        :param notice: Whether to send the reply as a notice, rather than a message to the channel
+        :type notice: bool
+        """
+        super().__init__(message)
+        self.message = message
+        self.notice = notice
+
+
+class _InFlight:
+    __slots__ = ("future", "waiters")
+
+    def __init__(self, future):
+        self.future = future
+        # how many other callers are waiting for this result
+        self.waiters = 0
+
+
+class ResultCache:
+    """
+    Remembers the results of a coroutine for each key: the same key asked for again within <ttl> seconds gets the
+    same result without running anything, and (if <coalesce> is set) callers asking for a key which is already being
+    worked out wait for that instead of starting another one. At most <max_size> results are kept, dropping the least
+    recently used. None results aren't kept.
+
+    :type ttl: float
+    :type max_size: int
+    :type coalesce: bool
+    :type hits: int
+    :type misses: int
+    :type coalesced: int
+    """
+
+    def __init__(self, *, ttl=0, max_size=100, coalesce=False, loop):
+        """
+        :param ttl: Seconds to keep results for, or 0 to not keep them once they've been worked out
+        :type ttl: float
+        :type max_size: int
+        :type coalesce: bool
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.coalesce = coalesce
+        self.loop = loop
+        # key -> (expiry time, result), least recently used first
+        self._results = OrderedDict()
+        self._in_flight = {}
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def _get(self, key):
+        """
+        :rtype: (bool, object)
+        """
+        entry = self._results.get(key)
+        if entry is None:
+            return False, None
+        expiry, result = entry
+        if expiry < time.time():
+            del self._results[key]
+            return False, None
+        self._results.move_to_end(key)
+        return True, result
+
+    def _put(self, key, result):
+        self._results[key] = (time.time() + self.ttl, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    @asyncio.coroutine
+    def run(self, key, function):
+        """
+        Gets the result for <key>, calling <function> to create a coroutine which works it out if it's needed
+        :type key: collections.Hashable
+        :type function: () -> collections.Awaitable
+        """
+        if self.ttl:
+            found, result = self._get(key)
+            if found:
+                self.hits += 1
+                return result
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            in_flight.waiters += 1
+            try:
+                # shielded, so that if this caller gives up, the one working it out doesn't
+                return (yield from asyncio.shield(in_flight.future, loop=self.loop))
+            except asyncio.CancelledError:
+                in_flight.waiters -= 1
+                raise
+
+        self.misses += 1
+        if not self.coalesce:
+            result = yield from function()
+            if self.ttl and result is not None:
+                self._put(key, result)
+            return result
+
+        in_flight = self._in_flight[key] = _InFlight(asyncio.Future(loop=self.loop))
+        try:
+            result = yield from function()
+        except asyncio.CancelledError:
+            # we were cancelled (most likely we timed out), so whoever's waiting for us would have timed out too
+            if in_flight.waiters:
+                in_flight.future.set_exception(asyncio.TimeoutError())
+            raise
+        except Exception as e:
+            if in_flight.waiters:
+                in_flight.future.set_exception(e)
+            raise
+        else:
+            if self.ttl and result is not None:
+                self._put(key, result)
+            in_flight.future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    def clear(self):
+        self._results.clear()
+
+    def stats(self):
+        """
+        :rtype: dict[str, int]
+        """
+        return {"size": len(self._results), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
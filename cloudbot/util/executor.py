@@ -0,0 +1,251 @@
+"""
+Thread pools with a limit on how much work can be waiting for them, so one group of slow plugins can't take every
+thread and hold everything else up.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+logger = logging.getLogger("cloudbot")
+
+# what to do with work submitted while a pool and its queue are full
+rejection_policies = ("reject", "wait")
+
+
+class ExecutorFull(Exception):
+    """
+    Raised when work is submitted to a full BoundedExecutor with the "reject" policy
+    """
+
+
+class CallAbandoned(asyncio.TimeoutError):
+    """
+    Raised when a function run by a BoundedExecutor with a timeout is still running when the timeout's up. The function
+    can't be stopped, so it carries on in its thread, with <finished> being done once it returns.
+
+    :type finished: asyncio.Future
+    """
+
+    def __init__(self, finished):
+        """
+        :type finished: asyncio.Future
+        """
+        super().__init__()
+        self.finished = finished
+
+
+class _Call:
+    """
+    The state of one function submitted to a BoundedExecutor
+    """
+    __slots__ = ("running", "abandoned", "finished", "keeps_thread")
+
+    def __init__(self):
+        self.running = False
+        self.abandoned = False
+        # for abandoned functions, done once they return
+        self.finished = None
+        # whether an abandoned function keeps its place in the pool until it returns
+        self.keeps_thread = False
+
+
+class BoundedExecutor:
+    """
+    A thread pool which runs at most <threads> functions at once, with at most <max_queue> more waiting for a thread.
+    Anything submitted beyond that is either rejected with ExecutorFull, or waits (in the event loop, without holding
+    a thread) until there's room, depending on the pool's policy.
+
+    If a function times out, or whatever's waiting for it is cancelled, while it's running, the function is abandoned:
+    its result is thrown away, and its place in the pool is given up straight away. The pool has <threads> spare
+    threads for abandoned functions to finish in, so they don't hold up anything else; once those are all taken, an
+    abandoned function keeps its place until it finishes.
+
+    :type name: str
+    :type threads: int
+    :type max_queue: int
+    :type policy: str
+    :type submitted: int
+    :type completed: int
+    :type rejected: int
+    :type waited: int
+    :type peak_queued: int
+    :type abandoned: int
+    """
+
+    def __init__(self, name, *, threads, max_queue, policy="reject", loop=None):
+        """
+        :type name: str
+        :type threads: int
+        :type max_queue: int
+        :param policy: "reject" or "wait"
+        :type policy: str
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        if policy not in rejection_policies:
+            raise ValueError("Unknown rejection policy {!r} for executor {}".format(policy, name))
+        self.name = name
+        self.threads = threads
+        self.max_queue = max_queue
+        self.policy = policy
+        self.loop = loop or asyncio.get_event_loop()
+        # twice as many threads as are used at once, to make room for abandoned functions
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads * 2)
+        self._slots = asyncio.Semaphore(threads + max_queue, loop=self.loop)
+        # functions wait for one of these before being handed to a thread, so no more than <threads> run at once
+        self._threads_free = asyncio.Semaphore(threads, loop=self.loop)
+        self._lock = threading.Lock()
+        self._created = time.time()
+
+        # statistics
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.waited = 0
+        self.peak_queued = 0
+        self.abandoned = 0
+        self._abandoned_running = 0
+        self._pending = 0
+        self._active = 0
+        self._busy_time = 0
+
+    @property
+    def active(self):
+        """
+        How many functions are running right now
+        :rtype: int
+        """
+        return self._active
+
+    @property
+    def queued(self):
+        """
+        How many functions are waiting for a thread
+        :rtype: int
+        """
+        return max(self._pending - self._active, 0)
+
+    @property
+    def abandoned_running(self):
+        """
+        How many abandoned functions are still running
+        :rtype: int
+        """
+        return self._abandoned_running
+
+    @property
+    def utilisation(self):
+        """
+        The fraction of the pool's thread time which has been spent running functions, since it was created
+        :rtype: float
+        """
+        elapsed = (time.time() - self._created) * self.threads
+        if elapsed <= 0:
+            return 0
+        return min(self._busy_time / elapsed, 1)
+
+    def _run(self, function, args, call):
+        """
+        :type call: _Call
+        """
+        with self._lock:
+            call.running = True
+            self._active += 1
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                call.running = False
+                self._active -= 1
+                self._busy_time += elapsed
+                if call.abandoned:
+                    self._abandoned_running -= 1
+                    self.loop.call_soon_threadsafe(self._finish_abandoned, call)
+
+    def _finish_abandoned(self, call):
+        """
+        :type call: _Call
+        """
+        if call.keeps_thread:
+            self._threads_free.release()
+        call.finished.set_result(None)
+
+    def _abandon(self, call):
+        """
+        Stops waiting for a function, if it's running
+        :type call: _Call
+        :rtype: bool
+        :return: Whether the function was running, and so has been abandoned
+        """
+        with self._lock:
+            if not call.running:
+                # it either hasn't started, in which case cancelling stopped it, or it's already finished
+                return False
+            call.abandoned = True
+            call.finished = asyncio.Future(loop=self.loop)
+            self.abandoned += 1
+            self._abandoned_running += 1
+            # once the spare threads are all taken by abandoned functions, they keep their places in the pool
+            call.keeps_thread = self._abandoned_running > self.threads
+            return True
+
+    @asyncio.coroutine
+    def run(self, function, *args, timeout=None):
+        """
+        Runs function(*args) in the pool, and returns its result
+        :param timeout: Seconds the function can run for, counted from when it gets a thread, or None for no limit
+        :type timeout: float
+        :raises ExecutorFull: If the pool and its queue are full, and the policy is "reject"
+        :raises CallAbandoned: If the function is still running after <timeout> seconds
+        """
+        if self._slots.locked():
+            if self.policy == "reject":
+                self.rejected += 1
+                raise ExecutorFull("Executor {} is full ({} running, {} queued)".format(
+                    self.name, self.active, self.queued))
+            self.waited += 1
+        yield from self._slots.acquire()
+        self.submitted += 1
+        self._pending += 1
+        if self.queued > self.peak_queued:
+            self.peak_queued = self.queued
+        call = _Call()
+        try:
+            yield from self._threads_free.acquire()
+            try:
+                running = self.loop.run_in_executor(self._executor, self._run, function, args, call)
+                return (yield from asyncio.wait_for(running, timeout, loop=self.loop))
+            except asyncio.TimeoutError:
+                if self._abandon(call):
+                    raise CallAbandoned(call.finished)
+                raise
+            except asyncio.CancelledError:
+                self._abandon(call)
+                raise
+            finally:
+                if not call.keeps_thread:
+                    self._threads_free.release()
+        finally:
+            self._pending -= 1
+            self.completed += 1
+            self._slots.release()
+
+    def stats(self):
+        """
+        :rtype: dict[str, int | float | str]
+        """
+        return {"threads": self.threads, "max_queue": self.max_queue, "policy": self.policy, "active": self.active,
+                "queued": self.queued, "peak_queued": self.peak_queued, "submitted": self.submitted,
+                "completed": self.completed, "rejected": self.rejected, "waited": self.waited,
+                "abandoned": self.abandoned, "abandoned_running": self.abandoned_running,
+                "utilisation": self.utilisation}
+
+    def shutdown(self, wait=False):
+        """
+        Stops the pool's threads once they've finished what they're running
+        :type wait: bool
+        """
+        self._executor.shutdown(wait=wait)
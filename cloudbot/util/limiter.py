@@ -0,0 +1,105 @@
+import asyncio
+
+
+class _Entry:
+    __slots__ = ("semaphore", "users")
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+        # how many tasks are running or waiting under this key
+        self.users = 0
+
+
+class KeyedLimiter:
+    """
+    Limits how many tasks can run at once, separately for each key: for example, one at a time per channel.
+
+    Keys nothing is running or waiting under are forgotten, so any number of keys can be used.
+
+    :type limit: int
+    :type waiting: int
+    :type peak_waiting: int
+    :type waited: int
+    :type dropped: int
+    """
+
+    def __init__(self, limit, *, loop):
+        """
+        :param limit: How many tasks can run at once under each key
+        :type limit: int
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        self.limit = limit
+        self.loop = loop
+        self._entries = {}
+
+        # statistics
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.waited = 0
+        self.dropped = 0
+
+    @property
+    def keys_in_use(self):
+        """
+        :rtype: int
+        """
+        return len(self._entries)
+
+    def _forget(self, key, entry):
+        entry.users -= 1
+        if not entry.users:
+            del self._entries[key]
+
+    @asyncio.coroutine
+    def acquire(self, key, timeout=None):
+        """
+        Waits until there's room to run under <key>, for up to <timeout> seconds. Returns True if there's room (and
+        release(key) must be called once done), or False if there still wasn't room after <timeout> seconds.
+        :type key: collections.Hashable
+        :type timeout: float
+        :rtype: bool
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry(asyncio.Semaphore(self.limit, loop=self.loop))
+        entry.users += 1
+
+        if not entry.semaphore.locked():
+            yield from entry.semaphore.acquire()
+            return True
+
+        self.waited += 1
+        self.waiting += 1
+        if self.waiting > self.peak_waiting:
+            self.peak_waiting = self.waiting
+        try:
+            if timeout:
+                yield from asyncio.wait_for(entry.semaphore.acquire(), timeout, loop=self.loop)
+            else:
+                yield from entry.semaphore.acquire()
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            self._forget(key, entry)
+            return False
+        except asyncio.CancelledError:
+            self._forget(key, entry)
+            raise
+        finally:
+            self.waiting -= 1
+        return True
+
+    def release(self, key):
+        """
+        :type key: collections.Hashable
+        """
+        entry = self._entries[key]
+        entry.semaphore.release()
+        self._forget(key, entry)
+
+    def stats(self):
+        """
+        :rtype: dict[str, int]
+        """
+        return {"limit": self.limit, "keys_in_use": self.keys_in_use, "waiting": self.waiting,
+                "peak_waiting": self.peak_waiting, "waited": self.waited, "dropped": self.dropped}
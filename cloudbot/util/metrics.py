@@ -0,0 +1,334 @@
+"""
+A small metrics registry, exported in the Prometheus text format.
+
+Counters and histograms are updated as things happen. Anything which is already counted somewhere else (like the
+statistics IrcClient and BoundedExecutor keep) is read when the metrics are exported instead, by collectors: functions
+which return (name, type, help, samples) for each metric, where samples is a list of (labels, value).
+"""
+import asyncio
+import functools
+import logging
+import os
+import threading
+
+logger = logging.getLogger("cloudbot")
+
+infinity = float("inf")
+
+# seconds, from half a millisecond to ten seconds
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    """
+    :type value: str
+    :rtype: str
+    """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    """
+    :type labels: dict[str, object] | list[(str, object)]
+    :rtype: str
+    """
+    if not labels:
+        return ""
+    if isinstance(labels, dict):
+        labels = labels.items()
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + "}"
+
+
+def _format_value(value):
+    """
+    :type value: float
+    :rtype: str
+    """
+    if value == infinity:
+        return "+Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """
+    :type name: str
+    :type documentation: str
+    :type label_names: tuple[str]
+    """
+    type = None  # to be assigned in subclasses
+
+    def __init__(self, name, documentation, label_names=()):
+        """
+        :type name: str
+        :type documentation: str
+        :type label_names: tuple[str]
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        # label values -> value
+        self._values = {}
+        # metrics can be updated from threaded hooks
+        self._lock = threading.Lock()
+
+    def _check_labels(self, label_values):
+        if len(label_values) != len(self.label_names):
+            raise ValueError("{} has labels {}, got {!r}".format(self.name, self.label_names, label_values))
+
+    def samples(self):
+        """
+        :rtype: list[(str, list[(str, object)], float)]
+        :return: (name, labels, value) for each sample
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        """
+        :param label_values: A value for each of the counter's labels, in order
+        :type amount: float
+        """
+        self._check_labels(label_values)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        """
+        :rtype: float
+        """
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, list(zip(self.label_names, label_values)), value) for label_values, value in values]
+
+
+class Histogram(Metric):
+    """
+    :type buckets: tuple[float]
+    """
+    type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=default_buckets):
+        """
+        :type name: str
+        :type documentation: str
+        :type label_names: tuple[str]
+        :param buckets: Upper bounds of the buckets, in increasing order
+        :type buckets: tuple[float]
+        """
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (infinity,)
+
+    def observe(self, value, *label_values):
+        """
+        :type value: float
+        :param label_values: A value for each of the histogram's labels, in order
+        """
+        self._check_labels(label_values)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                # [count in each bucket (not cumulative), total count, sum]
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+
+    def get(self, *label_values):
+        """
+        :rtype: (int, float)
+        :return: The number of values observed, and their sum
+        """
+        entry = self._values.get(label_values)
+        if entry is None:
+            return 0, 0
+        return entry[1], entry[2]
+
+    def quantile(self, fraction, *label_values):
+        """
+        Estimates a quantile from the buckets, as the upper bound of the bucket it falls in
+        :type fraction: float
+        :rtype: float
+        """
+        entry = self._values.get(label_values)
+        if entry is None or not entry[1]:
+            return 0
+        wanted = fraction * entry[1]
+        seen = 0
+        for bound, count in zip(self.buckets, entry[0]):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return infinity
+
+    def labels(self):
+        """
+        :rtype: list[tuple]
+        """
+        return list(self._values)
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(entry[0]), entry[1], entry[2])
+                      for label_values, entry in self._values.items()]
+        samples = []
+        for label_values, bucket_counts, count, total in values:
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                samples.append((self.name + "_bucket", labels + [("le", _format_value(bound))], cumulative))
+            samples.append((self.name + "_count", labels, count))
+            samples.append((self.name + "_sum", labels, total))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    :type metrics: dict[str, Metric]
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._collectors = []
+
+    def _register(self, metric_class, name, documentation, label_names, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is not None:
+            if not isinstance(metric, metric_class) or metric.label_names != tuple(label_names):
+                raise ValueError("Metric {} is already registered, differently".format(name))
+            return metric
+        metric = self.metrics[name] = metric_class(name, documentation, label_names, **kwargs)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        """
+        Gets the counter called <name>, creating it if it doesn't exist yet
+        :type name: str
+        :type documentation: str
+        :type label_names: tuple[str]
+        :rtype: Counter
+        """
+        return self._register(Counter, name, documentation, label_names)
+
+    def histogram(self, name, documentation, label_names=(), buckets=default_buckets):
+        """
+        Gets the histogram called <name>, creating it if it doesn't exist yet
+        :type name: str
+        :type documentation: str
+        :type label_names: tuple[str]
+        :type buckets: tuple[float]
+        :rtype: Histogram
+        """
+        return self._register(Histogram, name, documentation, label_names, buckets=buckets)
+
+    def add_collector(self, collector):
+        """
+        :type collector: () -> collections.Iterable[(str, str, str, list[(dict[str, object], float)])]
+        """
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        self._collectors.remove(collector)
+
+    def export(self):
+        """
+        Formats every metric in the Prometheus text format
+        :rtype: str
+        """
+        lines = []
+        for metric in sorted(self.metrics.values(), key=lambda metric: metric.name):
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+        for collector in self._collectors:
+            try:
+                collected = list(collector())
+            except Exception:
+                logger.exception("Error collecting metrics from {}".format(collector))
+                continue
+            for name, metric_type, documentation, samples in collected:
+                lines.append("# HELP {} {}".format(name, documentation))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                for labels, value in samples:
+                    lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+    def write_file(self, path):
+        """
+        Writes the metrics to <path>, replacing it in one go so nothing reading it sees half of them
+        :type path: str
+        """
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.write(self.export())
+        os.replace(temporary_path, path)
+
+    @asyncio.coroutine
+    def write_periodically(self, path, interval, *, loop):
+        """
+        Writes the metrics to <path> every <interval> seconds, until cancelled
+        :type path: str
+        :type interval: float
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        while True:
+            try:
+                self.write_file(path)
+            except OSError:
+                logger.exception("Error writing metrics to {}".format(path))
+            yield from asyncio.sleep(interval, loop=loop)
+
+    @asyncio.coroutine
+    def serve(self, host, port, *, loop):
+        """
+        Starts an HTTP server which answers every request with the metrics
+        :type host: str
+        :type port: int
+        :type loop: asyncio.events.AbstractEventLoop
+        :rtype: asyncio.base_events.Server
+        """
+        return (yield from asyncio.start_server(functools.partial(self._handle_request, loop=loop), host, port,
+                                                loop=loop))
+
+    @asyncio.coroutine
+    def _handle_request(self, reader, writer, *, loop):
+        """
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        try:
+            # read the request line and headers, which are all ignored
+            while True:
+                line = yield from asyncio.wait_for(reader.readline(), 10, loop=loop)
+                if not line.strip():
+                    break
+            body = self.export().encode("utf-8")
+            writer.write(b"HTTP/1.0 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                         b"\r\n" + body)
+            yield from writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
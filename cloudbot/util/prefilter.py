@@ -0,0 +1,198 @@
+"""
+Runs many regexes over the same text, skipping the ones which can't possibly match.
+
+For each regex, the longest literal substring every match must contain is worked out from the parsed pattern (for
+example "youtu" from a youtube link regex, or "\\x01VERSION\\x01" at the very start from a CTCP regex). Each distinct
+literal is looked for once per text, and only the regexes whose literal was found are run. Regexes with no required
+literal are always run.
+
+Every search which is run is timed. A regex which takes longer than max_time on max_strikes searches (for example
+because of catastrophic backtracking) is disabled, since a search in progress can't be interrupted.
+"""
+import logging
+import re
+import sre_constants
+import sre_parse
+import time
+
+logger = logging.getLogger("cloudbot")
+
+_anchors = {sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING}
+
+
+def _required_literals(subpattern, found):
+    """
+    Adds each run of literal characters which any match of <subpattern> must contain to <found>
+    :type subpattern: sre_parse.SubPattern | list
+    :type found: list[str]
+    """
+    run = []
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            found.append("".join(run))
+            run = []
+        if op == sre_constants.SUBPATTERN:
+            # (group, subpattern) before Python 3.6, (group, add_flags, del_flags, subpattern) after
+            if len(av) == 4 and (av[1] or av[2]):
+                # the group changes flags, so its literals might not be matched the way we'd expect
+                continue
+            _required_literals(av[-1], found)
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            _required_literals(av[2], found)
+    if run:
+        found.append("".join(run))
+
+
+def extract_literal(regex):
+    """
+    Works out the longest literal every match of <regex> contains, and whether it must be at the start of the text.
+    Returns (None, False) if there isn't one.
+    :type regex: re.__Regex
+    :rtype: (str, bool)
+    """
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (sre_constants.error, TypeError):
+        return None, False
+    items = list(parsed)
+
+    if items and items[0][0] == sre_constants.AT and items[0][1] in _anchors and not regex.flags & re.MULTILINE:
+        run = []
+        for op, av in items[1:]:
+            if op != sre_constants.LITERAL:
+                break
+            run.append(chr(av))
+        if run:
+            return "".join(run), True
+
+    found = []
+    _required_literals(items, found)
+    if not found:
+        return None, False
+    return max(found, key=len), False
+
+
+class _Entry:
+    __slots__ = ("regex", "value", "literal", "anchored", "fold", "calls", "time", "max_time", "strikes", "disabled")
+
+    def __init__(self, regex, value):
+        self.regex = regex
+        self.value = value
+        self.literal, self.anchored = extract_literal(regex)
+        self.fold = bool(regex.flags & re.IGNORECASE)
+        if self.literal is not None and self.fold:
+            self.literal = self.literal.casefold()
+        self.calls = 0
+        self.time = 0
+        self.max_time = 0
+        self.strikes = 0
+        self.disabled = False
+
+
+class RegexPrefilter:
+    """
+    A set of (regex, value) pairs, searched in the order they were added.
+    :type max_time: float
+    :type max_strikes: int
+    :type skipped: int
+    """
+
+    def __init__(self, *, max_time=0.1, max_strikes=3):
+        """
+        :param max_time: The longest, in seconds, a single search should take
+        :param max_strikes: How many searches may take longer than max_time before a regex is disabled
+        :type max_time: float
+        :type max_strikes: int
+        """
+        self.max_time = max_time
+        self.max_strikes = max_strikes
+        self._entries = []
+        # how many searches have been skipped because their literal wasn't in the text
+        self.skipped = 0
+
+    def add(self, regex, value):
+        """
+        :type regex: re.__Regex
+        """
+        self._entries.append(_Entry(regex, value))
+
+    def remove(self, regex, value):
+        """
+        :type regex: re.__Regex
+        """
+        for index, entry in enumerate(self._entries):
+            if entry.regex is regex and entry.value is value:
+                del self._entries[index]
+                return
+        raise ValueError("{} isn't in the prefilter".format(regex.pattern))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def search(self, text):
+        """
+        Searches <text> with every regex which could match it, yielding (match, value) for each which does
+        :type text: str
+        :rtype: collections.Iterable[(re.__Match, object)]
+        """
+        folded = None
+        # (literal, anchored, fold) -> whether it's in the text, so each literal is only looked for once
+        seen = {}
+        for entry in self._entries:
+            if entry.disabled:
+                continue
+            if entry.literal is not None:
+                key = (entry.literal, entry.anchored, entry.fold)
+                present = seen.get(key)
+                if present is None:
+                    if entry.fold:
+                        if folded is None:
+                            folded = text.casefold()
+                        subject = folded
+                    else:
+                        subject = text
+                    present = subject.startswith(entry.literal) if entry.anchored else entry.literal in subject
+                    seen[key] = present
+                if not present:
+                    self.skipped += 1
+                    continue
+
+            start = time.perf_counter()
+            match = entry.regex.search(text)
+            elapsed = time.perf_counter() - start
+            entry.calls += 1
+            entry.time += elapsed
+            if elapsed > entry.max_time:
+                entry.max_time = elapsed
+            if elapsed > self.max_time:
+                entry.strikes += 1
+                logger.warning("Regex {!r} took {:.3f}s to search {} characters".format(
+                    entry.regex.pattern, elapsed, len(text)))
+                if entry.strikes >= self.max_strikes:
+                    logger.warning("Disabling regex {!r}, it has been too slow {} times".format(
+                        entry.regex.pattern, entry.strikes))
+                    entry.disabled = True
+            if match:
+                yield match, entry.value
+
+    def enable(self, regex):
+        """
+        Re-enables a regex which was disabled for being too slow
+        :type regex: re.__Regex
+        """
+        for entry in self._entries:
+            if entry.regex is regex:
+                entry.disabled = False
+                entry.strikes = 0
+
+    def stats(self):
+        """
+        Gets statistics for each regex
+        :rtype: list[dict[str, object]]
+        """
+        return [{"pattern": entry.regex.pattern, "value": entry.value, "literal": entry.literal,
+                 "anchored": entry.anchored, "calls": entry.calls, "time": entry.time, "max_time": entry.max_time,
+                 "strikes": entry.strikes, "disabled": entry.disabled} for entry in self._entries]
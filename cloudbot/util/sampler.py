@@ -0,0 +1,140 @@
+"""
+A sampling profiler for every thread in the process.
+
+Every 1/<rate> seconds it takes the stack of each thread from sys._current_frames(), and counts how many times each
+stack was seen. Stacks are written in the collapsed format flamegraph.pl and speedscope read: one line per stack, with
+its frames from outermost to innermost separated by semicolons, then the number of samples.
+"""
+from collections import Counter
+import os
+import sys
+import threading
+import time
+
+# (file, function) of frames threads sit in while they're waiting for something to do
+idle_frames = {
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("selectors.py", "poll"),
+    ("thread.py", "_worker"),
+}
+
+
+def _describe(code):
+    """
+    :type code: types.CodeType
+    :rtype: str
+    """
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class Profile:
+    """
+    The results of a SamplingProfiler run
+    :type stacks: collections.Counter[str]
+    :type labels: collections.Counter[str]
+    :type samples: int
+    :type idle: int
+    :type duration: float
+    """
+
+    def __init__(self):
+        self.stacks = Counter()
+        # samples for each label, not counting idle ones
+        self.labels = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.duration = 0
+
+    def top(self, count):
+        """
+        Gets the labels busy threads were seen running most, with the fraction of busy samples for each
+        :type count: int
+        :rtype: list[(str, float)]
+        """
+        busy = self.samples - self.idle
+        if not busy:
+            return []
+        return [(label, samples / busy) for label, samples in self.labels.most_common(count)]
+
+    def write_collapsed(self, path):
+        """
+        :type path: str
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, samples))
+
+
+class SamplingProfiler:
+    """
+    :type rate: float
+    """
+
+    def __init__(self, *, rate=100, attribute=None):
+        """
+        :param rate: Samples to take each second
+        :type rate: float
+        :param attribute: Called with each frame's file name, innermost first, to find what the sample should be
+                          counted against; returns a label, or None to try the next frame out. Stacks are written with
+                          their label as the outermost frame, so they're grouped by it.
+        :type attribute: (str) -> str
+        """
+        self.rate = rate
+        self.attribute = attribute
+
+    def _label(self, frame):
+        """
+        :type frame: types.FrameType
+        :rtype: str
+        """
+        if self.attribute is not None:
+            while frame is not None:
+                label = self.attribute(frame.f_code.co_filename)
+                if label is not None:
+                    return label
+                frame = frame.f_back
+        return "other"
+
+    def run(self, duration):
+        """
+        Samples every other thread for <duration> seconds. This blocks, so it should be run in a thread of its own.
+        :type duration: float
+        :rtype: Profile
+        """
+        profile = Profile()
+        this_thread = threading.get_ident()
+        interval = 1 / self.rate
+        start = time.perf_counter()
+        end = start + duration
+        next_sample = start
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            if now < next_sample:
+                time.sleep(next_sample - now)
+            next_sample += interval
+
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == this_thread:
+                    continue
+                profile.samples += 1
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in idle_frames:
+                    profile.idle += 1
+                    label = "idle"
+                else:
+                    label = self._label(frame)
+                    profile.labels[label] += 1
+                frames = []
+                while frame is not None:
+                    frames.append(_describe(frame.f_code))
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, "thread {}".format(thread_id)))
+                frames.append(label)
+                profile.stacks[";".join(reversed(frames))] += 1
+        profile.duration = time.perf_counter() - start
+        return profile
@@ -0,0 +1,188 @@
+"""
+Notices when the event loop is blocked, and finds out what's blocking it.
+
+A heartbeat task on the loop wakes up every <interval> seconds, and a watchdog thread checks that it has. If the
+heartbeat is more than <threshold> seconds late, the loop is stuck running something, so the watchdog looks at what
+the loop's thread is running, and logs it. Once the loop gets going again, the heartbeat records how long it was
+stuck, and what it was stuck on.
+"""
+import asyncio
+from collections import deque
+import logging
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger("cloudbot")
+
+
+class StallStats:
+    """
+    :type count: int
+    :type total: float
+    :type longest: float
+    :type last_stack: list
+    """
+    __slots__ = ("count", "total", "longest", "last_stack")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.longest = 0
+        self.last_stack = None
+
+
+class _Sample:
+    __slots__ = ("beat", "culprit", "stack")
+
+    def __init__(self, beat, culprit, stack):
+        self.beat = beat
+        self.culprit = culprit
+        self.stack = stack
+
+
+class StallDetector:
+    """
+    :type threshold: float
+    :type interval: float
+    :type lag: float
+    :type peak_lag: float
+    :type stalls: int
+    :type stats: dict[str, StallStats]
+    :type recent: collections.deque[(float, str, float)]
+    """
+    unknown = "unknown"
+
+    def __init__(self, loop, *, threshold=0.5, interval=0.1, attribute=None):
+        """
+        :param threshold: Seconds the loop can be blocked for before it's counted as a stall
+        :type threshold: float
+        :param interval: Seconds between heartbeats, and between the watchdog's checks
+        :type interval: float
+        :param attribute: Called (in the watchdog thread) with the innermost frame the loop is running when it's
+                          stalled, to name whatever's responsible. May return None if it can't tell.
+        :type attribute: (types.FrameType) -> str
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.attribute = attribute
+
+        self._thread_id = None
+        self._heartbeat_task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        # these are written by the heartbeat, and read by the watchdog
+        self._last_beat = time.monotonic()
+        self._beats = 0
+        # written by the watchdog, and read by the heartbeat
+        self._sample = None
+
+        # statistics
+        self.lag = 0
+        self.peak_lag = 0
+        self.stalls = 0
+        self.stats = {}
+        self.recent = deque(maxlen=20)
+
+    @property
+    def running(self):
+        """
+        :rtype: bool
+        """
+        return self._watchdog is not None
+
+    def start(self):
+        """
+        Starts the heartbeat and the watchdog. This must be called from the loop's thread.
+        """
+        if self.running:
+            return
+        self._thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._last_beat = time.monotonic()
+        self._heartbeat_task = asyncio.async(self._heartbeat(), loop=self.loop)
+        self._watchdog = threading.Thread(target=self._watch, name="Stall detector", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stopped.set()
+        self._heartbeat_task.cancel()
+        self._heartbeat_task = None
+        self._watchdog = None
+
+    @asyncio.coroutine
+    def _heartbeat(self):
+        while True:
+            before = time.monotonic()
+            yield from asyncio.sleep(self.interval, loop=self.loop)
+            now = time.monotonic()
+            self._last_beat = now
+            lag = max(now - before - self.interval, 0)
+            self.lag = lag
+            if lag > self.peak_lag:
+                self.peak_lag = lag
+            sample, self._sample = self._sample, None
+            if lag >= self.threshold:
+                if sample is None or sample.beat != self._beats:
+                    # the watchdog didn't see this one happen
+                    sample = None
+                self._record(lag, sample)
+            self._beats += 1
+
+    def _record(self, lag, sample):
+        """
+        :type lag: float
+        :type sample: _Sample
+        """
+        culprit = sample.culprit if sample is not None else self.unknown
+        stats = self.stats.get(culprit)
+        if stats is None:
+            stats = self.stats[culprit] = StallStats()
+        stats.count += 1
+        stats.total += lag
+        if lag > stats.longest:
+            stats.longest = lag
+        if sample is not None:
+            stats.last_stack = sample.stack
+        self.stalls += 1
+        self.recent.append((time.time(), culprit, lag))
+        logger.warning("Event loop was blocked for {:.2f}s by {}".format(lag, culprit))
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._beats
+            blocked = time.monotonic() - self._last_beat - self.interval
+            if blocked < self.threshold or self._sample is not None:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            culprit = None
+            if self.attribute is not None:
+                try:
+                    culprit = self.attribute(frame)
+                except Exception:
+                    logger.exception("Error finding what's blocking the event loop")
+            stack = traceback.extract_stack(frame)
+            del frame
+            self._sample = _Sample(beat, culprit or self.unknown, stack)
+            logger.warning("Event loop has been blocked for {:.2f}s, in {}:\n{}".format(
+                blocked, culprit or self.unknown, "".join(traceback.format_list(stack)).rstrip()))
+
+    def worst(self, count=5):
+        """
+        Gets whatever has stalled the loop for longest in total, longest first
+        :type count: int
+        :rtype: list[(str, StallStats)]
+        """
+        return sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)[:count]
+
+    def clear(self):
+        self.stalls = 0
+        self.stats.clear()
+        self.recent.clear()
@@ -0,0 +1,204 @@
+"""
+Optional tracing of incoming lines through the bot, written as Chrome trace events.
+
+Each sampled line gets a Trace, with an ID, when it's dispatched. Spans are recorded against the trace as the line goes
+through the dispatch queue, CloudBot.process, each hook's sieves and executor, the hook itself, and any replies it
+sends out through the connection's send queue. The trace file can be loaded in chrome://tracing or Perfetto, where each
+trace is shown as its own row.
+"""
+import asyncio
+from collections import deque
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger("cloudbot")
+
+# the trace of whatever's running in this thread, for code which doesn't have the event, like IrcClient.send
+_local = threading.local()
+
+
+def current_trace():
+    """
+    Gets the trace of the event whose hook is sending something in this thread, if it's being traced
+    :rtype: Trace
+    """
+    return getattr(_local, "trace", None)
+
+
+def now():
+    """
+    :return: The current time in microseconds, for trace events
+    :rtype: float
+    """
+    return time.perf_counter() * 1000000
+
+
+class _NullSpan:
+    """
+    What span() returns for events which aren't being traced
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(trace, name, *, activate=False, **args):
+    """
+    Records how long a with block takes against <trace>, or does nothing if <trace> is None
+    :param activate: Whether to make <trace> the current_trace() in this thread during the block
+    :type trace: Trace
+    :type name: str
+    :type activate: bool
+    """
+    if trace is None:
+        return _null_span
+    return _Span(trace, name, args, activate)
+
+
+class _Span:
+    __slots__ = ("trace", "name", "args", "activate", "start", "previous")
+
+    def __init__(self, trace, name, args, activate):
+        self.trace = trace
+        self.name = name
+        self.args = args
+        self.activate = activate
+        self.start = None
+        self.previous = None
+
+    def __enter__(self):
+        if self.activate:
+            self.previous = getattr(_local, "trace", None)
+            _local.trace = self.trace
+        self.start = now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.add(self.name, self.start, now(), **self.args)
+        if self.activate:
+            _local.trace = self.previous
+        return False
+
+
+class Trace:
+    """
+    :type trace_id: int
+    :type start: float
+    """
+    __slots__ = ("tracer", "trace_id", "start")
+
+    def __init__(self, tracer, trace_id, start=None):
+        """
+        :type tracer: Tracer
+        :type trace_id: int
+        :param start: When the trace started, from now(), if not now
+        :type start: float
+        """
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.start = now() if start is None else start
+
+    def span(self, name, *, activate=False, **args):
+        """
+        Records how long a with block takes
+        :param activate: Whether to make this the current_trace() in this thread during the block
+        :type name: str
+        :type activate: bool
+        """
+        return _Span(self, name, args, activate)
+
+    def add(self, name, start, end, **args):
+        """
+        Records a span which has already finished
+        :param start: Microseconds, from now()
+        :param end: Microseconds, from now()
+        :type name: str
+        :type start: float
+        :type end: float
+        """
+        args["trace"] = self.trace_id
+        self.tracer.record({"name": name, "cat": "cloudbot", "ph": "X", "ts": start, "dur": end - start,
+                            "pid": self.tracer.pid, "tid": self.trace_id, "args": args})
+
+
+class Tracer:
+    """
+    :type path: str
+    :type sample_rate: float
+    :type traces_started: int
+    """
+
+    def __init__(self, path, *, sample_rate=1.0, max_events=100000):
+        """
+        :param path: The file to write the trace events to
+        :type path: str
+        :param sample_rate: The fraction of lines to trace
+        :type sample_rate: float
+        :param max_events: How many of the latest spans to keep
+        :type max_events: int
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.pid = os.getpid()
+        self._events = deque(maxlen=max_events)
+        # spans are recorded from threaded hooks as well as the event loop
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.traces_started = 0
+
+    def start_trace(self, start=None):
+        """
+        Starts a new trace, or returns None if this one isn't sampled
+        :param start: When the trace started, from now(), if not now
+        :type start: float
+        :rtype: Trace
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        self.traces_started += 1
+        return Trace(self, next(self._ids), start)
+
+    def record(self, trace_event):
+        """
+        :type trace_event: dict
+        """
+        with self._lock:
+            self._events.append(trace_event)
+
+    def write(self):
+        """
+        Writes every span kept so far to the trace file, replacing it in one go
+        """
+        with self._lock:
+            events = list(self._events)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        os.replace(temporary_path, self.path)
+
+    @asyncio.coroutine
+    def write_periodically(self, interval, *, loop):
+        """
+        Writes the trace file every <interval> seconds, until cancelled. Serialising a full buffer of spans takes long
+        enough to stall the loop, so it's done in the loop's default executor.
+        :type interval: float
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        while True:
+            yield from asyncio.sleep(interval, loop=loop)
+            try:
+                yield from loop.run_in_executor(None, self.write)
+            except OSError:
+                logger.exception("Error writing trace events to {}".format(self.path))
@@ -0,0 +1,124 @@
+class _Node:
+    __slots__ = ("children", "key", "value", "count")
+
+    def __init__(self):
+        # character -> _Node
+        self.children = {}
+        # the key ending at this node, or None if no key ends here
+        self.key = None
+        self.value = None
+        # how many keys end at or below this node
+        self.count = 0
+
+
+class PrefixTrie:
+    """
+    A mapping from strings to values, which can also find every key starting with a given prefix.
+
+    Looking up a key, or the only key starting with a prefix, takes time proportional to the length of the key.
+    Listing every key starting with a prefix takes time proportional to the size of the listing.
+
+    >>> trie = PrefixTrie()
+    >>> trie["help"] = 1
+    >>> trie["hello"] = 2
+    >>> trie.prefixed("hel")
+    [('hello', 2), ('help', 1)]
+    """
+
+    def __init__(self):
+        self._root = _Node()
+
+    def _find(self, key):
+        """
+        :type key: str
+        :rtype: _Node
+        """
+        node = self._root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def __setitem__(self, key, value):
+        """
+        :type key: str
+        """
+        if key in self:
+            self._find(key).value = value
+            return
+        node = self._root
+        node.count += 1
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = _Node()
+            node = child
+            node.count += 1
+        node.key = key
+        node.value = value
+
+    def __getitem__(self, key):
+        """
+        :type key: str
+        """
+        node = self._find(key)
+        if node is None or node.key is None:
+            raise KeyError(key)
+        return node.value
+
+    def __delitem__(self, key):
+        """
+        :type key: str
+        """
+        if key not in self:
+            raise KeyError(key)
+        node = self._root
+        node.count -= 1
+        for char in key:
+            child = node.children[char]
+            child.count -= 1
+            if not child.count:
+                # nothing else is below this, so drop the whole branch
+                del node.children[char]
+                return
+            node = child
+        node.key = None
+        node.value = None
+
+    def __contains__(self, key):
+        node = self._find(key)
+        return node is not None and node.key is not None
+
+    def __len__(self):
+        return self._root.count
+
+    def get(self, key, default=None):
+        """
+        :type key: str
+        """
+        node = self._find(key)
+        if node is None or node.key is None:
+            return default
+        return node.value
+
+    def prefixed(self, prefix):
+        """
+        Gets every key starting with <prefix> (including <prefix> itself), and its value, in sorted order
+        :type prefix: str
+        :rtype: list[(str, object)]
+        """
+        node = self._find(prefix)
+        if node is None:
+            return []
+        found = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.key is not None:
+                found.append((node.key, node.value))
+            if node.count == 1 and node.key is not None:
+                continue
+            # push children in reverse so they're popped (and found) in sorted order
+            stack.extend(node.children[char] for char in sorted(node.children, reverse=True))
+        return found
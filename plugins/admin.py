@@ -155,6 +155,7 @@ def remove_permission_user(text, bot, conn, notice, reply):
     if changed:
         bot.config.save_config()
         permission_manager.reload()
+        bot.plugin_manager.clear_sieve_cache()
 
 
 @asyncio.coroutine
@@ -197,6 +198,7 @@ def add_permissions_user(text, conn, bot, notice, reply):
     if changed:
         bot.config.save_config()
         permission_manager.reload()
+        bot.plugin_manager.clear_sieve_cache()
 
 
 @asyncio.coroutine
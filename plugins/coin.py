@@ -5,7 +5,7 @@ from cloudbot import hook
 
 
 @asyncio.coroutine
-@hook.command(autohelp=False)
+@hook.command(autohelp=False, inline=True)
 def coin(text, notice, action):
     """[amount] - flips [amount] coins
     :type text: str
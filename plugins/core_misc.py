@@ -21,7 +21,7 @@ def invite(irc_paramlist, conn):
 
 # Identify to NickServ (or other service)
 @asyncio.coroutine
-@hook.irc_raw('004')
+@hook.irc_raw('004', timeout=0)
 def onjoin(conn, bot):
     """
     :type conn: cloudbot.clients.irc.IrcClient
@@ -29,7 +29,10 @@ def onjoin(conn, bot):
     """
     bot.logger.info("ONJOIN hook triggered.")
     nickserv = conn.config.get('nickserv')
-    if nickserv and nickserv.get("enabled", True):
+    if getattr(conn, "sasl_authenticated", False):
+        # we're already identified, so there's no need to wait for nickserv
+        bot.logger.info("Authenticated using SASL, not identifying with NickServ.")
+    elif nickserv and nickserv.get("enabled", True):
         nickserv_password = nickserv.get('nickserv_password', '')
         nickserv_name = nickserv.get('nickserv_name', 'nickserv')
         nickserv_account_name = nickserv.get('nickserv_user', '')
@@ -61,7 +64,7 @@ def onjoin(conn, bot):
 
 
 @asyncio.coroutine
-@hook.irc_raw('004')
+@hook.irc_raw('004', timeout=0)
 def keep_alive(conn):
     """
     :type conn: cloudbot.clients.irc.IrcClient
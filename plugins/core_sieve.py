@@ -1,5 +1,3 @@
-import asyncio
-
 from cloudbot import hook
 from cloudbot.plugin import HookType
 from cloudbot.util import bucket
@@ -11,10 +9,10 @@ MESSAGE_COST = 5
 buckets = {}
 
 
-@asyncio.coroutine
-@hook.sieve
-def sieve_suite(bot, event, _hook):
+@hook.sieve(pure=True)
+def sieve_acls(bot, event, _hook):
     """
+    The checks which only depend on who sent the event and where, so their results can be cached
     :type bot: cloudbot.bot.CloudBot
     :type event: cloudbot.event.Event
     :type _hook: cloudbot.plugin.Hook
@@ -36,6 +34,18 @@ def sieve_suite(bot, event, _hook):
             if event.chan.lower() in denied_channels:
                 return None
 
+    return event
+
+
+@hook.sieve(sync=True)
+def sieve_suite(bot, event, _hook):
+    """
+    :type bot: cloudbot.bot.CloudBot
+    :type event: cloudbot.event.Event
+    :type _hook: cloudbot.plugin.Hook
+    """
+    conn = event.conn
+
     # check disabled_commands
     if _hook.type is HookType.command:
         disabled_commands = conn.config.get('disabled_commands', [])
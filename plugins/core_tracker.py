@@ -21,8 +21,7 @@ def on_kick(conn, chan, nick):
     """
     # if the bot has been kicked, remove from the channel list
     if nick == conn.nick:
-        if chan in conn.channels:
-            conn.channels.remove(chan)
+        conn.channels.discard(chan)
         if conn.config.get('auto_rejoin', False):
             conn.join(chan)
 
@@ -37,8 +36,8 @@ def on_nick(irc_paramlist, conn, irc_raw):
     """
     old_nick = nick_re.search(irc_raw).group(1)
     new_nick = str(irc_paramlist[0])
-    if old_nick == conn.nick:
-        conn.nick = new_nick
+    if new_nick.lstrip(":") == conn.nick:
+        # the client follows its own nick changes as soon as the server tells it about them
         logger.info("Bot nick changed from '{}' to '{}'.".format(old_nick, new_nick))
 
 
@@ -53,5 +52,4 @@ def on_join(conn, chan, nick):
     :type nick: str
     """
     if nick == conn.nick:
-        if chan not in conn.channels:
-            conn.channels.append(chan)
+        conn.channels.append(chan)
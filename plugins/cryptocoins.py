@@ -1,6 +1,7 @@
 import requests
 
 from cloudbot import hook
+from cloudbot.util.cache import UncachedReply
 
 
 ## CONSTANTS
@@ -32,8 +33,8 @@ exchanges = {
 
 ## HOOK FUNCTIONS
 
-@hook.command("btc", "bitcoin", autohelp=False)
-def bitcoin(text, notice):
+@hook.command("btc", "bitcoin", autohelp=False, cache_ttl=30, coalesce=True)
+def bitcoin(text):
     """[mtgox|bitpay|coinbase|bitstamp] - gets bitcoin exchange rate using <exchange>, defaulting to blockchain
     :type text: str
     """
@@ -44,15 +45,15 @@ def bitcoin(text, notice):
             exchange = exchanges[text]
         else:
             valid_exchanges = list(exchanges.keys())
-            notice("Invalid exchange '{}', valid exchanges are {} and {}".format(text, ", ".join(valid_exchanges[:-1]),
-                                                                                 valid_exchanges[-1]))
-            return
+            raise UncachedReply("Invalid exchange '{}', valid exchanges are {} and {}".format(
+                text, ", ".join(valid_exchanges[:-1]), valid_exchanges[-1]), notice=True)
     else:
         exchange = exchanges["blockchain"]
 
     response = requests.get(exchange["api_url"])
     if response.status_code != requests.codes.ok:
-        return "Error reaching {}: {}".format(text or "blockchain", response.status_code)
+        # don't keep the error around for cache_ttl
+        raise UncachedReply("Error reaching {}: {}".format(text or "blockchain", response.status_code))
     func = exchange["func"]
     return func(response.json())
 
@@ -7,6 +7,7 @@ from sqlalchemy import Table, Column, String
 import requests
 
 from cloudbot import hook
+from cloudbot.client import Priority
 from cloudbot.util import botvars, formatting, web
 
 re_lineends = re.compile(r'[\r\n]*')
@@ -189,10 +190,10 @@ def listfactoids(notice):
     for word in factoid_cache.keys():
         added_length = len(word) + 2
         if reply_text_length + added_length > 400:
-            notice(", ".join(reply_text))
+            notice(", ".join(reply_text), priority=Priority.bulk)
             reply_text = []
             reply_text_length = 0
         else:
             reply_text.append(word)
             reply_text_length += added_length
-    notice(", ".join(reply_text))
+    notice(", ".join(reply_text), priority=Priority.bulk)
@@ -3,6 +3,7 @@ import asyncio
 import re
 
 from cloudbot import hook
+from cloudbot.client import Priority
 
 
 @asyncio.coroutine
@@ -79,5 +80,6 @@ def help_command(text, conn, bot, notice, has_permission):
 
         notice("Here's a list of commands you can use:")
         for line in lines:
-            notice(line)
-        notice("For detailed help, use {}help <command>, without the brackets.".format(conn.config["command_prefix"]))
+            notice(line, priority=Priority.bulk)
+        notice("For detailed help, use {}help <command>, without the brackets.".format(conn.config["command_prefix"]),
+               priority=Priority.bulk)
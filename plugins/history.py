@@ -52,7 +52,8 @@ def track_history(event, message_time, conn):
     history.append(data)
 
 
-@hook.event([EventType.message, EventType.action], ignorebots=False, singlethread=True)
+@hook.event([EventType.message, EventType.action], ignorebots=False, max_concurrency=1,
+            concurrency_key=("conn", "chan"))
 def chat_tracker(event, db, conn):
     """
     :type db: sqlalchemy.orm.Session
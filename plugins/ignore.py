@@ -2,7 +2,6 @@ import asyncio
 from fnmatch import fnmatch
 
 from cloudbot import hook
-from cloudbot.event import EventType
 from cloudbot.plugin import HookType
 
 
@@ -25,7 +24,7 @@ def ensure_ignored(bot):
 
 
 @asyncio.coroutine
-@hook.sieve()
+@hook.sieve(pure=True)
 def ignore_sieve(bot, event, _hook):
     """ blocks events from ignored channels/hosts
     :type bot: cloudbot.bot.CloudBot
@@ -36,8 +35,8 @@ def ignore_sieve(bot, event, _hook):
     if _hook.type is HookType.event:
         return event
 
-    # don't block an event that could be unignoring
-    if event.type is EventType.message and event.content[1:] == "unignore":
+    # don't block unignoring
+    if _hook.type is HookType.command and _hook.function_name == "unignore":
         return event
 
     if event.mask is None:
@@ -80,6 +79,7 @@ def ignore(text, bot, conn, notice):
         ignorelist.append(target)
         ignorelist.sort()
         bot.config.save_config()
+        bot.plugin_manager.clear_sieve_cache()
     return
 
 
@@ -95,6 +95,7 @@ def unignore(text, bot, conn, notice):
         ignorelist.remove(target)
         ignorelist.sort()
         bot.config.save_config()
+        bot.plugin_manager.clear_sieve_cache()
     else:
         notice("{} is not ignored.".format(target))
     return
@@ -198,7 +198,7 @@ def get_raw_log_stream(server):
     return log_stream
 
 
-@hook.irc_raw("*", singlethread=True)
+@hook.irc_raw("*", max_concurrency=1, concurrency_key="conn")
 def log_raw(event):
     """
     :type event: cloudbot.event.Event
@@ -210,7 +210,7 @@ def log_raw(event):
     get_raw_log_stream(event.conn.name).write(event.irc_raw + "\n")
 
 
-@hook.irc_raw("*", singlethread=True)
+@hook.irc_raw("*", max_concurrency=1, concurrency_key=("conn", "chan"))
 def log(event):
     """
     :type event: cloudbot.event.Event
@@ -0,0 +1,18 @@
+import asyncio
+
+from cloudbot import hook
+
+
+@asyncio.coroutine
+@hook.command("more", autohelp=False)
+def more(conn, chan, nick, notice):
+    """- shows the next part of my last message which was too long to send at once
+    :type conn: cloudbot.clients.irc.IrcClient
+    :type chan: str
+    :type nick: str
+    """
+    if not hasattr(conn, "send_more"):
+        return
+    # check messages sent to the user first, then messages sent to this channel
+    if not conn.send_more(nick) and not conn.send_more(chan):
+        notice("There's nothing more to show.")
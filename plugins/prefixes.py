@@ -4,7 +4,7 @@ import re
 from sqlalchemy import Table, Column, String, UniqueConstraint
 
 from cloudbot import hook
-from cloudbot.events import CommandEvent
+from cloudbot.event import CommandEvent
 from cloudbot.util import formatting, botvars
 
 
@@ -116,22 +116,12 @@ def run_extra_prefix(event, bot, conn, chan, content):
         match = chan_re[key].match(content)
         if match:
             command = match.group(2).lower()
-            if command in bot.plugin_manager.commands:
-                command_hook = bot.plugin_manager.commands[command]
-                event = CommandEvent(triggered_command=command, hook=command_hook, text=match.group(3).strip(),
-                                     base_event=event)
+            potential_matches = bot.plugin_manager.find_commands(command)
+            if len(potential_matches) == 1:
+                command_hook = potential_matches[0][1]
+                event = CommandEvent.view(event, command_hook, text=match.group(3).strip(),
+                                          triggered_command=command)
                 yield from bot.plugin_manager.launch(command_hook, event)
-            else:
-                potential_matches = []
-                for potential_match, plugin in bot.plugin_manager.commands.items():
-                    if potential_match.startswith(command):
-                        potential_matches.append((potential_match, plugin))
-                if potential_matches:
-                    if len(potential_matches) == 1:
-                        command_hook = potential_matches[0][1]
-                        event = CommandEvent(triggered_command=command, hook=command_hook, text=match.group(3).strip(),
-                                             base_event=event)
-                        yield from bot.plugin_manager.launch(command_hook, event)
-                    else:
-                        event.notice("Possible matches: {}".format(
-                            formatting.get_text_list([command for command, plugin in potential_matches])))
+            elif potential_matches:
+                event.notice("Possible matches: {}".format(
+                    formatting.get_text_list([command for command, plugin in potential_matches])))
@@ -1,7 +1,9 @@
 import asyncio
+import logging
 import os
 import signal
 import threading
+import time
 import traceback
 import sys
 
@@ -24,6 +26,14 @@ except ImportError:
 
 from cloudbot import hook
 from cloudbot.util import web
+from cloudbot.util.sampler import SamplingProfiler
+
+logger = logging.getLogger("cloudbot")
+
+# only one profile runs at a time, whether it's started by .profile or SIGUSR2
+profile_lock = threading.Lock()
+# the bot, for the SIGUSR2 handler
+profiled_bot = None
 
 
 def get_name(thread_id):
@@ -70,6 +80,159 @@ def threaddump_command():
     return get_thread_dump()
 
 
+@asyncio.coroutine
+@hook.command("stalls", autohelp=False, permissions=["botcontrol"])
+def stalls_command(text, bot, notice):
+    """[hook|clear] - shows which hooks have blocked the event loop the longest, or where [hook] last blocked it
+    :type text: str
+    :type bot: cloudbot.bot.CloudBot
+    """
+    detector = bot.stall_detector
+    if detector is None:
+        return "The stall detector is disabled"
+    text = text.strip()
+    if text == "clear":
+        detector.clear()
+        return "Cleared stall statistics"
+    if text:
+        stats = detector.stats.get(text)
+        if stats is None:
+            return "{} hasn't blocked the event loop".format(text)
+        if stats.last_stack is None:
+            return "{} blocked the event loop {} times, but its stack wasn't caught".format(text, stats.count)
+        # the innermost frames are the interesting ones
+        for filename, line_num, name, line in stats.last_stack[-5:]:
+            notice("{}:{} - {}: {}".format(os.path.basename(filename), line_num, name, (line or "").strip()))
+        return
+    if not detector.stats:
+        return "No stalls longer than {}s".format(detector.threshold)
+    return "{} stalls longer than {}s. Worst: {}".format(detector.stalls, detector.threshold, ", ".join(
+        "{} ({}x, {:.2f}s total, {:.2f}s max)".format(culprit, stats.count, stats.total, stats.longest)
+        for culprit, stats in detector.worst()))
+
+
+@asyncio.coroutine
+@hook.command("metrics", autohelp=False, permissions=["botcontrol"])
+def metrics_command(bot):
+    """- summarises the bot's metrics
+    :type bot: cloudbot.bot.CloudBot
+    """
+    plugin_manager = bot.plugin_manager
+    lines = ["Lines in/out: " + ", ".join("{} {}/{}".format(conn.name, conn.lines_received, conn.lines_sent)
+                                          for conn in bot.connections)]
+
+    hook_times = plugin_manager.hook_seconds
+    hooks = sorted(hook_times.labels(), key=lambda labels: hook_times.get(*labels)[1], reverse=True)[:5]
+    if hooks:
+        lines.append("Slowest hooks: " + ", ".join(
+            "{} ({} calls, {:.0f} errors, {:.2f}s total, p99 <= {}s)".format(
+                description, hook_times.get(description)[0], plugin_manager.hook_errors.get(description),
+                hook_times.get(description)[1], hook_times.quantile(0.99, description))
+            for description, in hooks))
+
+    rejections = plugin_manager.sieve_rejections.samples()
+    executors = ", ".join("{} {}/{} busy, {} queued".format(name, executor.active, executor.threads, executor.queued)
+                          for name, executor in sorted(plugin_manager.executors.items()))
+    summary = "Sieve rejections: {:.0f}. Executors: {}.".format(sum(value for name, labels, value in rejections),
+                                                               executors)
+    if bot.stall_detector is not None:
+        summary += " Loop lag: {:.3f}s (peak {:.3f}s, {} stalls).".format(
+            bot.stall_detector.lag, bot.stall_detector.peak_lag, bot.stall_detector.stalls)
+    lines.append(summary)
+    return lines
+
+
+def run_profile(bot, seconds):
+    """
+    Samples every thread for <seconds>, and writes the stacks to a file in the logs directory. This blocks. It must be
+    called holding profile_lock, which is released once the profile is done, even if whatever asked for it has
+    stopped waiting.
+    :type bot: cloudbot.bot.CloudBot
+    :type seconds: float
+    :rtype: (cloudbot.util.sampler.Profile, str)
+    """
+    try:
+        return _run_profile(bot, seconds)
+    finally:
+        profile_lock.release()
+
+
+def _run_profile(bot, seconds):
+    """
+    :type bot: cloudbot.bot.CloudBot
+    :type seconds: float
+    :rtype: (cloudbot.util.sampler.Profile, str)
+    """
+    core_dir = os.path.dirname(os.path.abspath(cloudbot.__file__))
+    titles = {os.path.abspath(plugin.file_path): plugin.title for plugin in bot.plugin_manager.plugins.values()}
+    labels = {}
+
+    def attribute(filename):
+        # the innermost frame from a plugin's file gets the sample, so time spent in libraries goes to their caller
+        try:
+            return labels[filename]
+        except KeyError:
+            path = os.path.abspath(filename)
+            label = titles.get(path)
+            if label is None and path.startswith(core_dir):
+                label = "core"
+            labels[filename] = label
+            return label
+
+    profiler = SamplingProfiler(rate=bot.config.get("profiler", {}).get("rate", 100), attribute=attribute)
+    profile = profiler.run(seconds)
+
+    log_dir = os.path.join(os.path.abspath(os.path.curdir), "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    path = os.path.join(log_dir, "profile-{}.collapsed".format(time.strftime("%Y%m%d-%H%M%S")))
+    profile.write_collapsed(path)
+    return profile, path
+
+
+def summarise_profile(bot, profile, path):
+    """
+    :type bot: cloudbot.bot.CloudBot
+    :type profile: cloudbot.util.sampler.Profile
+    :type path: str
+    :rtype: str
+    """
+    top = profile.top(bot.config.get("profiler", {}).get("top", 5))
+    busy = profile.samples - profile.idle
+    if not top:
+        summary = "nothing was running"
+    else:
+        summary = ", ".join("{} {:.0%}".format(label, share) for label, share in top)
+    return "Profiled {:.1f}s, {} samples ({} busy): {}. Stacks written to {}".format(
+        profile.duration, profile.samples, busy, summary, path)
+
+
+@asyncio.coroutine
+@hook.command("profile", permissions=["botcontrol"], timeout=0)
+def profile_command(text, bot, notice):
+    """<seconds> - samples what every thread is running for <seconds>, writing flamegraph stacks to the logs directory
+    :type text: str
+    :type bot: cloudbot.bot.CloudBot
+    """
+    try:
+        seconds = float(text.strip())
+    except ValueError:
+        return "Invalid number of seconds: {}".format(text.strip())
+    max_seconds = bot.config.get("profiler", {}).get("max_seconds", 300)
+    if not 0 < seconds <= max_seconds:
+        return "The number of seconds must be between 0 and {}".format(max_seconds)
+    if not profile_lock.acquire(blocking=False):
+        return "A profile is already running"
+    notice("Profiling for {}s".format(seconds))
+    profile, path = yield from bot.loop.run_in_executor(None, run_profile, bot, seconds)
+    notice(summarise_profile(bot, profile, path))
+
+
+@hook.onload()
+def remember_bot(bot):
+    global profiled_bot
+    profiled_bot = bot
+
+
 @hook.command("objtypes", autohelp=False, permissions=["botcontrol"])
 def show_types():
     if objgraph is None:
@@ -117,3 +280,20 @@ if os.name == "posix":
         print(get_thread_dump())
 
     signal.signal(signal.SIGUSR1, debug)  # Register handler
+
+    # and to profile the bot, by using SIGUSR2
+    def profile_in_background():
+        bot = profiled_bot
+        try:
+            profile, path = run_profile(bot, bot.config.get("profiler", {}).get("signal_seconds", 30))
+            logger.info(summarise_profile(bot, profile, path))
+        except Exception:
+            logger.exception("Error profiling the bot")
+
+    def start_profile(sig, frame):
+        if profiled_bot is None or not profile_lock.acquire(blocking=False):
+            return
+        # the handler runs in the event loop's thread, which the profile needs to watch rather than block
+        threading.Thread(target=profile_in_background, name="Profiler", daemon=True).start()
+
+    signal.signal(signal.SIGUSR2, start_profile)
@@ -54,7 +54,7 @@ def delete_status(db, conn, chan):
     db.commit()
 
 
-@hook.sieve()
+@hook.sieve(pure=True)
 def sieve_regex(bot, event, _hook):
     if _hook.type == "regex" and event.chan.startswith("#") and _hook.plugin.title != "factoids":
         status = status_cache.get((event.conn.name, event.chan))
@@ -67,7 +67,7 @@ def sieve_regex(bot, event, _hook):
 
 
 @hook.command(autohelp=False, permissions=["botcontrol"])
-def enableregex(text, db, conn, chan, nick, message, notice):
+def enableregex(text, db, conn, bot, chan, nick, message, notice):
     text = text.strip().lower()
     if not text:
         channel = chan
@@ -80,10 +80,11 @@ def enableregex(text, db, conn, chan, nick, message, notice):
     notice("Enabling regex matching (youtube, etc) in channel {}".format(channel))
     set_status(db, conn.name, channel, "ENABLED")
     load_cache(db)
+    bot.plugin_manager.clear_sieve_cache()
 
 
 @hook.command(autohelp=False, permissions=["botcontrol"])
-def disableregex(text, db, conn, chan, nick, message, notice):
+def disableregex(text, db, conn, bot, chan, nick, message, notice):
     text = text.strip().lower()
     if not text:
         channel = chan
@@ -96,10 +97,11 @@ def disableregex(text, db, conn, chan, nick, message, notice):
     notice("Disabling regex matching (youtube, etc) in channel {}".format(channel))
     set_status(db, conn.name, channel, "DISABLED")
     load_cache(db)
+    bot.plugin_manager.clear_sieve_cache()
 
 
 @hook.command(autohelp=False, permissions=["botcontrol"])
-def resetregex(text, db, conn, chan, nick, message, notice):
+def resetregex(text, db, conn, bot, chan, nick, message, notice):
     text = text.strip().lower()
     if not text:
         channel = chan
@@ -112,6 +114,7 @@ def resetregex(text, db, conn, chan, nick, message, notice):
     notice("Resetting regex matching setting (youtube, etc) in channel {}".format(channel))
     delete_status(db, conn.name, channel)
     load_cache(db)
+    bot.plugin_manager.clear_sieve_cache()
 
 
 @hook.command(autohelp=False, permissions=["botcontrol"])
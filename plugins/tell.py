@@ -72,7 +72,7 @@ def add_tell(db, server, sender, target, message):
     db.commit()
 
 
-@hook.event(EventType.message, singlethread=True)
+@hook.event(EventType.message, max_concurrency=1, concurrency_key=("conn", "nick"))
 def tellinput(event, conn, db, nick, notice):
     """
     :type event: cloudbot.event.Event
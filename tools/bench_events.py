@@ -0,0 +1,139 @@
+"""
+Micro-benchmark for fanning an incoming line out to the hooks it triggers.
+
+For each line, this parses it into the base Event the way the IRC client does, creates an event for each of a number
+of hooks, and gets each hook's arguments from its event, the way PluginManager does before calling the hook. It
+compares three ways of creating the per-hook events, and reports the time and the memory allocated per line for each:
+
+- copying: how events were created before Event.view() existed, with an instance dict each and a copy of the base
+  event's assigned fields
+- constructor: the Event constructors, with base_event=...
+- view: Event.view()
+
+Usage: python3 -m tools.bench_events [--lines N] [--hooks N] [--args NAME,NAME,...]
+"""
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+from cloudbot.clients.irc import IrcMessage
+from cloudbot.event import Event, CommandEvent, RegexEvent
+
+sample_lines = [
+    ":nick{0}!~user@host{0}.example.com PRIVMSG #channel :just some chatter, line {0}",
+    ":nick{0}!~user@host{0}.example.com PRIVMSG #channel :.choose red, green, blue",
+    ":nick{0}!~user@host{0}.example.com PRIVMSG #channel :have a look at http://example.com/{0}",
+    ":nick{0}!~user@host{0}.example.com JOIN :#channel",
+]
+
+
+class _StubConn:
+    """
+    Just enough of a connection for IrcMessage
+    """
+    name = "bench"
+    nick = "CloudBot"
+
+
+# subclasses without __slots__, so their instances get a __dict__ like events used to
+_DictEvent = type("_DictEvent", (Event,), {})
+_DictCommandEvent = type("_DictCommandEvent", (CommandEvent,), {})
+_DictRegexEvent = type("_DictRegexEvent", (RegexEvent,), {})
+
+
+def _copy(base_event, hook, kind):
+    if kind == 1:
+        event = _DictCommandEvent(hook=hook, text="red, green, blue", triggered_command="choose", base_event=base_event)
+    elif kind == 2:
+        event = _DictRegexEvent(hook=hook, match=None, base_event=base_event)
+    else:
+        event = _DictEvent(hook=hook, base_event=base_event)
+    event._fields = base_event._fields.copy()
+    event._fields_shared = False
+    return event
+
+
+def _construct(base_event, hook, kind):
+    if kind == 1:
+        return CommandEvent(hook=hook, text="red, green, blue", triggered_command="choose", base_event=base_event)
+    if kind == 2:
+        return RegexEvent(hook=hook, match=None, base_event=base_event)
+    return Event(hook=hook, base_event=base_event)
+
+
+def _view(base_event, hook, kind):
+    if kind == 1:
+        return CommandEvent.view(base_event, hook, text="red, green, blue", triggered_command="choose")
+    if kind == 2:
+        return RegexEvent.view(base_event, hook, match=None)
+    return Event.view(base_event, hook)
+
+
+def fan_out(lines, hooks, args, make_event, keep=None):
+    """
+    :type lines: list[str]
+    :type hooks: int
+    :type args: list[str]
+    :type make_event: (Event, object, int) -> Event
+    :param keep: If given, every event and argument tuple created is added to this, so none of them are freed
+    :type keep: list
+    """
+    conn = _StubConn()
+    for line in lines:
+        base_event = Event(bot=None, conn=conn, irc_message=IrcMessage(conn, line))
+        for hook in range(hooks):
+            event = make_event(base_event, hook, hook % 3)
+            parameters = tuple(getattr(event, arg) for arg in args)
+            if keep is not None:
+                keep.append((event, parameters))
+
+
+def measure(lines, hooks, args, make_event):
+    """
+    :rtype: (float, float, float)
+    :return: seconds, memory blocks and bytes allocated, all per line
+    """
+    gc.collect()
+    start = time.perf_counter()
+    fan_out(lines, hooks, args, make_event)
+    elapsed = time.perf_counter() - start
+
+    # allocations are counted in a second run, since tracing them slows everything down. Everything created is kept
+    # alive until the end, so what's still allocated then is everything which was allocated.
+    keep = []
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        fan_out(lines, hooks, args, make_event, keep)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    # the list holding everything isn't part of the cost
+    blocks = sum(stat.count_diff for stat in stats) - 1
+    size = sum(stat.size_diff for stat in stats) - sys.getsizeof(keep)
+    return elapsed / len(lines), blocks / len(lines), size / len(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ways of creating per-hook events")
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--hooks", type=int, default=6, help="hooks each line is passed to")
+    parser.add_argument("--args", default="nick,chan,content,conn",
+                        help="arguments each hook asks for, separated by commas")
+    args = parser.parse_args()
+
+    lines = [sample_lines[i % len(sample_lines)].format(i) for i in range(args.lines)]
+    hook_args = args.args.split(",")
+    print("{} lines, {} hooks each, hooks asking for {}".format(args.lines, args.hooks, ", ".join(hook_args)))
+    print("{:<12} {:>12} {:>14} {:>14}".format("", "us/line", "blocks/line", "bytes/line"))
+    for name, make_event in (("copying", _copy), ("constructor", _construct), ("view", _view)):
+        elapsed, blocks, size = measure(lines, args.hooks, hook_args, make_event)
+        print("{:<12} {:>12.2f} {:>14.1f} {:>14.0f}".format(name, elapsed * 1000000, blocks, size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Micro-benchmark for inbound IRC line framing.
+
+Feeds multi-megabyte bursts (NAMES replies, MOTD, netsplit QUITs) through IrcLineBuffer and through the old
+bytes-concatenation approach, in socket-sized chunks, and prints the throughput of each.
+
+Usage: python3 -m tools.bench_framing [megabytes] [chunk_size]
+"""
+import sys
+import time
+
+from cloudbot.clients.irc import IrcLineBuffer
+
+
+def _legacy_framing(chunks):
+    """
+    The framing which _IrcProtocol.data_received used to do, kept here for comparison
+    :type chunks: list[bytes]
+    :rtype: int
+    """
+    input_buffer = b""
+    count = 0
+    for data in chunks:
+        input_buffer += data
+        while b"\r\n" in input_buffer:
+            line_data, input_buffer = input_buffer.split(b"\r\n", 1)
+            line_data.decode()
+            count += 1
+    return count
+
+
+def _buffer_framing(chunks):
+    """
+    :type chunks: list[bytes]
+    :rtype: int
+    """
+    line_buffer = IrcLineBuffer()
+    count = 0
+    for data in chunks:
+        count += len(line_buffer.feed(data))
+    return count
+
+
+def make_burst(size):
+    """
+    Creates roughly <size> bytes of realistic server output
+    :type size: int
+    :rtype: bytes
+    """
+    names = " ".join("@user{0} +voiced{0} plain{0}".format(i) for i in range(40))
+    lines = [
+        ":irc.example.net 353 CloudBot = #channel :{}".format(names),
+        ":irc.example.net 372 CloudBot :- Welcome to the example network, please read the rules.",
+        ":someone!~ident@host.example.com QUIT :irc.example.net split.example.net",
+        ":other!~ident@host.example.com PRIVMSG #channel :élève café ☃ some unicode chatter",
+    ]
+    block = ("\r\n".join(lines) + "\r\n").encode("utf-8")
+    return block * (size // len(block) + 1)
+
+
+def chunk(data, chunk_size):
+    """
+    :type data: bytes
+    :type chunk_size: int
+    :rtype: list[bytes]
+    """
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def run(name, function, chunks, total_bytes):
+    start = time.perf_counter()
+    count = function(chunks)
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:>9} lines  {:>8.3f}s  {:>8.1f} MB/s  {:>10.0f} lines/s".format(
+        name, count, elapsed, total_bytes / elapsed / 1e6, count / elapsed))
+    return count
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 65536
+
+    data = make_burst(int(megabytes * 1024 * 1024))
+    chunks = chunk(data, chunk_size)
+    print("Framing {:.1f} MB in {} chunks of {} bytes".format(len(data) / 1024 / 1024, len(chunks), chunk_size))
+
+    new_count = run("buffer", _buffer_framing, chunks, len(data))
+    old_count = run("legacy", _legacy_framing, chunks, len(data))
+    assert new_count == old_count, "framers disagree on line count"
+
+
+if __name__ == "__main__":
+    main()
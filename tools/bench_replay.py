@@ -0,0 +1,317 @@
+"""
+Replay benchmark for the whole inbound pipeline.
+
+Replays a raw IRC log (as written by the raw_file_log option of plugins/log.py) through _IrcProtocol.data_received,
+the connection's dispatch queue, CloudBot.process and every loaded plugin's hooks, against a stub transport, so no
+network or server is needed. Replies the plugins send are counted and thrown away.
+
+It reports lines per second, latency percentiles for each hook and for all hooks together, and allocation counts for
+the run.
+
+Run this from the bot's directory, since it loads config.json, the database and the plugins just like the bot does.
+The first connection in config.json is used for per-connection settings.
+
+Usage: python3 -m tools.bench_replay [--speed N] [--chunk-size BYTES] [--tracemalloc] [--no-inline] <raw log file>
+
+With --speed, lines are replayed at N times their original timing, taken from their IRCv3 server-time tags (lines
+without one are sent straight away). By default lines are replayed as fast as the bot will take them.
+
+With --no-inline, every threaded hook is run in a thread, even ones which ask to be run inline or are quick enough to be
+moved onto the event loop, to compare the latencies with and without that.
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+import datetime
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from cloudbot.bot import CloudBot
+from cloudbot.clients.irc import IrcClient, IrcMessage, _IrcProtocol
+
+logger = logging.getLogger("cloudbot")
+
+
+class StubTransport:
+    """
+    A transport which counts what's written to it, and supports pausing reading
+    :type paused: bool
+    :type bytes_written: int
+    """
+
+    def __init__(self, loop):
+        self.paused = False
+        self.bytes_written = 0
+        self.resumed = asyncio.Event(loop=loop)
+        self.resumed.set()
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def close(self):
+        pass
+
+    def pause_reading(self):
+        self.paused = True
+        self.resumed.clear()
+
+    def resume_reading(self):
+        self.paused = False
+        self.resumed.set()
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+class ReplayClient(IrcClient):
+    """
+    An IrcClient which "connects" to a StubTransport instead of a server
+    :type transport: StubTransport
+    """
+
+    @asyncio.coroutine
+    def connect(self):
+        self._start_tasks()
+        self.transport = StubTransport(self.loop)
+        self._transport = self.transport
+        self._protocol = _IrcProtocol(self)
+        self._protocol.connection_made(self.transport)
+        self._connected = True
+        self._cap_negotiating = False
+
+    def feed(self, data):
+        """
+        :type data: bytes
+        """
+        self._protocol.data_received(data)
+
+
+class HookTimer:
+    """
+    Wraps PluginManager.launch and PluginManager.start, recording how long each hook takes from being launched to
+    finishing (including its sieves). Hooks which CloudBot.process starts in tasks of their own are timed until their
+    task finishes.
+    :type latencies: dict[str, list[float]]
+    """
+
+    def __init__(self, plugin_manager):
+        """
+        :type plugin_manager: cloudbot.plugin.PluginManager
+        """
+        self.latencies = defaultdict(list)
+        self._launch = plugin_manager.launch
+        self._start = plugin_manager.start
+        plugin_manager.launch = self.launch
+        plugin_manager.start = self.start
+
+    @asyncio.coroutine
+    def launch(self, hook, event):
+        start = time.perf_counter()
+        try:
+            return (yield from self._launch(hook, event))
+        finally:
+            self.latencies[hook.description].append(time.perf_counter() - start)
+
+    @asyncio.coroutine
+    def start(self, hook, event):
+        start = time.perf_counter()
+        started = yield from self._start(hook, event)
+        if started is None:
+            # stopped by a sieve
+            self.latencies[hook.description].append(time.perf_counter() - start)
+        else:
+            started[1].add_done_callback(lambda task: self.latencies[hook.description].append(
+                time.perf_counter() - start))
+        return started
+
+
+def percentile(values, fraction):
+    """
+    :param values: Sorted values
+    :type values: list[float]
+    :type fraction: float
+    :rtype: float
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def read_log(path):
+    """
+    Reads the lines from a raw log, leaving out the blank ones
+    :type path: str
+    :rtype: list[str]
+    """
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return [line.rstrip("\r\n") for line in f if line.strip()]
+
+
+def line_time(conn, line):
+    """
+    Gets the server-time of a line, as a unix timestamp, or None if it doesn't have one
+    :type conn: IrcClient
+    :type line: str
+    :rtype: float
+    """
+    if not line.startswith("@"):
+        return None
+    server_time = IrcMessage(conn, line).tags.get("time")
+    if not server_time:
+        return None
+    try:
+        parsed = datetime.datetime.strptime(server_time, "%Y-%m-%dT%H:%M:%S.%fZ")
+    except ValueError:
+        return None
+    return parsed.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+@asyncio.coroutine
+def replay(conn, lines, *, speed=0, chunk_size=4096):
+    """
+    Feeds <lines> to <conn> in chunks of about <chunk_size> bytes, then waits for every hook to finish
+    :type conn: ReplayClient
+    :type lines: list[str]
+    :param speed: Replay at this many times the original timing, or as fast as possible if 0
+    :type speed: float
+    :type chunk_size: int
+    """
+    start = time.time()
+    first_line_time = None
+    chunk = []
+    chunk_bytes = 0
+
+    for line in lines:
+        if speed:
+            timestamp = line_time(conn, line)
+            if timestamp is not None:
+                if first_line_time is None:
+                    first_line_time = timestamp
+                delay = (timestamp - first_line_time) / speed - (time.time() - start)
+                if delay > 0:
+                    if chunk:
+                        conn.feed(b"".join(chunk))
+                        chunk, chunk_bytes = [], 0
+                    yield from asyncio.sleep(delay, loop=conn.loop)
+
+        data = line.encode("utf-8") + b"\r\n"
+        chunk.append(data)
+        chunk_bytes += len(data)
+        if chunk_bytes >= chunk_size:
+            # like a real socket, don't read any more while the bot has asked us not to
+            yield from conn.transport.resumed.wait()
+            conn.feed(b"".join(chunk))
+            chunk, chunk_bytes = [], 0
+            # let the dispatch workers run, as they would between socket reads
+            yield from asyncio.sleep(0, loop=conn.loop)
+
+    if chunk:
+        yield from conn.transport.resumed.wait()
+        conn.feed(b"".join(chunk))
+    yield from conn.wait_for_dispatch()
+
+
+def report(conn, timer, line_count, elapsed, allocations):
+    """
+    Prints the results of a replay
+    :type conn: ReplayClient
+    :type timer: HookTimer
+    :type line_count: int
+    :type elapsed: float
+    :type allocations: dict[str, int | str]
+    """
+    print("Replayed {} lines in {:.3f}s: {:.0f} lines/sec".format(line_count, elapsed, line_count / elapsed))
+    print("Events dispatched: {}, lines no hook wanted: {}, peak dispatch queue: {}, read pauses: {}".format(
+        conn.events_dispatched, conn.events_skipped, conn.dispatch_queue_peak, conn.read_pauses))
+    print("Dispatch plans built: {}".format(conn.bot.plugin_manager.plans_built))
+    print("Lines sent: {}, bytes written: {}".format(conn.lines_sent, conn.transport.bytes_written))
+    plugin_manager = conn.bot.plugin_manager
+    print("Hooks run inline: {} (moved onto the event loop: {}, moved back off it: {})".format(
+        len(plugin_manager.inline_hooks()), plugin_manager.hooks_promoted, plugin_manager.hooks_demoted))
+    print()
+    everything = sorted(latency for latencies in timer.latencies.values() for latency in latencies)
+    if everything:
+        print("All hooks: {} calls, p50 {:.3f}ms, p90 {:.3f}ms, p99 {:.3f}ms, p99.9 {:.3f}ms, max {:.3f}ms".format(
+            len(everything), percentile(everything, 0.5) * 1000, percentile(everything, 0.9) * 1000,
+            percentile(everything, 0.99) * 1000, percentile(everything, 0.999) * 1000, everything[-1] * 1000))
+        print()
+    print("{:<40} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "hook", "calls", "p50 ms", "p90 ms", "p99 ms", "p99.9 ms", "max ms"))
+    ordered = sorted(timer.latencies.items(), key=lambda item: sum(item[1]), reverse=True)
+    for description, latencies in ordered:
+        latencies.sort()
+        print("{:<40} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            description, len(latencies), percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, percentile(latencies, 0.999) * 1000, latencies[-1] * 1000))
+    print()
+    for name, value in allocations.items():
+        print("{}: {}".format(name, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a raw IRC log through the bot, and time it")
+    parser.add_argument("log", help="a raw log file, one IRC line per line")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="replay at this many times the original speed, using server-time tags")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="bytes to feed at a time")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="trace allocations, and show where the most were made (much slower)")
+    parser.add_argument("--no-inline", action="store_true", help="run every threaded hook in a thread")
+    args = parser.parse_args()
+
+    if not os.path.exists("config.json"):
+        print("Run this from the bot's directory, with a config.json")
+        sys.exit(1)
+    logging.getLogger("cloudbot").setLevel(logging.WARNING)
+
+    lines = read_log(args.log)
+    loop = asyncio.get_event_loop()
+    bot = CloudBot(loop)
+    loop.run_until_complete(bot.plugin_manager.load_all(os.path.abspath("plugins")))
+    if args.no_inline:
+        bot.plugin_manager.adaptive_inline = False
+        for hook in bot.plugin_manager.all_hooks():
+            hook.runs_inline = False
+
+    conf = dict(bot.config["connections"][0])
+    # replies are thrown away, so don't hold them back
+    conf["flood_control"] = {"enabled": False, "max_queue": sys.maxsize}
+    conn = ReplayClient(bot, "replay", conf["nick"], readable_name="replay", channels=conf["channels"],
+                        config=conf, server="replay.invalid")
+    bot.connections.append(conn)
+    loop.run_until_complete(conn.connect())
+    timer = HookTimer(bot.plugin_manager)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    gc.collect()
+    gc_before = [stats["collections"] for stats in gc.get_stats()]
+    blocks_before = sys.getallocatedblocks()
+
+    start = time.perf_counter()
+    loop.run_until_complete(replay(conn, lines, speed=args.speed, chunk_size=args.chunk_size))
+    elapsed = time.perf_counter() - start
+
+    gc_after = [stats["collections"] for stats in gc.get_stats()]
+    allocations = {
+        "memory blocks still allocated": sys.getallocatedblocks() - blocks_before,
+        "gc collections (gen 0/1/2)": "/".join(str(after - before) for before, after in zip(gc_before, gc_after)),
+    }
+    if args.tracemalloc:
+        snapshot = tracemalloc.take_snapshot()
+        allocations["peak traced memory (bytes)"] = tracemalloc.get_traced_memory()[1]
+        for stat in snapshot.statistics("lineno")[:10]:
+            allocations["  {}".format(stat.traceback[0])] = "{} blocks, {} bytes".format(stat.count, stat.size)
+        tracemalloc.stop()
+
+    report(conn, timer, len(lines), elapsed, allocations)
+    conn.close()
+    loop.run_until_complete(bot.stop("Replay finished"))
+
+
+if __name__ == "__main__":
+    main()
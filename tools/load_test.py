@@ -0,0 +1,272 @@
+"""
+Synthetic load test, for capacity planning.
+
+Starts the stub ircd in-process on localhost, connects the real CloudBot (with config.json and the real plugins) to
+it, and has M simulated users in N channels send a mix of chatter, commands, URLs and joins/parts at a set rate. The
+time from a user sending a command to the bot's reply reaching them is measured, and a throughput and latency report
+is printed at the end.
+
+A reply is matched to the oldest unanswered command from the user it's addressed to, either by the "nick, " prefix
+the bot puts on channel replies, or by being sent to them directly. Commands which only reply with an action can't be
+matched, so the default commands all reply normally.
+
+Run this from the bot's directory. Plugins which fetch URLs will really try to fetch the generated ones, which use
+the .invalid domain so the lookup fails quickly.
+
+Usage: python3 -m tools.load_test [--channels N] [--users M] [--rate MSGS_PER_SEC] [--duration SECONDS]
+                                  [--mix chatter=70,command=20,url=5,joinpart=5] [--command TEXT ...]
+                                  [--no-flood-control]
+"""
+import argparse
+import asyncio
+import bisect
+from collections import Counter, defaultdict, deque
+import itertools
+import logging
+import os
+import random
+import sys
+import time
+
+from cloudbot.bot import CloudBot
+from cloudbot.clients.irc import IrcClient
+from tools.bench_replay import percentile
+from tools.stub_ircd import StubIrcd
+
+default_mix = "chatter=70,command=20,url=5,joinpart=5"
+default_commands = ["choose red, green, blue", "roll 2d6", "choose yes, no"]
+words = ["the", "bot", "is", "a", "channel", "message", "hello", "anyone", "here", "today", "server", "load", "test"]
+
+
+def parse_mix(mix):
+    """
+    Parses a mix like "chatter=70,command=30" into the kinds of message, and their cumulative weights
+    :type mix: str
+    :rtype: (list[str], list[int])
+    """
+    kinds, weights = [], []
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        kinds.append(kind.strip())
+        weights.append(int(weight))
+    return kinds, list(itertools.accumulate(weights))
+
+
+class LoadGenerator:
+    """
+    Simulated users, and the statistics of what they've sent and received
+    :type server: StubIrcd
+    :type bot_nick: str
+    :type pending: dict[str, deque[float]]
+    :type latencies: list[float]
+    :type sent: Counter
+    """
+
+    def __init__(self, server, bot_nick, *, channels, users, channels_per_user, commands, command_prefix="."):
+        """
+        :type server: StubIrcd
+        :type bot_nick: str
+        :type channels: int
+        :type users: int
+        :type channels_per_user: int
+        :type commands: list[str]
+        :type command_prefix: str
+        """
+        self.server = server
+        self.bot_nick = bot_nick
+        self.channels = ["#load{}".format(i) for i in range(channels)]
+        self.commands = commands
+        self.command_prefix = command_prefix
+        self._bot_prefix = ":{}!".format(bot_nick)
+        self._channels_per_user = min(channels_per_user, channels)
+        self.users = [server.add_virtual_client("user{}".format(i), self._on_line) for i in range(users)]
+        # nick -> when each of their unanswered commands was sent
+        self.pending = defaultdict(deque)
+        self.latencies = []
+        self.sent = Counter()
+        self.replies = 0
+        self.unmatched_replies = 0
+
+    def join_all(self):
+        """
+        Joins the bot and then every user to their channels
+        """
+        bot = self.server.find_client(self.bot_nick)
+        for channel in self.channels:
+            # like a services-forced join, since core_misc joins configured channels a second apart
+            self.server.handle_line(bot, "JOIN {}".format(channel))
+        for user in self.users:
+            for channel in random.sample(self.channels, self._channels_per_user):
+                self.server.handle_line(user, "JOIN {}".format(channel))
+
+    def _on_line(self, user, line):
+        """
+        :type user: tools.stub_ircd.VirtualClient
+        :type line: str
+        """
+        if not line.startswith(self._bot_prefix):
+            return
+        _, command, rest = line.split(" ", 2)
+        if command not in ("PRIVMSG", "NOTICE"):
+            return
+        target, _, text = rest.partition(" :")
+        if target.startswith("#"):
+            if not text.startswith("{}, ".format(user.nick)):
+                return
+        elif target.lower() != user.nick.lower():
+            return
+        self.replies += 1
+        pending = self.pending.get(user.nick)
+        if pending:
+            self.latencies.append(time.perf_counter() - pending.popleft())
+        else:
+            self.unmatched_replies += 1
+
+    def send_one(self, kind):
+        """
+        Has a random user send one message of the given kind
+        :type kind: str
+        """
+        user = random.choice(self.users)
+        if not user.channels:
+            return
+        channel = random.choice(list(user.channels))
+        if kind == "command":
+            self.pending[user.nick].append(time.perf_counter())
+            text = self.command_prefix + random.choice(self.commands)
+        elif kind == "url":
+            text = "have a look at http://{}.example.invalid/{}".format(random.choice(words), random.randint(0, 10000))
+        elif kind == "joinpart":
+            self.server.handle_line(user, "PART {}".format(channel))
+            channel = random.choice(self.channels)
+            self.server.handle_line(user, "JOIN {}".format(channel))
+            self.sent[kind] += 1
+            return
+        else:
+            text = " ".join(random.choice(words) for _ in range(random.randint(3, 12)))
+        self.server.handle_line(user, "PRIVMSG {} :{}".format(channel, text))
+        self.sent[kind] += 1
+
+    @asyncio.coroutine
+    def run(self, rate, duration, mix, loop):
+        """
+        Sends messages at <rate> per second for <duration> seconds
+        :type rate: float
+        :type duration: float
+        :type mix: (list[str], list[int])
+        :type loop: asyncio.events.AbstractEventLoop
+        """
+        kinds, cumulative_weights = mix
+        start = time.perf_counter()
+        owed = 0
+        last = start
+        while True:
+            now = time.perf_counter()
+            if now - start >= duration:
+                break
+            owed += (now - last) * rate
+            last = now
+            count = int(owed)
+            owed -= count
+            for _ in range(count):
+                index = bisect.bisect(cumulative_weights, random.random() * cumulative_weights[-1])
+                self.send_one(kinds[index])
+            yield from asyncio.sleep(0.01, loop=loop)
+
+
+def report(generator, conn, delivered, duration, drain_time):
+    """
+    :type generator: LoadGenerator
+    :type conn: IrcClient
+    :param delivered: How many lines the server sent the bot while the load was being generated
+    :type delivered: int
+    :type duration: float
+    :type drain_time: float
+    """
+    total_sent = sum(generator.sent.values())
+    print("Generated {} messages in {:.1f}s ({:.0f}/sec): {}".format(
+        total_sent, duration, total_sent / duration,
+        ", ".join("{} {}".format(count, kind) for kind, count in generator.sent.most_common())))
+    print("Lines delivered to the bot: {} ({:.0f}/sec), events it processed: {}, peak dispatch queue: {}".format(
+        delivered, delivered / duration, conn.events_dispatched, conn.dispatch_queue_peak))
+    print("Lines sent by the bot: {}, dropped: {}".format(conn.lines_sent, conn.lines_dropped))
+    unanswered = sum(len(pending) for pending in generator.pending.values())
+    print("Commands: {}, replies: {} ({} unmatched), unanswered after {:.1f}s: {}".format(
+        generator.sent["command"], generator.replies, generator.unmatched_replies, drain_time, unanswered))
+    latencies = sorted(generator.latencies)
+    if latencies:
+        print("Command -> reply latency: p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms, max {:.1f}ms".format(
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the bot against an in-process IRC server")
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--channels-per-user", type=int, default=3)
+    parser.add_argument("--rate", type=float, default=50, help="messages per second, from all users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to generate load for")
+    parser.add_argument("--drain", type=float, default=10, help="seconds to wait for replies after the load stops")
+    parser.add_argument("--mix", default=default_mix, help="weights of each kind of message")
+    parser.add_argument("--command", action="append", dest="commands",
+                        help="a command to send, without the prefix (can be given more than once)")
+    parser.add_argument("--no-flood-control", action="store_true", help="let the bot reply as fast as it can")
+    parser.add_argument("--port", type=int, default=0, help="port for the server (default: any free port)")
+    args = parser.parse_args()
+
+    if not os.path.exists("config.json"):
+        print("Run this from the bot's directory, with a config.json")
+        sys.exit(1)
+    logging.getLogger("cloudbot").setLevel(logging.WARNING)
+
+    loop = asyncio.get_event_loop()
+    server = StubIrcd(loop=loop, netjoin_size=0)
+    listener = loop.run_until_complete(server.start(port=args.port))
+    port = listener.sockets[0].getsockname()[1]
+
+    bot = CloudBot(loop)
+    loop.run_until_complete(bot.plugin_manager.load_all(os.path.abspath("plugins")))
+
+    conf = dict(bot.config["connections"][0])
+    conf["connection"] = {"server": "127.0.0.1", "port": port}
+    conf["sasl"] = {"enabled": False}
+    conf["nickserv"] = {"enabled": False}
+    if args.no_flood_control:
+        conf["flood_control"] = {"enabled": False, "max_queue": sys.maxsize}
+    conn = IrcClient(bot, "loadtest", conf["nick"], readable_name="loadtest", channels=[], config=conf,
+                     server="127.0.0.1", port=port)
+    # only our connection, so stopping the bot doesn't try to quit the real ones
+    bot.connections = [conn]
+    loop.run_until_complete(conn.connect())
+
+    @asyncio.coroutine
+    def wait_for_registration():
+        while True:
+            bot_client = server.find_client(conn.nick)
+            if bot_client is not None and bot_client.registered:
+                return bot_client
+            yield from asyncio.sleep(0.1, loop=loop)
+
+    bot_client = loop.run_until_complete(asyncio.wait_for(wait_for_registration(), 30, loop=loop))
+    generator = LoadGenerator(server, conn.nick, channels=args.channels, users=args.users,
+                              channels_per_user=args.channels_per_user, commands=args.commands or default_commands,
+                              command_prefix=conf.get("command_prefix", "."))
+    generator.join_all()
+    # let the bot catch up with the joins before the clock starts
+    loop.run_until_complete(asyncio.sleep(1, loop=loop))
+    lines_before = bot_client.lines_sent
+
+    start = time.perf_counter()
+    loop.run_until_complete(generator.run(args.rate, args.duration, parse_mix(args.mix), loop))
+    duration = time.perf_counter() - start
+    delivered = bot_client.lines_sent - lines_before
+    loop.run_until_complete(asyncio.sleep(args.drain, loop=loop))
+
+    report(generator, conn, delivered, duration, args.drain)
+    loop.run_until_complete(bot.stop("Load test finished"))
+    server.close()
+
+
+if __name__ == "__main__":
+    main()
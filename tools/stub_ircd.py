@@ -0,0 +1,373 @@
+"""
+A minimal IRC server, for testing the bot's IRC client locally without a real network.
+
+It supports registration with IRCv3 capability negotiation (CAP LS/REQ/END, and SASL PLAIN), JOIN/PART, PRIVMSG and
+NOTICE between connected clients, and PING/PONG. When a client with the batch capability joins a channel, the server
+sends it a netjoin BATCH of a few fake users, so batch handling can be seen working.
+
+Simulated users can be added with add_virtual_client(), which live inside the server rather than connecting to it, for
+generating load without thousands of sockets (see tools/load_test.py).
+
+Usage: python3 -m tools.stub_ircd [port] [sasl_user:sasl_password]
+
+Then point a connection in config.json at localhost:<port>.
+"""
+import asyncio
+import base64
+import logging
+import sys
+import time
+
+logger = logging.getLogger("stub_ircd")
+
+server_name = "stub.irc"
+
+supported_caps = ["multi-prefix", "extended-join", "away-notify", "server-time", "batch", "message-tags", "sasl"]
+
+
+class StubClient:
+    """
+    A client connected to the stub server
+    :type server: StubIrcd
+    :type writer: asyncio.StreamWriter
+    :type nick: str
+    :type user: str
+    :type caps: set[str]
+    :type channels: set[str]
+    """
+
+    def __init__(self, server, writer):
+        self.server = server
+        self.writer = writer
+        self.nick = None
+        self.user = None
+        self.caps = set()
+        self.channels = set()
+        self.account = None
+        self.registered = False
+        self._negotiating = False
+        self.lines_sent = 0
+
+    @property
+    def mask(self):
+        return "{}!{}@127.0.0.1".format(self.nick, self.user)
+
+    def send(self, line, tags=None):
+        """
+        :type line: str
+        :type tags: dict[str, str]
+        """
+        if tags is None:
+            tags = {}
+        if "server-time" in self.caps:
+            tags.setdefault("time", time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()))
+        if tags and ("message-tags" in self.caps or "server-time" in self.caps or "batch" in self.caps):
+            line = "@{} {}".format(";".join("{}={}".format(key, value) for key, value in tags.items()), line)
+        self.writer.write((line + "\r\n").encode("utf-8"))
+        self.lines_sent += 1
+
+    def numeric(self, numeric, text):
+        self.send(":{} {} {} {}".format(server_name, numeric, self.nick or "*", text))
+
+    def try_register(self):
+        if self.registered or self._negotiating or self.nick is None or self.user is None:
+            return
+        self.registered = True
+        self.numeric("001", ":Welcome to the stub network, {}".format(self.mask))
+        self.numeric("002", ":Your host is {}".format(server_name))
+        self.numeric("003", ":This server was created just now")
+        self.numeric("004", "{} stub-1.0 iow ov".format(server_name))
+        self.numeric("376", ":End of /MOTD command.")
+
+
+class VirtualClient(StubClient):
+    """
+    A simulated user, which lives inside the server instead of connecting to it. Lines sent to it are passed to on_line,
+    if it's given, and otherwise thrown away.
+    :type on_line: (VirtualClient, str) -> None
+    """
+
+    def __init__(self, server, nick, on_line=None):
+        """
+        :type server: StubIrcd
+        :type nick: str
+        :type on_line: (VirtualClient, str) -> None
+        """
+        super().__init__(server, None)
+        self.nick = nick
+        self.user = nick.lower()[:10]
+        self.registered = True
+        self.on_line = on_line
+
+    def send(self, line, tags=None):
+        self.lines_sent += 1
+        if self.on_line is not None:
+            self.on_line(self, line)
+
+
+class StubIrcd:
+    """
+    :type clients: set[StubClient]
+    :type channels: dict[str, set[StubClient]]
+    :type sasl_accounts: dict[str, str]
+    """
+
+    def __init__(self, *, loop=None, sasl_accounts=None, netjoin_size=3):
+        """
+        :param sasl_accounts: Accounts which SASL PLAIN will accept, account name -> password
+        :param netjoin_size: How many fake users to send in a netjoin batch when a client joins a channel
+        :type sasl_accounts: dict[str, str]
+        :type netjoin_size: int
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.clients = set()
+        self.channels = {}
+        self.sasl_accounts = sasl_accounts or {}
+        self.netjoin_size = netjoin_size
+        self.lines_received = 0
+        self._server = None
+        self._batch_counter = 0
+
+    @asyncio.coroutine
+    def start(self, host="127.0.0.1", port=6667):
+        self._server = yield from asyncio.start_server(self._handle_client, host, port, loop=self.loop)
+        return self._server
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for client in list(self.clients):
+            if client.writer is not None:
+                client.writer.close()
+
+    def add_virtual_client(self, nick, on_line=None):
+        """
+        Adds a simulated user, which can then send lines with handle_line()
+        :type nick: str
+        :type on_line: (VirtualClient, str) -> None
+        :rtype: VirtualClient
+        """
+        client = VirtualClient(self, nick, on_line)
+        self.clients.add(client)
+        return client
+
+    def find_client(self, nick):
+        """
+        :type nick: str
+        :rtype: StubClient
+        """
+        for client in self.clients:
+            if client.nick is not None and client.nick.lower() == nick.lower():
+                return client
+        return None
+
+    @asyncio.coroutine
+    def _handle_client(self, reader, writer):
+        client = StubClient(self, writer)
+        self.clients.add(client)
+        try:
+            while True:
+                data = yield from reader.readline()
+                if not data:
+                    break
+                line = data.decode("utf-8", "replace").rstrip("\r\n")
+                if line:
+                    self.lines_received += 1
+                    self.handle_line(client, line)
+        finally:
+            self._quit(client, "Connection closed")
+            writer.close()
+
+    def handle_line(self, client, line):
+        """
+        :type client: StubClient
+        :type line: str
+        """
+        if " :" in line:
+            head, trailing = line.split(" :", 1)
+            params = head.split() + [trailing]
+        else:
+            params = line.split()
+        command = params.pop(0).upper()
+        handler = getattr(self, "on_" + command.lower(), None)
+        if handler is None:
+            if client.registered:
+                client.numeric("421", "{} :Unknown command".format(command))
+            return
+        handler(client, params)
+
+    def on_cap(self, client, params):
+        subcommand = params[0].upper()
+        if subcommand == "LS":
+            client._negotiating = True
+            client.send(":{} CAP {} LS :{}".format(server_name, client.nick or "*", " ".join(supported_caps)))
+        elif subcommand == "REQ":
+            requested = params[1].split()
+            if all(cap.lstrip("-") in supported_caps for cap in requested):
+                for cap in requested:
+                    if cap.startswith("-"):
+                        client.caps.discard(cap[1:])
+                    else:
+                        client.caps.add(cap)
+                client.send(":{} CAP {} ACK :{}".format(server_name, client.nick or "*", params[1]))
+            else:
+                client.send(":{} CAP {} NAK :{}".format(server_name, client.nick or "*", params[1]))
+        elif subcommand == "END":
+            client._negotiating = False
+            client.try_register()
+
+    def on_authenticate(self, client, params):
+        if params[0] == "PLAIN":
+            client.send("AUTHENTICATE +")
+            return
+        if params[0] == "*":
+            client.numeric("906", ":SASL authentication aborted")
+            return
+        try:
+            _, account, password = base64.b64decode(params[0]).decode("utf-8").split("\0")
+        except ValueError:
+            client.numeric("904", ":SASL authentication failed")
+            return
+        if self.sasl_accounts.get(account) == password:
+            client.account = account
+            client.numeric("900", "{} {} :You are now logged in as {}".format(client.mask, account, account))
+            client.numeric("903", ":SASL authentication successful")
+        else:
+            client.numeric("904", ":SASL authentication failed")
+
+    def on_pass(self, client, params):
+        pass
+
+    def on_nick(self, client, params):
+        old_mask = client.mask
+        client.nick = params[0]
+        if client.registered:
+            self._broadcast_common(client, ":{} NICK :{}".format(old_mask, client.nick), include_self=True)
+        client.try_register()
+
+    def on_user(self, client, params):
+        client.user = params[0]
+        client.try_register()
+
+    def on_ping(self, client, params):
+        client.send(":{} PONG {} :{}".format(server_name, server_name, params[-1]))
+
+    def on_pong(self, client, params):
+        pass
+
+    def on_join(self, client, params):
+        for channel in params[0].split(","):
+            channel = channel.lower()
+            members = self.channels.setdefault(channel, set())
+            members.add(client)
+            client.channels.add(channel)
+            for member in members:
+                if "extended-join" in member.caps:
+                    member.send(":{} JOIN {} {} :Stub User".format(client.mask, channel, client.account or "*"))
+                else:
+                    member.send(":{} JOIN :{}".format(client.mask, channel))
+            prefix = "@" if len(members) == 1 else ""
+            if "multi-prefix" in client.caps and prefix:
+                prefix = "@+"
+            names = " ".join(prefix + member.nick if member is client else member.nick for member in members)
+            client.numeric("353", "= {} :{}".format(channel, names))
+            client.numeric("366", "{} :End of /NAMES list.".format(channel))
+            if "batch" in client.caps and self.netjoin_size:
+                self.send_netjoin(client, channel)
+
+    def send_netjoin(self, client, channel):
+        """
+        Sends a netjoin batch of fake users joining <channel> to <client>
+        :type client: StubClient
+        :type channel: str
+        """
+        self._batch_counter += 1
+        reference = "netjoin{}".format(self._batch_counter)
+        client.send(":{} BATCH +{} netjoin {} other.{}".format(server_name, reference, server_name, server_name))
+        for i in range(self.netjoin_size):
+            client.send(":splitter{0}!split@other.{1} JOIN :{2}".format(i, server_name, channel),
+                        tags={"batch": reference})
+        client.send(":{} BATCH -{}".format(server_name, reference))
+
+    def on_part(self, client, params):
+        for channel in params[0].split(","):
+            channel = channel.lower()
+            members = self.channels.get(channel, set())
+            if client not in members:
+                continue
+            for member in members:
+                member.send(":{} PART {}".format(client.mask, channel))
+            members.discard(client)
+            client.channels.discard(channel)
+
+    def on_privmsg(self, client, params, command="PRIVMSG"):
+        target, text = params[0], params[-1]
+        line = ":{} {} {} :{}".format(client.mask, command, target, text)
+        if target.startswith("#"):
+            for member in self.channels.get(target.lower(), ()):
+                if member is not client:
+                    member.send(line)
+        else:
+            other = self.find_client(target)
+            if other is not None:
+                other.send(line)
+
+    def on_notice(self, client, params):
+        self.on_privmsg(client, params, command="NOTICE")
+
+    def on_mode(self, client, params):
+        pass
+
+    def on_quit(self, client, params):
+        client.send("ERROR :Closing link ({})".format(params[0] if params else "Quit"))
+        if client.writer is not None:
+            client.writer.close()
+        else:
+            self._quit(client, params[0] if params else "Quit")
+
+    def _quit(self, client, reason):
+        if client not in self.clients:
+            return
+        self.clients.discard(client)
+        self._broadcast_common(client, ":{} QUIT :{}".format(client.mask, reason))
+        for channel in client.channels:
+            self.channels.get(channel, set()).discard(client)
+
+    def _broadcast_common(self, client, line, include_self=False):
+        """
+        Sends <line> to everyone sharing a channel with <client>
+        """
+        recipients = set()
+        for channel in client.channels:
+            recipients.update(self.channels.get(channel, ()))
+        if include_self:
+            recipients.add(client)
+        else:
+            recipients.discard(client)
+        for recipient in recipients:
+            recipient.send(line)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 6667
+    sasl_accounts = {}
+    if len(sys.argv) > 2:
+        account, password = sys.argv[2].split(":", 1)
+        sasl_accounts[account] = password
+
+    loop = asyncio.get_event_loop()
+    server = StubIrcd(loop=loop, sasl_accounts=sasl_accounts)
+    loop.run_until_complete(server.start(port=port))
+    logger.info("Stub ircd listening on 127.0.0.1:{}".format(port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()